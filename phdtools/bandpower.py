@@ -0,0 +1,382 @@
+"""Vectorized band power of stacked power spectral densities.
+
+The bands are applied as a (frequencies x bands) weight matrix, so the band
+power of every recording, channel and band is obtained with one matrix
+product instead of one boolean mask and Python loop per band. Averages of
+quantities that can be infinite, such as PSDs in dB, are masked means over
+the bins of each band instead.
+
+Band power timelines are computed from a single short-time Fourier transform
+of the recording: the periodogram of every segment is reduced to its band
+powers, and the Welch estimate of each sliding window is the mean of the
+segments it contains, taken from cumulative sums.
+"""
+import numpy as np
+import pandas as pd
+import scipy.fft
+from scipy.signal import get_window
+
+# Frequency bands (Hz), both edges included
+BANDS = {
+    'Delta': [0.5, 4],
+    'Theta': [4, 8],
+    'Alpha': [8, 12],
+    'Beta': [12, 30],
+    'Gamma': [30, 50]
+}
+
+# Fatigue and engagement indexes, as bands summed in the numerator and the denominator
+FATIGUE_INDICES = {
+    "theta/alpha": (["Theta"], ["Alpha"]),
+    "(theta+alpha)/beta": (["Theta", "Alpha"], ["Beta"]),
+    "(theta+alpha)/(alpha+beta)": (["Theta", "Alpha"], ["Alpha", "Beta"]),
+    "beta/(alpha+theta)": (["Beta"], ["Alpha", "Theta"]),
+}
+
+
+def band_masks(freqs, bands=BANDS):
+    """Boolean mask of the frequencies of each band.
+
+    Parameters
+    ----------
+    freqs : np.ndarray
+        Frequencies of the PSD, shape (n_freqs,)
+    bands : dict, optional
+        Band name to [fmin, fmax], both edges included
+
+    Returns
+    -------
+    np.ndarray
+        Masks with shape (n_freqs, n_bands)
+    """
+    freqs = np.asarray(freqs)
+    edges = np.asarray(list(bands.values()), dtype=float)
+    return (freqs[:, None] >= edges[:, 0]) & (freqs[:, None] <= edges[:, 1])
+
+
+def band_matrix(freqs, bands=BANDS, method="mean"):
+    """Weight matrix mapping a spectrum to its band powers.
+
+    Parameters
+    ----------
+    freqs : np.ndarray
+        Frequencies of the PSD, shape (n_freqs,). They must be evenly spaced
+        when ``method="integrate"``.
+    bands : dict, optional
+        Band name to [fmin, fmax], both edges included
+    method : {"mean", "integrate"}, optional
+        Average the PSD over the band, or integrate it (sum times the
+        frequency resolution)
+
+    Returns
+    -------
+    np.ndarray
+        Weights with shape (n_freqs, n_bands)
+    """
+    masks = band_masks(freqs, bands).astype(float)
+    if method == "mean":
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return masks / masks.sum(axis=0)
+    if method == "integrate":
+        return masks * (freqs[1] - freqs[0])
+    raise ValueError(f"Unknown method '{method}', use 'mean' or 'integrate'")
+
+
+def band_means(psds, freqs, bands=BANDS):
+    """Average a spectrum over each band.
+
+    Parameters
+    ----------
+    psds : np.ndarray
+        Spectra with the frequencies in the last axis, e.g. (recordings,
+        channels, freqs). Any quantity can be averaged, such as PSDs in dB.
+    freqs : np.ndarray
+        Frequencies of the last axis
+    bands : dict, optional
+        Band name to [fmin, fmax], both edges included
+
+    Returns
+    -------
+    np.ndarray
+        Band averages with the frequency axis replaced by the bands
+    """
+    psds = np.asarray(psds)
+    # Masked means rather than the weight matrix, so a -inf dB bin (a flat
+    # channel) only affects the bands that contain it
+    return np.stack([psds[..., mask].mean(axis=-1) for mask in band_masks(freqs, bands).T], axis=-1)
+
+
+def band_power(psds, freqs, bands=BANDS, method="mean"):
+    """Compute absolute, relative and dB band power in one pass.
+
+    Parameters
+    ----------
+    psds : np.ndarray
+        PSDs with the frequencies in the last axis, usually stacked as
+        (recordings, channels, freqs)
+    freqs : np.ndarray
+        Evenly spaced frequencies of the last axis
+    bands : dict, optional
+        Band name to [fmin, fmax], both edges included
+    method : {"mean", "integrate"}, optional
+        How the absolute power of a band is obtained from its PSD
+
+    Returns
+    -------
+    dict
+        ``absolute``, ``relative`` and ``db`` arrays with the frequency axis
+        replaced by the bands. The relative power is the integrated power of
+        the band divided by the integrated power over all the bands.
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from scipy.signal import welch
+    >>> from phdtools.bandpower import band_power
+    >>> data = np.random.randn(100, 14, 128 * 60)  # recordings x channels x times
+    >>> freqs, psds = welch(data, fs=128, nperseg=1024)
+    >>> powers = band_power(psds, freqs)
+    >>> powers["relative"].shape
+    (100, 14, 5)
+    """
+    psds = np.asarray(psds)
+    freqs = np.asarray(freqs)
+    absolute = psds @ band_matrix(freqs, bands, method)
+    integrated = absolute if method == "integrate" else psds @ band_matrix(freqs, bands, "integrate")
+
+    # Total power over the union of the bands, counting shared edges once
+    total_mask = band_masks(freqs, bands).any(axis=1)
+    total = psds[..., total_mask].sum(axis=-1) * (freqs[1] - freqs[0])
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return {
+            "absolute": absolute,
+            "relative": integrated / total[..., None],
+            "db": 10 * np.log10(absolute),
+        }
+
+
+def band_power_frame(powers, ch_names, bands=BANDS, recordings=None):
+    """Arrange band powers as a tidy long-format table.
+
+    Parameters
+    ----------
+    powers : dict
+        Output of `band_power`, arrays of shape (recordings, channels, bands)
+        or (channels, bands)
+    ch_names : list of str
+        Channel names
+    bands : dict, optional
+        Bands used to compute the powers
+    recordings : list, optional
+        Identifier of each recording, e.g. the file names. Defaults to the
+        recording index.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per recording, channel and band with a column per measure
+    """
+    arrays = {name: np.asarray(values) for name, values in powers.items()}
+    shape = next(iter(arrays.values())).shape
+    if len(shape) == 2:
+        arrays = {name: values[None] for name, values in arrays.items()}
+        shape = (1,) + shape
+    n_recordings, n_channels, n_bands = shape
+    if recordings is None:
+        recordings = np.arange(n_recordings)
+
+    index = pd.MultiIndex.from_product(
+        [recordings, ch_names, list(bands)], names=["recording", "channel", "band"]
+    )
+    frame = pd.DataFrame({name: values.reshape(-1) for name, values in arrays.items()}, index=index)
+    return frame.reset_index()
+
+
+def segment_band_powers(data, sfreq, bands=BANDS, nperseg=256, noverlap=None, block_size=1024, workers=None):
+    """Band powers of the periodogram of every Welch segment of a signal.
+
+    The segments are strided views of the data, transformed a block at a time
+    with the same window, so the whole signal goes through one STFT pass.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Signals with the times in the last axis, e.g. (recordings, channels,
+        times)
+    sfreq : float
+        Sampling frequency
+    bands : dict, optional
+        Band name to [fmin, fmax], both edges included
+    nperseg : int, optional
+        Length of each segment
+    noverlap : int, optional
+        Overlap between segments, ``nperseg // 2`` by default
+    block_size : int, optional
+        Segments transformed at a time, which bounds the memory used
+    workers : int, optional
+        Threads of the FFT, see `scipy.fft.rfft`
+
+    Returns
+    -------
+    dict
+        ``mean`` and ``integrated`` band powers and ``total`` power over
+        all the bands, with shape (..., segments, bands) and (..., segments),
+        the ``step`` between segments in samples and the frequency
+        ``resolution``. The periodograms are Hann-windowed and detrended by
+        their mean, as in `scipy.signal.welch`.
+    """
+    data = np.asarray(data, dtype=float)
+    noverlap = nperseg // 2 if noverlap is None else noverlap
+    step = nperseg - noverlap
+    n_times = data.shape[-1]
+    if n_times < nperseg:
+        raise ValueError(f"The signal has {n_times} samples, less than one segment of {nperseg}")
+    n_segments = (n_times - nperseg) // step + 1
+
+    window = get_window("hann", nperseg)
+    scale = 1.0 / (sfreq * (window ** 2).sum())
+    freqs = np.fft.rfftfreq(nperseg, 1 / sfreq)
+    resolution = freqs[1] - freqs[0]
+    # One-sided density, the Nyquist frequency is not doubled
+    scale = np.full(len(freqs), 2 * scale)
+    scale[0] /= 2
+    if nperseg % 2 == 0:
+        scale[-1] /= 2
+
+    # Mean, integrated and total band power in one matrix product
+    total_mask = band_masks(freqs, bands).any(axis=1).astype(float)[:, None] * resolution
+    weights = np.hstack([band_matrix(freqs, bands, "mean"), band_matrix(freqs, bands, "integrate"), total_mask])
+    weights *= scale[:, None]
+
+    segments = np.lib.stride_tricks.sliding_window_view(data, nperseg, axis=-1)[..., ::step, :][..., :n_segments, :]
+    powers = np.empty(data.shape[:-1] + (n_segments, weights.shape[1]))
+    for start in range(0, n_segments, block_size):
+        block = segments[..., start:start + block_size, :]
+        block = (block - block.mean(axis=-1, keepdims=True)) * window
+        spectrum = scipy.fft.rfft(block, axis=-1, workers=workers)
+        powers[..., start:start + block_size, :] = (spectrum.real ** 2 + spectrum.imag ** 2) @ weights
+
+    n_bands = len(bands)
+    return {
+        "mean": powers[..., :n_bands],
+        "integrated": powers[..., n_bands:2 * n_bands],
+        "total": powers[..., -1],
+        "step": step,
+        "resolution": resolution,
+    }
+
+
+def band_power_timeline(data, sfreq, bands=BANDS, window=30.0, step=5.0, nperseg=256, noverlap=None,
+                        method="mean", indices=FATIGUE_INDICES, block_size=1024, workers=None):
+    """Band power, relative power and fatigue indexes in sliding windows.
+
+    Each window gets the Welch PSD of its samples (the mean of its segment
+    periodograms), but the periodograms are computed once for the whole
+    signal and shared by overlapping windows.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Signals with the times in the last axis, e.g. (channels, times) or
+        (recordings, channels, times) for recordings of the same length
+    sfreq : float
+        Sampling frequency
+    bands : dict, optional
+        Band name to [fmin, fmax], both edges included
+    window : float, optional
+        Length of the windows in seconds
+    step : float, optional
+        Time between the start of consecutive windows in seconds, rounded to
+        a whole number of segment steps
+    nperseg : int, optional
+        Length of the Welch segments
+    noverlap : int, optional
+        Overlap between segments, ``nperseg // 2`` by default
+    method : {"mean", "integrate"}, optional
+        How the absolute power of a band is obtained from its PSD
+    indices : dict, optional
+        Index name to the bands of its numerator and denominator, computed
+        from the integrated band powers
+    block_size, workers
+        See `segment_band_powers`
+
+    Returns
+    -------
+    dict
+        ``times`` of the window centres in seconds, ``absolute`` and
+        ``relative`` band powers with shape (..., windows, bands), and
+        ``indices``, a dict of arrays with shape (..., windows)
+
+    Examples
+    --------
+    >>> from phdtools.bandpower import band_power_timeline
+    >>> timeline = band_power_timeline(raw.get_data(), raw.info["sfreq"], window=30, step=5)
+    >>> timeline["indices"]["theta/alpha"].shape  # channels x windows of a 1 h recording at 128 Hz
+    (14, 715)
+    """
+    segments = segment_band_powers(data, sfreq, bands, nperseg, noverlap, block_size, workers)
+    segment_step = segments["step"]
+    window_segments = (int(round(window * sfreq)) - nperseg) // segment_step + 1
+    step_segments = max(1, int(round(step * sfreq / segment_step)))
+    n_segments = segments["total"].shape[-1]
+    if window_segments < 1 or window_segments > n_segments:
+        raise ValueError(f"Windows of {window} s do not fit between one segment and the whole signal")
+    starts = np.arange(0, n_segments - window_segments + 1, step_segments)
+
+    def window_means(values):
+        # Sum of the segments of each window from the cumulative sum along the segments
+        cumulative = np.cumsum(values, axis=-2)
+        cumulative = np.concatenate([np.zeros_like(cumulative[..., :1, :]), cumulative], axis=-2)
+        return (cumulative[..., starts + window_segments, :] - cumulative[..., starts, :]) / window_segments
+
+    mean = window_means(segments["mean"])
+    integrated = window_means(segments["integrated"])
+    total = window_means(segments["total"][..., None])[..., 0]
+
+    names = list(bands)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        timeline_indices = {
+            name: (integrated[..., [names.index(band) for band in numerator]].sum(axis=-1)
+                   / integrated[..., [names.index(band) for band in denominator]].sum(axis=-1))
+            for name, (numerator, denominator) in indices.items()
+        }
+        relative = integrated / total[..., None]
+
+    return {
+        "times": (starts * segment_step + (nperseg + (window_segments - 1) * segment_step) / 2) / sfreq,
+        "absolute": mean if method == "mean" else integrated,
+        "relative": relative,
+        "indices": timeline_indices,
+    }
+
+
+def timeline_frame(timeline, ch_names, bands=BANDS):
+    """Arrange the timeline of one recording as a long-format table.
+
+    Parameters
+    ----------
+    timeline : dict
+        Output of `band_power_timeline` for data of shape (channels, times)
+    ch_names : list of str
+        Channel names
+    bands : dict, optional
+        Bands used to compute the timeline
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per channel and window, with the absolute and relative power
+        of each band and the indexes as columns
+    """
+    n_channels, n_windows, _ = timeline["absolute"].shape
+    frame = pd.DataFrame({
+        "channel": np.repeat(ch_names, n_windows),
+        "time": np.tile(timeline["times"], n_channels),
+    })
+    for idx_band, band in enumerate(bands):
+        frame[f"{band}_absolute"] = timeline["absolute"][..., idx_band].reshape(-1)
+        frame[f"{band}_relative"] = timeline["relative"][..., idx_band].reshape(-1)
+    for name, values in timeline["indices"].items():
+        frame[name] = values.reshape(-1)
+    return frame
@@ -0,0 +1,211 @@
+"""Objects shared by all the recordings of a batch.
+
+Most recordings of a study share the same channels and sampling rate, so the
+montage, the FIR filter and the spherical spline interpolation matrices used
+by PyPREP and MNE are the same for every file. A `BatchContext` computes each
+of them once per (channels, sampling rate) and reuses it for the rest of the
+batch. It can be built in the parent process, precomputed for the expected
+layout and sent to the workers of a process pool.
+
+The montage and the filter are requested from the active context by the
+stages that use them (`BatchContext.montage`, `BatchContext.filter`). MNE and
+PyPREP have no such hook for the interpolation matrices, so the context
+replaces the private function computing them, only for the versions of MNE
+and PyPREP listed in ``SUPPORTED_VERSIONS``.
+"""
+import importlib
+import inspect
+import re
+import warnings
+from contextlib import contextmanager
+
+import mne
+import numpy as np
+
+# Modules whose spherical spline interpolation is memoized, with the name of
+# the function they call
+_INTERPOLATION_MODULES = ["mne.channels.interpolation", "pyprep.ransac"]
+_INTERPOLATION_FUNCTION = "_make_interpolation_matrix"
+_INTERPOLATION_PARAMETERS = ["pos_from", "pos_to", "alpha"]
+
+# Versions of each package (first included, last excluded) whose private
+# interpolation function is known to match `_INTERPOLATION_PARAMETERS`
+SUPPORTED_VERSIONS = {
+    "mne": ((1, 8), (1, 14)),
+    "pyprep": ((0, 4), (0, 10)),
+}
+
+_active = None
+
+
+def active_context():
+    """The `BatchContext` installed in this process, or None."""
+    return _active
+
+
+def _version_tuple(version):
+    """Major and minor numbers of a version string."""
+    return tuple(int(number) for number in re.findall(r"\d+", version)[:2])
+
+
+def _check_interpolation(module):
+    """Reason why the interpolation function of a module is not memoized, or None."""
+    package = module.__name__.split(".")[0]
+    version = importlib.import_module(package).__version__
+    first, last = SUPPORTED_VERSIONS[package]
+    if not first <= _version_tuple(version) < last:
+        return f"{package} {version} is not a supported version"
+    function = getattr(module, _INTERPOLATION_FUNCTION, None)
+    if function is None or list(inspect.signature(function).parameters) != _INTERPOLATION_PARAMETERS:
+        return f"{module.__name__}.{_INTERPOLATION_FUNCTION} is missing or changed"
+    return None
+
+
+class BatchContext:
+    """Cache of the montage, filters and interpolation matrices of a batch.
+
+    The stages get the montage and the FIR filter from the active context with
+    `montage` and `filter`. While the context is installed, the private
+    ``_make_interpolation_matrix`` used by MNE and PyPREP returns the stored
+    matrix when called again with the same electrode positions, so PyPREP and
+    ``raw.interpolate_bads`` only invert them once. With a version of MNE or
+    PyPREP outside ``SUPPORTED_VERSIONS`` the matrices are computed as usual,
+    with a warning.
+
+    Examples
+    --------
+    >>> from phdtools.batch import BatchContext, active_context
+    >>> context = BatchContext()
+    >>> context.precompute(sfreq=256, l_freq=1, h_freq=50)
+    >>> with context.activate():
+    >>>     for raw in raws:
+    >>>         raw.set_montage(active_context().montage("standard_1020"))
+    >>>         h = active_context().filter(256, 1, 50)  # Designed once
+    >>> context.stats
+    {'montage': {'hits': 9, 'misses': 1}, 'filter': {...}, 'interpolation': {...}}
+    """
+
+    def __init__(self):
+        self._montages = {}
+        self._filters = {}
+        self._interpolations = {}
+        self.stats = {name: {"hits": 0, "misses": 0} for name in ("montage", "filter", "interpolation")}
+        self._originals = {}
+
+    def __getstate__(self):
+        # The patched functions stay in the process that installed them
+        return {**self.__dict__, "_originals": {}}
+
+    def _count(self, name, hit):
+        self.stats[name]["hits" if hit else "misses"] += 1
+
+    def montage(self, name="standard_1020"):
+        """Standard montage, built once.
+
+        Parameters
+        ----------
+        name : str, optional
+            Name of the montage, see `mne.channels.make_standard_montage`
+
+        Returns
+        -------
+        mne.channels.DigMontage
+            Copy of the stored montage
+        """
+        hit = name in self._montages
+        self._count("montage", hit)
+        if not hit:
+            self._montages[name] = mne.channels.make_standard_montage(name)
+        return self._montages[name].copy()
+
+    def filter(self, sfreq, l_freq=None, h_freq=None):
+        """FIR band-pass filter with the default design of ``raw.filter``, designed once.
+
+        Parameters
+        ----------
+        sfreq : float
+            Sampling frequency of the filtered data
+        l_freq, h_freq : float, optional
+            Band of the filter
+
+        Returns
+        -------
+        np.ndarray
+            Copy of the coefficients returned by `mne.filter.create_filter`
+        """
+        key = (float(sfreq), l_freq, h_freq)
+        hit = key in self._filters
+        self._count("filter", hit)
+        if not hit:
+            self._filters[key] = mne.filter.create_filter(None, sfreq, l_freq, h_freq, verbose="error")
+        return self._filters[key].copy()
+
+    def _make_interpolation_matrix(self, original, pos_from, pos_to, alpha=1e-5):
+        pos_from, pos_to = np.asarray(pos_from), np.asarray(pos_to)
+        key = (pos_from.shape, pos_from.tobytes(), pos_to.shape, pos_to.tobytes(), alpha)
+        hit = key in self._interpolations
+        self._count("interpolation", hit)
+        if not hit:
+            self._interpolations[key] = original(pos_from, pos_to, alpha=alpha)
+        return self._interpolations[key].copy()
+
+    def precompute(self, sfreq=None, l_freq=None, h_freq=None, montage="standard_1020"):
+        """Build the montage and design the filter before the batch starts.
+
+        Parameters
+        ----------
+        sfreq : float, optional
+            Sampling frequency of the filtered data, no filter is designed if
+            None
+        l_freq, h_freq : float, optional
+            Band of the filter, see `filter`
+        montage : str, optional
+            Name of the standard montage
+        """
+        self.montage(montage)
+        if sfreq is not None and (l_freq is not None or h_freq is not None):
+            self.filter(sfreq, l_freq, h_freq)
+
+    def install(self):
+        """Start memoizing in this process, e.g. in the initializer of a worker."""
+        global _active
+        if _active is self:
+            return
+        for module_name in _INTERPOLATION_MODULES:
+            try:
+                module = importlib.import_module(module_name)
+            except ImportError:
+                continue
+            reason = _check_interpolation(module)
+            if reason is not None:
+                warnings.warn(f"{reason}, the interpolation matrices are not reused")
+                continue
+
+            original = getattr(module, _INTERPOLATION_FUNCTION)
+            self._originals[module] = original
+
+            def patched(*args, _original=original, **kwargs):
+                return self._make_interpolation_matrix(_original, *args, **kwargs)
+
+            setattr(module, _INTERPOLATION_FUNCTION, patched)
+        _active = self
+
+    def uninstall(self):
+        """Restore the original functions."""
+        global _active
+        for module, original in self._originals.items():
+            setattr(module, _INTERPOLATION_FUNCTION, original)
+        self._originals = {}
+        if _active is self:
+            _active = None
+
+    @contextmanager
+    def activate(self):
+        """Memoize inside the context only."""
+        installed = _active is self
+        self.install()
+        try:
+            yield self
+        finally:
+            if not installed:
+                self.uninstall()
@@ -0,0 +1,283 @@
+"""On-disk cache of preprocessing results.
+
+Each entry is addressed by a key built from the hash of the input file and the
+full preprocessing configuration, so a result is reused only when neither of
+them changed. Entries store the cleaned ``_raw.fif`` (or ``_raw.h5``) file,
+its PSD and the fitted ICA if there is one, and the cache keeps its size under
+a limit by evicting the least recently used entries.
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+from phdtools.filetools import file_hash
+
+INDEX_FILE = "index.json"
+
+
+class ResultCache:
+    """Content-addressed cache of preprocessed recordings.
+
+    The index of the cache is a JSON file inside ``cache_dir``. It is only
+    meant to be modified by one process at a time: in a process pool, the
+    parent process does the lookups and stores the worker results. `put`,
+    `invalidate` and `clear` write the index. The file hashes and access
+    times recorded by `make_key` and `get` are only written by the next of
+    them or by `flush`, so looking up a batch does not rewrite it once per
+    file.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory holding the cached files
+    max_size : int, optional
+        Maximum size of the cache in bytes. The least recently used entries
+        are removed once it is exceeded.
+
+    Examples
+    --------
+    >>> from phdtools.cache import ResultCache
+    >>> cache = ResultCache("cache")
+    >>> key = cache.make_key("data/M1_OA_F001.edf", {"sfreq": 128})
+    >>> entry = cache.get(key)  # None if the file was never processed
+    """
+
+    def __init__(self, cache_dir, max_size=50 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+        self._index_path = os.path.join(cache_dir, INDEX_FILE)
+        self._index = self._load_index()
+        self._dirty = False
+
+    def _load_index(self):
+        if not os.path.exists(self._index_path):
+            return {"entries": {}, "hashes": {}}
+        with open(self._index_path) as f:
+            return json.load(f)
+
+    def _save_index(self):
+        # Write to a temporary file first, so an interrupted run never leaves
+        # a truncated index behind
+        tmp_path = self._index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._index, f, indent=1)
+        os.replace(tmp_path, self._index_path)
+        self._dirty = False
+
+    def flush(self):
+        """Write the hashes and access times recorded since the index was last saved."""
+        if self._dirty:
+            self._save_index()
+
+    def _hash_file(self, file_path):
+        """Hash a file, reusing the previous hash if its size and mtime did not change."""
+        file_path = os.path.abspath(file_path)
+        stat = os.stat(file_path)
+        known = self._index["hashes"].get(file_path)
+        if known and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+            return known["sha256"]
+
+        sha256 = file_hash(file_path)
+        self._index["hashes"][file_path] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": sha256,
+        }
+        self._dirty = True
+        return sha256
+
+    def make_key(self, file_path, config):
+        """Build the key of an input file processed with a configuration.
+
+        Parameters
+        ----------
+        file_path : str
+            Path of the input file
+        config : dict
+            JSON serializable description of the processing
+
+        Returns
+        -------
+        str
+            Key of the cache entry
+        """
+        payload = json.dumps(
+            {"input": self._hash_file(file_path), "config": config},
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _paths(self, key, raw_extension=None):
+        if raw_extension is None:
+            raw_extension = self._index["entries"].get(key, {}).get("raw_extension", ".fif")
+        return (
+            os.path.join(self.cache_dir, f"{key}_raw{raw_extension}"),
+            os.path.join(self.cache_dir, f"{key}_psd.npz"),
+            os.path.join(self.cache_dir, f"{key}_ica.fif"),
+        )
+
+    def get(self, key):
+        """Look up an entry and mark it as recently used.
+
+        Parameters
+        ----------
+        key : str
+            Key returned by `make_key`
+
+        Returns
+        -------
+        dict or None
+            Entry with the ``raw_path`` of the cleaned data, its
+            ``frequencies`` and ``psd`` and the ``ica_path`` of the fitted
+            ICA (None if it was not stored), or None on a cache miss.
+        """
+        entry = self._index["entries"].get(key)
+        if entry is None:
+            return None
+
+        raw_path, psd_path, ica_path = self._paths(key)
+        if not (os.path.exists(raw_path) and os.path.exists(psd_path)):
+            # Files removed by hand, forget the entry
+            self._remove(key)
+            self._dirty = True
+            return None
+
+        entry["last_access"] = time.time()
+        self._dirty = True
+        with np.load(psd_path) as psd_file:
+            frequencies, psd = psd_file["frequencies"], psd_file["psd"]
+        return {
+            "raw_path": raw_path,
+            "frequencies": frequencies,
+            "psd": psd,
+            "ica_path": ica_path if os.path.exists(ica_path) else None,
+            **entry,
+        }
+
+    def put(self, key, raw_path, frequencies, psd, source=None, ica_path=None):
+        """Store a result in the cache.
+
+        Parameters
+        ----------
+        key : str
+            Key returned by `make_key`
+        raw_path : str
+            Path of the cleaned ``_raw.fif`` or ``_raw.h5`` file, which is copied into the cache
+        frequencies : np.ndarray
+            Frequencies of the PSD
+        psd : np.ndarray
+            PSD of the cleaned data
+        source : str, optional
+            Path of the input file, kept to inspect and invalidate entries
+        ica_path : str, optional
+            Path of the fitted ``_ica.fif`` file, which is copied into the cache
+        """
+        raw_extension = os.path.splitext(raw_path)[1]
+        cached_raw_path, psd_path, cached_ica_path = self._paths(key, raw_extension)
+        shutil.copyfile(raw_path, cached_raw_path)
+        np.savez(psd_path, frequencies=frequencies, psd=psd)
+        if ica_path is not None:
+            shutil.copyfile(ica_path, cached_ica_path)
+
+        now = time.time()
+        self._index["entries"][key] = {
+            "source": os.path.abspath(source) if source else None,
+            "size": sum(os.path.getsize(path) for path in self._paths(key, raw_extension) if os.path.exists(path)),
+            "created": now,
+            "last_access": now,
+            "raw_extension": raw_extension,
+        }
+        self._evict(keep=key)
+        self._save_index()
+
+    def _remove(self, key):
+        for path in self._paths(key):
+            if os.path.exists(path):
+                os.remove(path)
+        self._index["entries"].pop(key, None)
+
+    def _evict(self, keep=None):
+        """Remove the least recently used entries until the cache fits in `max_size`."""
+        by_age = sorted(self._index["entries"].items(), key=lambda item: item[1]["last_access"])
+        for key, _ in by_age:
+            if self.size <= self.max_size:
+                break
+            if key != keep:
+                print(f"Evicting cache entry {key[:12]}")
+                self._remove(key)
+
+    @property
+    def size(self):
+        """Total size of the cached files in bytes."""
+        return sum(entry["size"] for entry in self._index["entries"].values())
+
+    def entries(self):
+        """List the cache entries, most recently used first.
+
+        Returns
+        -------
+        list of dict
+            Key, source file, size and access times of each entry
+        """
+        entries = [{"key": key, **entry} for key, entry in self._index["entries"].items()]
+        return sorted(entries, key=lambda entry: entry["last_access"], reverse=True)
+
+    def invalidate(self, key=None, source=None):
+        """Remove the entries matching a key or an input file.
+
+        Parameters
+        ----------
+        key : str, optional
+            Key of the entry to remove
+        source : str, optional
+            Remove every entry computed from this input file
+
+        Returns
+        -------
+        int
+            Number of removed entries
+        """
+        source = os.path.abspath(source) if source else None
+        to_remove = [
+            key_
+            for key_, entry in self._index["entries"].items()
+            if key_ == key or (source is not None and entry["source"] == source)
+        ]
+        for key_ in to_remove:
+            self._remove(key_)
+        self._save_index()
+        return len(to_remove)
+
+    def clear(self):
+        """Remove every entry of the cache."""
+        for key in list(self._index["entries"]):
+            self._remove(key)
+        self._index["hashes"] = {}
+        self._save_index()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or invalidate a preprocessing cache.")
+    parser.add_argument("cache_dir", help="Directory of the cache")
+    parser.add_argument("--invalidate", metavar="SOURCE", help="Remove the entries of this input file")
+    parser.add_argument("--clear", action="store_true", help="Remove every entry")
+    args = parser.parse_args()
+
+    cache = ResultCache(args.cache_dir)
+    if args.clear:
+        cache.clear()
+        print("Cache cleared")
+    elif args.invalidate:
+        print(f"Removed {cache.invalidate(source=args.invalidate)} entries")
+    else:
+        for entry in cache.entries():
+            last_access = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["last_access"]))
+            print(f"{entry['key'][:12]}  {entry['size'] / 1024**2:8.1f} MB  {last_access}  {entry['source']}")
+        print(f"{len(cache.entries())} entries, {cache.size / 1024**2:.1f} MB")
@@ -0,0 +1,204 @@
+"""Long-format band-power tables stored as a partitioned Parquet dataset.
+
+Each row holds the power of one band in one channel of one recording, with
+the file, subject, condition, measurement, channel and band as categoricals
+and the power as float32. The rows are written in batches of recordings as
+new Parquet files of a dataset partitioned by measurement and condition
+(``measurement=M1/condition=OA/part-....parquet``), so the results are never
+held in memory all at once and a single condition can be read back without
+parsing the rest.
+
+Writing and reading need the optional dependency pyarrow.
+"""
+import os
+import uuid
+
+import numpy as np
+import pandas as pd
+
+# Columns stored as categoricals, in order
+CATEGORICAL_COLUMNS = ["file", "subject", "condition", "measurement", "channel", "band"]
+
+# Columns of the partition folders
+PARTITION_COLUMNS = ["measurement", "condition"]
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("Parquet output needs pyarrow, install it with `pip install pyarrow`") from e
+    return pyarrow, pyarrow.parquet
+
+
+def long_band_powers(powers, ch_names, bands, **metadata):
+    """Arrange the band powers of one recording in long format.
+
+    Parameters
+    ----------
+    powers : np.ndarray
+        Power with shape (channels, bands)
+    ch_names : list of str
+        Channel names
+    bands : list of str or dict
+        Band names, in the order of the columns of ``powers``
+    **metadata
+        Values repeated on every row, e.g. ``file``, ``subject``,
+        ``condition`` and ``measurement``
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per channel and band with the metadata, ``channel``, ``band``
+        and ``power`` columns
+    """
+    powers = np.asarray(powers, dtype=np.float32)
+    bands = list(bands)
+    n_channels, n_bands = powers.shape
+    frame = pd.DataFrame({
+        **{name: [value] * powers.size for name, value in metadata.items()},
+        "channel": np.repeat(ch_names, n_bands),
+        "band": np.tile(bands, n_channels),
+        "power": powers.reshape(-1),
+    })
+    return as_typed(frame)
+
+
+def as_typed(frame):
+    """Cast the categorical columns to category and the power to float32."""
+    frame = frame.copy()
+    for column in CATEGORICAL_COLUMNS:
+        if column in frame:
+            frame[column] = frame[column].astype(str).astype("category")
+    if "power" in frame:
+        frame["power"] = frame["power"].astype(np.float32)
+    return frame
+
+
+class ParquetWriter:
+    """Write long-format frames to a partitioned Parquet dataset in batches.
+
+    Parameters
+    ----------
+    root_path : str
+        Folder of the dataset
+    partition_cols : list of str, optional
+        Columns whose values become folders
+    batch_size : int, optional
+        Number of frames (e.g. recordings) buffered before they are written
+
+    Examples
+    --------
+    >>> from phdtools.columnar import ParquetWriter, long_band_powers, read_dataset
+    >>> with ParquetWriter("band_powers") as writer:
+    >>>     for file, powers in results:
+    >>>         writer.write(long_band_powers(powers, ch_names, bands, file=file, measurement="M1",
+    >>>                                       condition="OA", subject="F001"))
+    >>> df = read_dataset("band_powers", filters=[("condition", "=", "OA")])
+    """
+
+    def __init__(self, root_path, partition_cols=PARTITION_COLUMNS, batch_size=50):
+        self.root_path = root_path
+        self.partition_cols = list(partition_cols)
+        self.batch_size = batch_size
+        self.n_rows = 0
+        self._frames = []
+        self._pa, self._pq = _import_pyarrow()
+
+    def write(self, frame):
+        """Add the rows of a frame, writing the batch once it is full."""
+        self._frames.append(frame)
+        if len(self._frames) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows as new files of the dataset."""
+        if not self._frames:
+            return
+        frame = as_typed(pd.concat(self._frames, ignore_index=True))
+        self._frames = []
+        missing = [column for column in self.partition_cols if column not in frame]
+        if missing:
+            raise ValueError(f"The rows have no partition columns {missing}")
+
+        table = self._pa.Table.from_pandas(frame, preserve_index=False)
+        # A unique name per batch, so batches never overwrite each other
+        self._pq.write_to_dataset(
+            table, self.root_path, partition_cols=self.partition_cols,
+            basename_template=f"part-{uuid.uuid4().hex}-{{i}}.parquet",
+        )
+        self.n_rows += len(frame)
+
+    def close(self):
+        """Write the last batch."""
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_dataset(root_path, columns=None, filters=None):
+    """Read a long-format Parquet dataset.
+
+    Parameters
+    ----------
+    root_path : str
+        Folder of the dataset
+    columns : list of str, optional
+        Columns to read, all by default
+    filters : list of tuple, optional
+        Row filters, e.g. ``[("measurement", "=", "M1")]``. Filters on the
+        partition columns skip whole folders.
+
+    Returns
+    -------
+    pd.DataFrame
+        Rows of the dataset, with the categorical columns as categories
+    """
+    _import_pyarrow()
+    frame = pd.read_parquet(root_path, columns=columns, filters=filters)
+    return as_typed(frame)
+
+
+def remove_files(root_path, files):
+    """Remove the rows of some recordings from a dataset.
+
+    Only the Parquet files containing rows of those recordings are rewritten.
+
+    Parameters
+    ----------
+    root_path : str
+        Folder of the dataset
+    files : iterable of str
+        Values of the ``file`` column to remove
+
+    Returns
+    -------
+    int
+        Number of removed rows
+    """
+    files = set(files)
+    if not files or not os.path.isdir(root_path):
+        return 0
+    pa, pq = _import_pyarrow()
+
+    removed = 0
+    for folder, _, names in os.walk(root_path):
+        for name in names:
+            if not name.endswith(".parquet"):
+                continue
+            path = os.path.join(folder, name)
+            frame = pq.read_table(path).to_pandas()
+            keep = ~frame["file"].astype(str).isin(files)
+            if keep.all():
+                continue
+            removed += int((~keep).sum())
+            if keep.any():
+                pq.write_table(pa.Table.from_pandas(as_typed(frame[keep]), preserve_index=False), path)
+            else:
+                os.remove(path)
+    return removed
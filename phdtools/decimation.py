@@ -0,0 +1,87 @@
+"""Band-pass filtering and decimation in a single pass.
+
+Resampling a recording and then band-pass filtering it transforms the whole
+signal twice. When the new rate divides the original one, a linear-phase FIR
+band-pass filter designed at the original rate also acts as anti-aliasing
+filter, and only every ``factor``-th output sample is needed. The filter is
+applied by overlap-add in blocks, and the spectrum of each filtered block is
+folded into the spectrum of its decimated version, so the inverse FFT is
+``factor`` times shorter and the full-rate signal is never built.
+"""
+import numpy as np
+import scipy.fft
+
+
+def _fold_indices(n_fft, factor):
+    """Bins of the full spectrum summed into each bin of the decimated spectrum."""
+    n_out = n_fft // factor
+    bins = np.arange(n_out // 2 + 1)[None, :] + n_out * np.arange(factor)[:, None]
+    mirrored = bins > n_fft // 2
+    # Bins above the Nyquist frequency are the conjugates of the ones below
+    return np.where(mirrored, n_fft - bins, bins), mirrored
+
+
+def fir_decimate(data, h, factor, block_size=None, workers=None):
+    """Filter with a zero-phase FIR filter and keep one sample out of ``factor``.
+
+    The result is ``scipy.signal.fftconvolve`` of the data (padded by odd
+    reflection at both ends) with ``h``, shifted by the delay of the filter
+    and decimated, i.e. the same as filtering like ``raw.filter`` and then
+    taking ``[..., ::factor]``, edges included.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Signals with the times in the last axis
+    h : np.ndarray
+        Coefficients of a linear-phase FIR filter of odd length, designed at
+        the rate of the data, e.g. with `mne.filter.create_filter`. It must
+        remove the frequencies above the new Nyquist frequency.
+    factor : int
+        Decimation factor
+    block_size : int, optional
+        Input samples filtered at a time, which bounds the memory used.
+        Defaults to about 8 filter lengths.
+    workers : int, optional
+        Threads of the FFTs, see `scipy.fft.rfft`
+
+    Returns
+    -------
+    np.ndarray
+        Decimated signals, with ``ceil(n_times / factor)`` samples
+    """
+    data = np.asarray(data, dtype=float)
+    h = np.asarray(h, dtype=float)
+    n_taps = len(h)
+    if n_taps % 2 == 0:
+        raise ValueError("The FIR filter must have an odd length (zero phase)")
+    delay = (n_taps - 1) // 2
+    n_times = data.shape[-1]
+    n_out = -(-n_times // factor)
+
+    # Edges reflected around the first and last samples (odd reflection), as the default "reflect_limited"
+    # padding of raw.filter. The start is padded a few more samples so the delay of the filter plus the
+    # padding is a whole number of output samples.
+    extra = (-2 * delay) % factor
+    pad_width = [(0, 0)] * (data.ndim - 1) + [(delay + extra, delay)]
+    padded = np.pad(data, pad_width, mode="reflect", reflect_type="odd")
+
+    # Blocks starting at multiples of the factor keep the decimation phase
+    block_size = block_size or 8 * n_taps
+    block_size = max(factor, block_size - block_size % factor)
+    n_fft = scipy.fft.next_fast_len(block_size + n_taps - 1, real=True)
+    n_fft += (-n_fft) % (2 * factor)
+    spectrum_h = scipy.fft.rfft(h, n_fft)
+    fold, mirrored = _fold_indices(n_fft, factor)
+    n_block_out = n_fft // factor
+
+    # Output sample k of the decimated zero-phase signal is sample k + first of the decimated convolution
+    first = (2 * delay + extra) // factor
+    last = first + n_out
+    out = np.zeros(data.shape[:-1] + (last + n_block_out,))
+    for start in range(0, min(padded.shape[-1], last * factor), block_size):
+        spectrum = scipy.fft.rfft(padded[..., start:start + block_size], n_fft, workers=workers) * spectrum_h
+        folded = np.where(mirrored, np.conj(spectrum[..., fold]), spectrum[..., fold]).sum(axis=-2) / factor
+        out_start = start // factor
+        out[..., out_start:out_start + n_block_out] += scipy.fft.irfft(folded, n_block_out, workers=workers)
+    return out[..., first:last]
@@ -0,0 +1,271 @@
+"""Run a function over many recordings.
+
+`apply_to_raw` loads each file as an MNE Raw object, calls a user function on
+it and collects the results by path. The work can run in this process, in a
+pool of threads or in a pool of processes, with a bounded number of files in
+memory at the same time, retries and per-file timeouts.
+
+The timeout of a file is counted from the moment a worker starts it: each
+worker reports when (and in which process) it starts a file. A worker
+process stuck in a file is killed and the pool replaced. A thread cannot be
+killed, so a new pool takes over while the stuck file keeps its place in
+the in-flight limit until its function returns.
+"""
+import multiprocessing
+import os
+import queue as queue_module
+import signal
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import mne
+
+BACKENDS = ("serial", "thread", "process")
+
+# Seconds between checks for the files started by the workers, while the start of a file is unknown
+POLL_INTERVAL = 0.05
+
+# Queue where the worker processes report the files they start, set by `_init_worker`
+_started = None
+
+
+def read_raw(path):
+    """Default reader: load any file supported by `mne.io.read_raw` into memory."""
+    return mne.io.read_raw(path, preload=True, verbose="error")
+
+
+def _init_worker(started):
+    global _started
+    _started = started
+
+
+def _run(function, path, reader, task=None, started=None):
+    """Load a file and apply the function to it, reporting when it starts."""
+    started = started if started is not None else _started
+    if started is not None:
+        started.put((task, os.getpid(), time.time()))
+    return function(reader(path))
+
+
+def iter_apply_to_raw(paths, function, backend="serial", n_jobs=1, max_in_flight=None, ordered=True,
+                      retries=0, timeout=None, reader=read_raw):
+    """Apply a function to the Raw object of each file, yielding the results.
+
+    Parameters
+    ----------
+    paths : iterable of str
+        Paths of the files
+    function : callable
+        Function taking a Raw object and returning any result. With the
+        process backend it must be defined at module level, so it can be
+        sent to the workers.
+    backend : {"serial", "thread", "process"}, optional
+        Where the function runs
+    n_jobs : int, optional
+        Number of workers of the thread and process backends
+    max_in_flight : int, optional
+        Maximum number of files submitted and not yet collected, which
+        bounds the number of recordings in memory. Defaults to ``n_jobs``.
+        Timed-out files still running in a thread are counted too.
+    ordered : bool, optional
+        Yield the results in the order of the paths. Otherwise they are
+        yielded as soon as they are completed.
+    retries : int, optional
+        Number of times a failing file is submitted again
+    timeout : float, optional
+        Seconds allowed for each file, counted from the moment a worker
+        starts it. A file that takes longer is reported as failed. With the
+        process backend its worker is killed, and the other files running
+        in the pool are started again in a new pool (without counting as a
+        retry). With the thread backend the thread cannot be interrupted and
+        keeps running until the function returns, while a new pool runs the
+        next files; the file still counts in ``max_in_flight``, so files
+        that never return stop the run once they fill it. Not available
+        with the serial backend.
+    reader : callable, optional
+        Function loading a path into a Raw object
+
+    Yields
+    ------
+    tuple
+        ``(path, result, error)``, where ``error`` is the last exception raised
+        for the file (or a `TimeoutError`) and ``result`` is None if it failed
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend '{backend}', use one of {BACKENDS}")
+    paths = list(paths)
+
+    if backend == "serial":
+        if timeout is not None:
+            raise ValueError("Timeouts need the thread or process backend")
+        for path in paths:
+            for attempt in range(retries + 1):
+                try:
+                    result, error = _run(function, path, reader), None
+                    break
+                except Exception as e:
+                    result, error = None, e
+            yield path, result, error
+        return
+
+    max_in_flight = max_in_flight or n_jobs
+    started = None
+    if timeout is not None:
+        started = multiprocessing.Queue() if backend == "process" else queue_module.Queue()
+
+    def new_pool():
+        if backend == "thread":
+            return ThreadPoolExecutor(max_workers=n_jobs)
+        if started is None:
+            return ProcessPoolExecutor(max_workers=n_jobs)
+        return ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(started,))
+
+    pool = new_pool()
+    old_pools = []
+    queue = list(enumerate(paths))[::-1]  # Next file at the end
+    attempts = {}
+    in_flight = {}  # future -> (position, path, task)
+    task_starts = {}  # task -> (pid, start time) reported by the worker
+    stuck = set()  # Timed-out futures of threads still running
+    done = {}  # position -> (path, result, error), waiting for its turn when ordered
+    next_position = 0
+    next_task = 0
+
+    try:
+        while queue or in_flight:
+            while queue and len(in_flight) + len(stuck) < max_in_flight:
+                position, path = queue.pop()
+                attempts[position] = attempts.get(position, 0) + 1
+                # The thread workers get the queue as an argument, the processes from their initializer
+                future = pool.submit(_run, function, path, reader, next_task,
+                                     started if backend == "thread" else None)
+                in_flight[future] = (position, path, next_task)
+                next_task += 1
+
+            wait_time = None
+            if started is not None:
+                while True:
+                    try:
+                        task, pid, start = started.get_nowait()
+                    except queue_module.Empty:
+                        break
+                    task_starts[task] = (pid, start)
+                deadlines = [task_starts[task][1] + timeout for _, _, task in in_flight.values()
+                             if task in task_starts]
+                wait_time = max(0.0, min(deadlines) - time.time()) if deadlines else None
+                if len(deadlines) < len(in_flight):
+                    wait_time = min(wait_time, POLL_INTERVAL) if wait_time is not None else POLL_INTERVAL
+            finished, _ = wait(set(in_flight) | stuck, timeout=wait_time, return_when=FIRST_COMPLETED)
+            stuck -= finished
+
+            now = time.time()
+            timed_out, stuck_pids = [], []
+            for future in list(in_flight):
+                position, path, task = in_flight[future]
+                if future in finished:
+                    error = future.exception()
+                    result = None if error else future.result()
+                elif task in task_starts and now >= task_starts[task][1] + timeout:
+                    timed_out.append(future)
+                    stuck_pids.append(task_starts[task][0])
+                    result, error = None, TimeoutError(f"{path} took more than {timeout} s")
+                else:
+                    continue
+                del in_flight[future]
+                task_starts.pop(task, None)
+
+                if error is not None and attempts[position] <= retries:
+                    print(f"Retrying {path} after error: {error}")
+                    queue.append((position, path))
+                    continue
+                done[position] = (path, result, error)
+
+            if timed_out and backend == "process":
+                # Kill the stuck workers. The pool is broken then, so the other files submitted to it are
+                # started again in a new one.
+                requeued = [(position, path) for position, path, _ in in_flight.values()]
+                for position, _ in requeued:
+                    attempts[position] -= 1
+                queue.extend(sorted(requeued, reverse=True))
+                for pid in stuck_pids + [pid for pid, _ in task_starts.values()]:
+                    try:
+                        os.kill(pid, signal.SIGTERM)
+                    except OSError:
+                        pass  # Already finished
+                pool.shutdown(wait=False, cancel_futures=True)
+                in_flight.clear()
+                task_starts.clear()
+                pool = new_pool()
+            elif timed_out:
+                # The threads cannot be stopped, a new pool runs the next files and the ones waiting behind
+                # the stuck threads
+                stuck.update(future for future in timed_out if not future.cancel())
+                requeued = []
+                for future, (position, path, task) in list(in_flight.items()):
+                    if future.cancel():
+                        del in_flight[future]
+                        attempts[position] -= 1
+                        requeued.append((position, path))
+                queue.extend(sorted(requeued, reverse=True))
+                old_pools.append(pool)
+                pool.shutdown(wait=False)
+                pool = new_pool()
+
+            if not ordered:
+                for position in list(done):
+                    yield done.pop(position)
+                continue
+            while next_position in done:
+                yield done.pop(next_position)
+                next_position += 1
+    finally:
+        # Do not wait for workers stuck in timed-out files
+        for old_pool in old_pools:
+            old_pool.shutdown(wait=False, cancel_futures=True)
+        pool.shutdown(wait=not (in_flight or stuck), cancel_futures=True)
+        if backend == "process" and started is not None:
+            started.close()
+
+def apply_to_raw(paths, function, backend="serial", n_jobs=1, max_in_flight=None, ordered=True,
+                 retries=0, timeout=None, reader=read_raw, raise_errors=False):
+    """Apply a function to the Raw object of each file.
+
+    See `iter_apply_to_raw` for the description of the parameters.
+
+    Parameters
+    ----------
+    raise_errors : bool, optional
+        Raise the error of the first failing file, instead of reporting the
+        failing files and leaving them out of the results
+
+    Returns
+    -------
+    dict
+        Result of each successful file, keyed by path
+
+    Examples
+    --------
+    >>> from phdtools.executor import apply_to_raw
+    >>> def ica_sources(raw):
+    >>>     ica = mne.preprocessing.ICA(n_components=0.99).fit(raw)
+    >>>     return ica.get_sources(raw).get_data()
+    >>> results = apply_to_raw(paths_to_edf, ica_sources, backend="process", n_jobs=8)
+    >>> results["path_edf_01"]  # ICA sources of that file
+    """
+    results = {}
+    failures = {}
+    for path, result, error in iter_apply_to_raw(
+        paths, function, backend=backend, n_jobs=n_jobs, max_in_flight=max_in_flight, ordered=ordered,
+        retries=retries, timeout=timeout, reader=reader,
+    ):
+        if error is None:
+            results[path] = result
+            continue
+        if raise_errors:
+            raise error
+        print(f"Error processing file {path}: {error!r}")
+        failures[path] = error
+
+    if failures:
+        print(f"{len(failures)} file(s) failed out of {len(results) + len(failures)}.")
+    return results
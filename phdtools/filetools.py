@@ -1,5 +1,10 @@
+import hashlib
+import json
 import shutil
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from phdtools.parser import parse_file_name
 
 def rename(file):
     """Rename files to remove extra info in name after XX or XY.
@@ -16,18 +21,17 @@ def rename(file):
     str
         New file name
     """
-    to_delete =  "_".join(file.split("_")[5:])
-    extension = file.split(".")[-1]
-    new_file_name = file.replace(to_delete, "")[:-1].upper()
+    parsed = parse_file_name(file)
+    stem = file[:-len(parsed.extension) - 1] if parsed.extension else file
+    new_file_name = "_".join(stem.split("_")[:5]).upper()
 
-    if "intervalmarker".upper() in file.upper():
+    if parsed.interval_marker:
         print(f"Interval in {file}")
         new_file_name = new_file_name + "_intervalmarket"
 
-    if file.endswith(".md.edf"):
-        extension = "md" + "." + extension
-
-    return new_file_name + "." + extension
+    if parsed.extension is None:
+        return new_file_name
+    return new_file_name + "." + parsed.extension
 
 
 def copy(old_file_path, new_file_path):
@@ -43,6 +47,30 @@ def copy(old_file_path, new_file_path):
     shutil.copyfile(old_file_path, new_file_path)
 
 
+def file_hash(file_path, chunk_size=1024 * 1024):
+    """Compute the SHA-256 hash of a file content.
+
+    The file is read in chunks, so memory use does not depend on its size.
+
+    Parameters
+    ----------
+    file_path : str
+        Path of the file
+    chunk_size : int, optional
+        Bytes read at a time
+
+    Returns
+    -------
+    str
+        Hexadecimal digest of the file content
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 def rename_and_copy(each_file, old_directory, new_directory=None):
     """Rename and copy file according to rename.
 
@@ -83,3 +111,250 @@ def rename_and_copy(each_file, old_directory, new_directory=None):
     print(f"Copied '{old_file_path}' to '{new_file_path}'.")
     copy(old_file_path, new_file_path)
 
+
+
+def plan_renames(files, old_directory, new_directory=None, overwrite=False, resumed=()):
+    """Plan the renaming of several files before copying any of them.
+
+    Directories, and files that already have their new name in the new
+    directory, are skipped. Two files that would get the same new name are
+    reported together, instead of the second copy overwriting the first one,
+    and so are new paths taken by files that already exist.
+
+    Parameters
+    ----------
+    files : list of str
+        File names
+    old_directory : str
+        Directory of the files
+    new_directory : str, optional
+        Directory of the renamed files, the old directory by default
+    overwrite : bool, optional
+        Allow new paths that already exist
+    resumed : iterable of str, optional
+        New paths written by a previous run of the same plan, which may
+        exist
+
+    Returns
+    -------
+    list of tuple
+        Old and new path of each file
+
+    Raises
+    ------
+    ValueError
+        If several files are renamed to the same name, or a new path is
+        already taken and ``overwrite`` is False
+    """
+    if new_directory is None:
+        new_directory = old_directory
+
+    # One scan of the directory instead of an isdir call per file
+    with os.scandir(old_directory) as entries:
+        directories = {entry.name for entry in entries if entry.is_dir()}
+
+    plan = []
+    sources = {}
+    for each_file in files:
+        if each_file in directories:
+            continue
+        old_file_path = os.path.join(old_directory, each_file)
+        new_file_path = os.path.join(new_directory, rename(each_file))
+        if os.path.abspath(new_file_path) == os.path.abspath(old_file_path):
+            continue
+        sources.setdefault(new_file_path, []).append(each_file)
+        plan.append((old_file_path, new_file_path))
+
+    collisions = {new: old for new, old in sources.items() if len(old) > 1}
+    if collisions:
+        details = "\n".join(f"  {new}: {', '.join(old)}" for new, old in collisions.items())
+        raise ValueError(f"{len(collisions)} renamed files would collide:\n{details}")
+
+    if not overwrite:
+        resumed = set(resumed)
+        taken = [new for _, new in plan if new not in resumed and os.path.lexists(new)]
+        if taken:
+            details = "\n".join(f"  {new}" for new in taken)
+            raise ValueError(f"{len(taken)} new paths already exist (use overwrite=True to replace them):\n{details}")
+    return plan
+
+
+def _reflink(old_fd, new_fd):
+    """Share the blocks of two files (copy-on-write) on filesystems that support it."""
+    import fcntl
+
+    FICLONE = 0x40049409
+    fcntl.ioctl(new_fd, FICLONE, old_fd)
+
+
+def fast_copy(old_file_path, new_file_path, link=False):
+    """Copy a file with the cheapest method available.
+
+    On the same filesystem, the file is cloned (reflink) or, if ``link`` is
+    True, hard linked. Otherwise the data is copied inside the kernel with
+    ``os.copy_file_range`` or ``os.sendfile``, falling back to
+    ``shutil.copyfile``. The copy is written next to the destination and
+    renamed at the end, so an interrupted copy never leaves a partial file.
+
+    Parameters
+    ----------
+    old_file_path : str
+        Old path string
+    new_file_path : str
+        New path string
+    link : bool, optional
+        Allow hard links. A hard link is the same file as the original, so
+        modifying one modifies the other: only use it for copies that are
+        never edited in place.
+
+    Returns
+    -------
+    str
+        Method used: "reflink", "hardlink", "copy_file_range", "sendfile" or "copyfile"
+    """
+    tmp_path = new_file_path + ".part"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    same_device = os.stat(old_file_path).st_dev == os.stat(os.path.dirname(new_file_path) or ".").st_dev
+
+    method = None
+    if same_device:
+        try:
+            with open(old_file_path, "rb") as old_file, open(tmp_path, "wb") as new_file:
+                _reflink(old_file.fileno(), new_file.fileno())
+            method = "reflink"
+        except (ImportError, OSError):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            if link:
+                try:
+                    os.link(old_file_path, tmp_path)
+                    method = "hardlink"
+                except OSError:
+                    pass
+
+    if method is None:
+        size = os.path.getsize(old_file_path)
+        for method, copy_range in (
+            ("copy_file_range", getattr(os, "copy_file_range", None)),
+            ("sendfile", getattr(os, "sendfile", None)),
+        ):
+            if copy_range is None:
+                continue
+            try:
+                with open(old_file_path, "rb") as old_file, open(tmp_path, "wb") as new_file:
+                    copied = 0
+                    while copied < size:
+                        if method == "sendfile":
+                            n = copy_range(new_file.fileno(), old_file.fileno(), copied, size - copied)
+                        else:
+                            n = copy_range(old_file.fileno(), new_file.fileno(), size - copied)
+                        if n == 0:
+                            break
+                        copied += n
+                if copied == size:
+                    break
+            except OSError:
+                pass
+        else:
+            method = "copyfile"
+            shutil.copyfile(old_file_path, tmp_path)
+
+    os.replace(tmp_path, new_file_path)
+    return method
+
+
+def bulk_rename_and_copy(files, old_directory, new_directory=None, n_jobs=8, dry_run=False,
+                         journal_path=None, link=False, overwrite=False):
+    """Rename and copy many files concurrently.
+
+    All the new names are planned first (see `plan_renames`), then the files
+    are copied on a pool of threads with `fast_copy`. Each finished copy is
+    written to a journal, so an interrupted run can be started again and
+    only copies the missing files.
+
+    Parameters
+    ----------
+    files : list of str
+        File names
+    old_directory : str
+        Directory of the files
+    new_directory : str, optional
+        Directory of the renamed files, the old directory by default
+    n_jobs : int, optional
+        Number of copies running at the same time
+    dry_run : bool, optional
+        Only print the plan, without copying anything
+    journal_path : str, optional
+        Journal of the finished copies, ``.rename_journal.jsonl`` in the new
+        directory by default
+    link : bool, optional
+        Allow hard links when both directories are on the same filesystem,
+        see `fast_copy`
+    overwrite : bool, optional
+        Replace the files that already have one of the new paths, see
+        `plan_renames`
+
+    Returns
+    -------
+    list of tuple
+        Old path, new path and copy method of each file. The method is
+        "journal" for files copied in a previous run and None in a dry run.
+
+    Examples
+    --------
+    >>> import os
+    >>> from phdtools.filetools import bulk_rename_and_copy
+    >>> directory = "data"
+    >>> files = os.listdir(directory)
+    >>> bulk_rename_and_copy(files, directory, new_directory=os.path.join(directory, "renamed"))
+    """
+    if new_directory is None:
+        new_directory = old_directory
+    journal_path = journal_path or os.path.join(new_directory, ".rename_journal.jsonl")
+
+    # Copies of a previous run, their new paths are not collisions. Only the complete ones are skipped.
+    finished = set()
+    journaled = set()
+    if os.path.exists(journal_path):
+        with open(journal_path) as journal:
+            for line in journal:
+                entry = json.loads(line)
+                journaled.add(entry["new"])
+                if os.path.exists(entry["new"]) and os.path.getsize(entry["new"]) == entry["size"]:
+                    finished.add((entry["old"], entry["new"]))
+    plan = plan_renames(files, old_directory, new_directory, overwrite=overwrite, resumed=journaled)
+
+    if dry_run:
+        for old_file_path, new_file_path in plan:
+            print(f"Would copy '{old_file_path}' to '{new_file_path}'.")
+        return [(old, new, None) for old, new in plan]
+
+    os.makedirs(new_directory, exist_ok=True)
+
+    copied = [(old, new, "journal") for old, new in plan if (old, new) in finished]
+    pending = [(old, new) for old, new in plan if (old, new) not in finished]
+    print(f"{len(plan)} files to copy, {len(copied)} already copied.")
+
+    with open(journal_path, "a") as journal, ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        futures = {executor.submit(fast_copy, old, new, link): (old, new) for old, new in pending}
+        for future in as_completed(futures):
+            old_file_path, new_file_path = futures[future]
+            try:
+                method = future.result()
+            except OSError as e:
+                # Left out of the journal, so the next run tries again
+                print(f"Error copying '{old_file_path}': {e}")
+                continue
+
+            journal.write(json.dumps({
+                "old": old_file_path,
+                "new": new_file_path,
+                "size": os.path.getsize(new_file_path),
+                "method": method,
+            }) + "\n")
+            journal.flush()
+            copied.append((old_file_path, new_file_path, method))
+            print(f"Copied '{old_file_path}' to '{new_file_path}' ({method}).")
+
+    return copied
@@ -0,0 +1,300 @@
+"""Metadata index of a tree of EDF recordings.
+
+The tree is scanned once and only the fixed-size EDF header of each file is
+read (sampling rate, channels, duration), never its samples. The metadata,
+together with the measurement, centre, condition and subject derived from the
+path, is stored in an SQLite table. Later scans only re-read the files whose
+size or modification time changed, and the table can be queried directly.
+"""
+import hashlib
+import os
+import re
+import sqlite3
+from contextlib import closing
+
+import pandas as pd
+
+from phdtools.parser import HEADSETS, find_centre, parse_file_name
+
+# Channels of each headset, used when the name does not tell the headset
+HEADSET_CHANNELS = {
+    "EPOC": {'AF3', 'F7', 'F3', 'FC5', 'T7', 'P7', 'O1', 'O2', 'P8', 'T8', 'FC6', 'F4', 'F8', 'AF4'},
+    "INSIGHT": {'AF3', 'AF4', 'T7', 'T8', 'Pz'},
+}
+
+INDEX_FILE = "edf_index.sqlite"
+
+COLUMNS = {
+    "path": "TEXT PRIMARY KEY",
+    "file": "TEXT",
+    "measurement": "TEXT",
+    "centre": "TEXT",
+    "centre_id": "INTEGER",
+    "condition": "TEXT",
+    "subject": "TEXT",
+    "headset": "TEXT",
+    "sampling_rate": "REAL",
+    "n_channels": "INTEGER",
+    "channels": "TEXT",
+    "duration": "REAL",
+    "start": "TEXT",
+    "size": "INTEGER",
+    "mtime_ns": "INTEGER",
+}
+
+# Columns with an SQLite index, for fast filtering
+INDEXED_COLUMNS = ["measurement", "centre_id", "condition", "subject", "headset", "sampling_rate"]
+
+
+def read_edf_header(file_path):
+    """Read the header of an EDF file without reading its samples.
+
+    Parameters
+    ----------
+    file_path : str
+        Path of the EDF file
+
+    Returns
+    -------
+    dict
+        Recording identification, start, duration in seconds, channel names
+        and sampling rate of each channel. Annotation channels are left out.
+    """
+    with open(file_path, "rb") as f:
+        header = f.read(256)
+        n_signals = int(header[252:256])
+        signals = f.read(256 * n_signals)
+
+    def field(offset, width):
+        # Fields of the signals are stored one after the other for all signals
+        start = offset * n_signals
+        return [
+            signals[start + i * width:start + (i + 1) * width].decode("latin-1").strip()
+            for i in range(n_signals)
+        ]
+
+    labels = field(0, 16)
+    samples_per_record = [int(value) for value in field(16 + 80 + 8 * 5 + 80, 8)]
+    n_records = int(header[236:244])
+    record_duration = float(header[244:252])
+
+    channels, sampling_rates = [], []
+    for label, n_samples in zip(labels, samples_per_record):
+        if label == "EDF Annotations":
+            continue
+        channels.append(label)
+        sampling_rates.append(n_samples / record_duration if record_duration else float("nan"))
+
+    return {
+        "recording": header[88:168].decode("latin-1").strip(),
+        "start": f"{header[168:176].decode('latin-1')} {header[176:184].decode('latin-1')}",
+        "duration": n_records * record_duration,
+        "channels": channels,
+        "sampling_rates": sampling_rates,
+    }
+
+
+def _headset(parsed, recording, channels):
+    if parsed.headset is not None:
+        return parsed.headset
+    recording = recording.upper()
+    for headset in HEADSETS:
+        if headset in recording:
+            return headset
+    for headset, headset_channels in HEADSET_CHANNELS.items():
+        if headset_channels <= set(channels):
+            return headset
+    return None
+
+
+def describe_file(file_path, root_path):
+    """Build the index row of a file.
+
+    Parameters
+    ----------
+    file_path : str
+        Path of the EDF file
+    root_path : str
+        Root of the data tree, whose first directory is the measurement (M1, M2...)
+
+    Returns
+    -------
+    dict
+        Values of the index columns
+    """
+    header = read_edf_header(file_path)
+    stat = os.stat(file_path)
+    file_name = os.path.basename(file_path)
+    directories = os.path.relpath(os.path.dirname(file_path), root_path).split(os.sep)
+
+    measurement = directories[0] if re.fullmatch(r"M\d+", directories[0]) else None
+    centre, centre_id = find_centre(reversed(directories))
+    parsed = parse_file_name(file_name)
+    rates = header["sampling_rates"]
+
+    return {
+        "path": file_path,
+        "file": file_name,
+        "measurement": measurement,
+        "centre": centre,
+        "centre_id": centre_id,
+        "condition": parsed.condition,
+        "subject": parsed.subject,
+        "headset": _headset(parsed, header["recording"], header["channels"]),
+        # The most common rate, auxiliary channels may be sampled differently
+        "sampling_rate": max(set(rates), key=rates.count) if rates else None,
+        "n_channels": len(header["channels"]),
+        "channels": ",".join(header["channels"]),
+        "duration": header["duration"],
+        "start": header["start"],
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+
+def _iter_files(root_path, extensions):
+    """Walk the tree with os.scandir, yielding the matching entries with their stat."""
+    stack = [root_path]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.lower().endswith(extensions) and not entry.name.startswith("."):
+                    yield entry
+
+
+def default_index_path(root_path):
+    """SQLite file of the index of a data tree, in the cache folder of the user.
+
+    The data tree may be read-only (e.g. an external drive), so the index is
+    not written inside it. Each tree gets its own file, named after a hash of
+    its absolute path, in ``$XDG_CACHE_HOME/phdtools`` (``~/.cache/phdtools``
+    by default).
+    """
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    cache_dir = os.path.join(cache_dir, "phdtools")
+    os.makedirs(cache_dir, exist_ok=True)
+    digest = hashlib.sha256(os.path.abspath(root_path).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{os.path.splitext(INDEX_FILE)[0]}_{digest}.sqlite")
+
+
+def _connect(index_path):
+    connection = sqlite3.connect(index_path)
+    columns = ", ".join(f"{name} {kind}" for name, kind in COLUMNS.items())
+    connection.execute(f"CREATE TABLE IF NOT EXISTS files ({columns})")
+    for column in INDEXED_COLUMNS:
+        connection.execute(f"CREATE INDEX IF NOT EXISTS idx_{column} ON files ({column})")
+    return connection
+
+
+def scan(root_path, index_path=None, extensions=(".edf",)):
+    """Scan the data tree and update the index.
+
+    Only the files that are new, or whose size or modification time changed,
+    have their header read. Files that disappeared are removed from the index.
+
+    Parameters
+    ----------
+    root_path : str
+        Root of the data tree
+    index_path : str, optional
+        SQLite file of the index, see `default_index_path` for the default
+    extensions : tuple of str, optional
+        Extensions of the indexed files
+
+    Returns
+    -------
+    dict
+        Number of ``added``, ``updated`` and ``removed`` files
+    """
+    index_path = index_path or default_index_path(root_path)
+    counts = {"added": 0, "updated": 0, "removed": 0}
+
+    with closing(_connect(index_path)) as connection, connection:
+        known = {
+            path: (size, mtime_ns)
+            for path, size, mtime_ns in connection.execute("SELECT path, size, mtime_ns FROM files")
+        }
+
+        rows, seen = [], set()
+        for entry in _iter_files(root_path, tuple(extensions)):
+            seen.add(entry.path)
+            stat = entry.stat()
+            previous = known.get(entry.path)
+            if previous == (stat.st_size, stat.st_mtime_ns):
+                continue
+            try:
+                rows.append(describe_file(entry.path, root_path))
+            except (OSError, ValueError) as e:
+                print(f"Error reading header of {entry.path}: {e}")
+                continue
+            counts["updated" if previous else "added"] += 1
+
+        if rows:
+            placeholders = ", ".join(f":{name}" for name in COLUMNS)
+            connection.executemany(f"INSERT OR REPLACE INTO files VALUES ({placeholders})", rows)
+
+        removed = [(path,) for path in known if path not in seen]
+        connection.executemany("DELETE FROM files WHERE path = ?", removed)
+        counts["removed"] = len(removed)
+
+    print(f"Index updated: {counts['added']} added, {counts['updated']} updated, {counts['removed']} removed.")
+    return counts
+
+
+def query_index(index_path, where=None, params=()):
+    """Select files from the index.
+
+    Parameters
+    ----------
+    index_path : str
+        SQLite file of the index
+    where : str, optional
+        SQL condition, e.g. ``"sampling_rate = 128 AND centre_id = ?"``
+    params : tuple, optional
+        Values of the ``?`` placeholders in the condition
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per selected file
+    """
+    sql = "SELECT * FROM files" + (f" WHERE {where}" if where else "") + " ORDER BY path"
+    with closing(_connect(index_path)) as connection:
+        return pd.read_sql_query(sql, connection, params=params)
+
+
+def build_dataframe_with_paths(root_path, index_path=None, rescan=True, where=None, params=()):
+    """Index the data tree and return it as a DataFrame.
+
+    Parameters
+    ----------
+    root_path : str
+        Root of the data tree
+    index_path : str, optional
+        SQLite file of the index, see `default_index_path` for the default
+    rescan : bool, optional
+        Update the index before reading it. Set it to False to only read
+        the index of a previous scan.
+    where : str, optional
+        SQL condition selecting the files, see `query_index`
+    params : tuple, optional
+        Values of the ``?`` placeholders in the condition
+
+    Returns
+    -------
+    pd.DataFrame
+        Path, measurement, centre, condition, subject, headset, sampling rate,
+        channels and duration of each file
+
+    Examples
+    --------
+    >>> from phdtools.index import build_dataframe_with_paths
+    >>> df = build_dataframe_with_paths("/Volumes/MENTALFIT/data")
+    >>> df_ = df[(df["sampling_rate"] == 128) & (df["centre_id"] == 1)]
+    """
+    index_path = index_path or default_index_path(root_path)
+    if rescan:
+        scan(root_path, index_path)
+    return query_index(index_path, where, params)
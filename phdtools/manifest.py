@@ -0,0 +1,192 @@
+"""Manifest of processed input files for incremental batch runs.
+
+The manifest stores the size, modification time and hash of every input file
+together with the outputs produced from it, so a later run only processes
+the files that were added or modified and can drop the outputs of the files
+that changed or disappeared.
+"""
+import json
+import os
+import time
+
+from phdtools.filetools import file_hash
+
+
+class Manifest:
+    """JSON manifest of the inputs processed by a batch.
+
+    Parameters
+    ----------
+    path : str
+        Path of the JSON file. It is created on the first `save`.
+
+    Examples
+    --------
+    >>> from phdtools.manifest import Manifest
+    >>> manifest = Manifest("filtered_data/manifest.json")
+    >>> to_process = manifest.changed(edf_files)
+    >>> for file_path in to_process:
+    >>>     output_path = process(file_path)
+    >>>     manifest.record(file_path, [output_path])
+    >>> manifest.save()
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        # Hashes computed by is_changed, reused by record: path -> (size, mtime_ns, sha256)
+        self._hashes = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def save(self):
+        """Write the manifest to disk."""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def is_changed(self, input_path):
+        """Check if a file is new or was modified since it was recorded.
+
+        Size and modification time are compared first. The content hash is
+        only computed when they differ, so a file that was just touched or
+        copied again is not considered modified.
+
+        Parameters
+        ----------
+        input_path : str
+            Path of the input file
+
+        Returns
+        -------
+        bool
+            True if the file has to be processed
+        """
+        entry = self.entries.get(os.path.abspath(input_path))
+        if entry is None:
+            return True
+
+        stat = os.stat(input_path)
+        if stat.st_size == entry["size"] and stat.st_mtime_ns == entry["mtime_ns"]:
+            return False
+        if stat.st_size != entry["size"] or self._hash(input_path, stat) != entry["sha256"]:
+            return True
+
+        # Same content with a new modification time
+        entry["mtime_ns"] = stat.st_mtime_ns
+        return False
+
+    def _hash(self, input_path, stat):
+        """Hash of a file, computed once while its size and modification time do not change."""
+        key = os.path.abspath(input_path)
+        known = self._hashes.get(key)
+        if known is None or known[:2] != (stat.st_size, stat.st_mtime_ns):
+            known = self._hashes[key] = (stat.st_size, stat.st_mtime_ns, file_hash(input_path))
+        return known[2]
+
+    def changed(self, input_paths):
+        """Select the files that are new or were modified.
+
+        Parameters
+        ----------
+        input_paths : list of str
+            Paths of the input files found in this run
+
+        Returns
+        -------
+        list of str
+            Paths to process, in the same order
+        """
+        return [input_path for input_path in input_paths if self.is_changed(input_path)]
+
+    def removed(self, input_paths):
+        """Select the recorded files that were deleted.
+
+        A recorded file that is only left out of this run (e.g. by another
+        keyword filter) still exists, and is not considered removed.
+
+        Parameters
+        ----------
+        input_paths : list of str
+            Paths of the input files found in this run
+
+        Returns
+        -------
+        list of str
+            Recorded paths whose input file does not exist anymore
+        """
+        current = {os.path.abspath(input_path) for input_path in input_paths}
+        return [
+            input_path for input_path in self.entries
+            if input_path not in current and not os.path.exists(input_path)
+        ]
+
+    def outputs(self, input_path):
+        """Outputs recorded for an input file."""
+        entry = self.entries.get(os.path.abspath(input_path))
+        return entry["outputs"] if entry else []
+
+    def record(self, input_path, outputs):
+        """Record an input file as processed.
+
+        Parameters
+        ----------
+        input_path : str
+            Path of the input file
+        outputs : list of str
+            Outputs produced from the file
+        """
+        stat = os.stat(input_path)
+        self.entries[os.path.abspath(input_path)] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": self._hash(input_path, stat),
+            "outputs": list(outputs),
+            "processed": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+
+    def forget(self, input_path):
+        """Remove an input file from the manifest.
+
+        Parameters
+        ----------
+        input_path : str
+            Path of the input file
+
+        Returns
+        -------
+        list of str
+            Outputs that were recorded for the file
+        """
+        entry = self.entries.pop(os.path.abspath(input_path), None)
+        return entry["outputs"] if entry else []
+
+    def remove_stale_outputs(self, input_paths):
+        """Delete the outputs of the files removed or modified since the last run.
+
+        Parameters
+        ----------
+        input_paths : list of str
+            Paths of the input files found in this run
+
+        Returns
+        -------
+        list of str
+            Deleted output files
+        """
+        stale = self.removed(input_paths) + [
+            input_path for input_path in input_paths
+            if os.path.abspath(input_path) in self.entries and self.is_changed(input_path)
+        ]
+        deleted = []
+        for input_path in stale:
+            for output in self.forget(input_path):
+                if os.path.exists(output):
+                    os.remove(output)
+                    deleted.append(output)
+        return deleted
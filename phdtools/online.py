@@ -0,0 +1,262 @@
+"""Band power of a live EEG stream.
+
+The samples arrive in small chunks from a source (a headset, or a recording
+replayed at real-time speed). Each chunk goes through causal IIR filters
+whose state is carried between chunks, is optionally decimated, and is
+written to a fixed-size ring buffer. Every new Welch segment is transformed
+once and its periodogram replaces the oldest one of the window, so each
+update costs one FFT per new segment instead of a Welch PSD of the whole
+window. The time spent on every update is recorded.
+"""
+import time
+
+import numpy as np
+from scipy.signal import butter, get_window, iirnotch, sosfilt, sosfilt_zi, tf2sos
+
+from phdtools.bandpower import BANDS, band_means
+
+
+class RingBuffer:
+    """Fixed-size buffer keeping the last samples of every channel.
+
+    Parameters
+    ----------
+    n_channels : int
+        Number of channels
+    size : int
+        Number of samples kept
+    """
+
+    def __init__(self, n_channels, size):
+        self.data = np.zeros((n_channels, size))
+        self.size = size
+        self.n_written = 0
+
+    def write(self, chunk):
+        """Append samples with shape (channels, times), overwriting the oldest ones."""
+        chunk = np.asarray(chunk)[:, -self.size:]
+        n = chunk.shape[1]
+        start = self.n_written % self.size
+        first = min(n, self.size - start)
+        self.data[:, start:start + first] = chunk[:, :first]
+        self.data[:, :n - first] = chunk[:, first:]
+        self.n_written += n
+
+    def latest(self, n):
+        """Last ``n`` samples in chronological order, shape (channels, n)."""
+        if n > min(self.size, self.n_written):
+            raise ValueError(f"Only {min(self.size, self.n_written)} samples available, {n} requested")
+        stop = self.n_written % self.size
+        start = stop - n
+        if start >= 0:
+            return self.data[:, start:stop].copy()
+        return np.concatenate([self.data[:, start:], self.data[:, :stop]], axis=1)
+
+
+class CausalFilter:
+    """Band-pass (and notch) IIR filter applied chunk by chunk.
+
+    The filter state is carried from one chunk to the next, so filtering the
+    chunks gives the same result as filtering the whole signal at once. The
+    initial state is the steady state for the first sample, which avoids the
+    transient of a step at the start of the stream.
+
+    Parameters
+    ----------
+    sfreq : float
+        Sampling frequency
+    n_channels : int
+        Number of channels
+    l_freq, h_freq : float, optional
+        Edges of the band-pass filter
+    order : int, optional
+        Order of the Butterworth filter
+    notch : float, optional
+        Line frequency removed with a notch filter, e.g. 50
+    """
+
+    def __init__(self, sfreq, n_channels, l_freq=1.0, h_freq=50.0, order=4, notch=None):
+        self.sos = butter(order, [l_freq, h_freq], btype="bandpass", fs=sfreq, output="sos")
+        if notch is not None and notch < sfreq / 2:
+            self.sos = np.vstack([self.sos, tf2sos(*iirnotch(notch, Q=30, fs=sfreq))])
+        self._zi_unit = sosfilt_zi(self.sos)  # sections x 2
+        self.n_channels = n_channels
+        self.zi = None
+
+    def process(self, chunk):
+        """Filter the next samples, shape (channels, times)."""
+        chunk = np.asarray(chunk, dtype=float)
+        if self.zi is None:
+            self.zi = self._zi_unit[:, None, :] * chunk[:, 0][None, :, None]
+        filtered, self.zi = sosfilt(self.sos, chunk, axis=-1, zi=self.zi)
+        return filtered
+
+
+class LatencyStats:
+    """Durations of the updates, in seconds."""
+
+    def __init__(self):
+        self.values = []
+
+    def add(self, seconds):
+        self.values.append(seconds)
+
+    def summary(self):
+        """Number of updates, mean, median, 95th and 99th percentiles and maximum in milliseconds."""
+        if not self.values:
+            return {"n_updates": 0}
+        values = np.asarray(self.values) * 1000
+        return {
+            "n_updates": len(values),
+            "mean_ms": float(values.mean()),
+            "p50_ms": float(np.percentile(values, 50)),
+            "p95_ms": float(np.percentile(values, 95)),
+            "p99_ms": float(np.percentile(values, 99)),
+            "max_ms": float(values.max()),
+        }
+
+
+class OnlineBandPower:
+    """Band power of a stream, updated at a fixed interval.
+
+    Parameters
+    ----------
+    sfreq : float
+        Sampling frequency of the stream
+    ch_names : list of str
+        Channel names of the chunks
+    bands : dict, optional
+        Band name to [fmin, fmax], both edges included
+    window : float, optional
+        Seconds of signal in each Welch estimate
+    nperseg : int, optional
+        Length of the Welch segments, after decimation
+    update_interval : float, optional
+        Seconds of signal between updates
+    l_freq, h_freq, order, notch
+        Causal filter, see `CausalFilter`. No filter if ``l_freq`` is None.
+    decimation : int, optional
+        Keep one sample out of ``decimation`` after filtering, e.g. 2 to
+        go from 256 to 128 Hz as the offline preprocessing. ``h_freq`` must
+        be below the new Nyquist frequency.
+
+    Examples
+    --------
+    >>> from phdtools.online import OnlineBandPower
+    >>> online = OnlineBandPower(sfreq=256, ch_names=CH_NAMES, decimation=2, update_interval=0.25)
+    >>> for chunk, timestamp in source:
+    >>>     for update in online.push(chunk, timestamp):
+    >>>         print(update["time"], update["band_power"][:, 2])  # Alpha power of every channel
+    >>> online.latency.summary()
+    """
+
+    def __init__(self, sfreq, ch_names, bands=BANDS, window=4.0, nperseg=256, update_interval=0.25, l_freq=1.0,
+                 h_freq=50.0, order=4, notch=None, decimation=1):
+        if decimation > 1 and h_freq is not None and h_freq >= sfreq / decimation / 2:
+            raise ValueError(f"h_freq must be below {sfreq / decimation / 2} Hz to decimate by {decimation}")
+        self.ch_names = list(ch_names)
+        self.bands = bands
+        self.decimation = decimation
+        self.sfreq = sfreq / decimation
+        self.nperseg = nperseg
+        self.step = nperseg // 2
+        self.n_segments = max(1, (int(round(window * self.sfreq)) - nperseg) // self.step + 1)
+        self.update_samples = max(1, int(round(update_interval * self.sfreq)))
+
+        n_channels = len(self.ch_names)
+        self.filter = None
+        if l_freq is not None:
+            self.filter = CausalFilter(sfreq, n_channels, l_freq, h_freq, order, notch)
+        self.buffer = RingBuffer(n_channels, nperseg + self.n_segments * self.step)
+        self.latency = LatencyStats()
+
+        self._window = get_window("hann", nperseg)
+        scale = 1.0 / (self.sfreq * (self._window ** 2).sum())
+        self.freqs = np.fft.rfftfreq(nperseg, 1 / self.sfreq)
+        self._scale = np.full(len(self.freqs), 2 * scale)
+        self._scale[0] /= 2
+        if nperseg % 2 == 0:
+            self._scale[-1] /= 2
+
+        # Periodograms of the segments of the window, the oldest replaced first
+        self._periodograms = np.zeros((self.n_segments, n_channels, len(self.freqs)))
+        self._sum = np.zeros((n_channels, len(self.freqs)))
+        self._n_done = 0
+        self._phase = 0
+        self._next_segment = nperseg
+        self._next_update = nperseg
+
+    def _segment_periodogram(self, segment):
+        segment = (segment - segment.mean(axis=-1, keepdims=True)) * self._window
+        spectrum = np.fft.rfft(segment, axis=-1)
+        return (spectrum.real ** 2 + spectrum.imag ** 2) * self._scale
+
+    def _process_buffer(self):
+        """Add the segments completed in the buffer and make the updates that are due."""
+        updates = []
+        n_written = self.buffer.n_written
+        while self._next_segment <= n_written or self._next_update <= n_written:
+            if self._next_segment <= min(self._next_update, n_written):
+                # The new segment replaces the oldest one in the running sum
+                back = n_written - self._next_segment
+                segment = self.buffer.latest(self.nperseg + back)[:, :self.nperseg]
+                periodogram = self._segment_periodogram(segment)
+                slot = self._n_done % self.n_segments
+                self._sum += periodogram - self._periodograms[slot]
+                self._periodograms[slot] = periodogram
+                if slot == self.n_segments - 1:
+                    self._sum = self._periodograms.sum(axis=0)  # Drop the rounding errors of the running sum
+                self._n_done += 1
+                self._next_segment += self.step
+                continue
+            psd = self._sum / min(self._n_done, self.n_segments)
+            updates.append({
+                "time": self._next_update / self.sfreq,
+                "segments": min(self._n_done, self.n_segments),
+                "psd": psd,
+                "band_power": band_means(psd, self.freqs, self.bands),
+            })
+            self._next_update += self.update_samples
+        return updates
+
+    def push(self, chunk, timestamp=None):
+        """Add the next samples of the stream.
+
+        Parameters
+        ----------
+        chunk : np.ndarray
+            Samples with shape (channels, times), in the order of ``ch_names``
+        timestamp : float, optional
+            Time (`time.perf_counter`) when the chunk arrived. The update
+            latencies are counted from it, otherwise from the call.
+
+        Returns
+        -------
+        list of dict
+            Updates due with these samples, each with the ``time`` of the
+            stream in seconds, the number of Welch ``segments`` averaged, the
+            ``psd`` (channels, freqs), ``band_power`` (channels, bands) and
+            ``latency`` in seconds
+        """
+        start = time.perf_counter() if timestamp is None else timestamp
+        chunk = np.asarray(chunk, dtype=float)
+        if self.filter is not None:
+            chunk = self.filter.process(chunk)
+        if self.decimation > 1:
+            # Continue the decimation where the previous chunk stopped
+            first = (-self._phase) % self.decimation
+            self._phase = (self._phase + chunk.shape[1]) % self.decimation
+            chunk = chunk[:, first::self.decimation]
+
+        updates = []
+        # Pieces of at most one segment step, so the ring buffer still holds every new segment
+        for piece_start in range(0, chunk.shape[1], self.step):
+            self.buffer.write(chunk[:, piece_start:piece_start + self.step])
+            updates.extend(self._process_buffer())
+
+        if updates:
+            latency = time.perf_counter() - start
+            for update in updates:
+                update["latency"] = latency
+                self.latency.add(latency)
+        return updates
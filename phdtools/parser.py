@@ -0,0 +1,179 @@
+"""Parse the names of the recordings.
+
+The file names follow one grammar, either the raw names written during the
+recordings (``OA_ABC123 ... EPOC.edf``) or the renamed ones
+(``M1_OA_F100_C1_EPOC.edf``): an optional measurement, the condition, the
+subject code, an optional centre code, and anywhere in the name the headset
+and an interval marker. The grammar is compiled once into a single regular
+expression, so a name is parsed in one pass, and the same expression parses a
+whole pandas Series of names at once.
+
+Centre folders are matched against the centre names through a precomputed
+table of every substring of those names.
+"""
+import re
+from typing import NamedTuple, Optional
+
+import pandas as pd
+from unidecode import unidecode
+
+# Conditions at the beginning of the raw file names
+CONDITIONS = ["OA", "OC", "STROOP", "PASAT", "PVTB", "MSIT", "PVSAT", "PVT-B", "PVT"]
+
+# Centre codes (see doc/codification.md), names without accents
+CENTRES = {
+    "QUERCUS": 1,
+    "PUEBLA": 2,  # "ENRIQUE DIEZ CANDO"
+    "EMERITA AUGUSTA": 3,
+    "SAGRADO CORAZON MIAJADAS": 4,
+    "SALESIANOS BADAJOZ": 5,
+    "SANTA EULALIA MERIDA": 6,
+    "NUESTRA SENORA DOLORES GUARENA": 7,
+    "ALBALAT": 8,
+}
+
+# Headsets, in the order they are looked for in the file name
+HEADSETS = ["EPOCX", "EPOC+", "EPOC", "INSIGHT", "FLEX", "MN8"]
+
+
+def _alternatives(words):
+    # The longest words first, so PVT-B is not read as PVT
+    return "|".join(re.escape(word) for word in sorted(words, key=len, reverse=True))
+
+
+FILE_NAME_PATTERN = re.compile(
+    rf"""
+    ^(?=(?:.*?(?P<headset>{_alternatives(HEADSETS)}))?)  # Headset anywhere in the name
+    (?=(?P<interval_marker>.*INTERVALMARKER)?)            # Interval marker anywhere in the name
+    \s*
+    (?:(?P<measurement>M\d+)[_ ])?
+    (?:(?P<condition>{_alternatives(CONDITIONS)})[_ ]?(?P<subject>[A-Z0-9]+)?)?
+    (?:_(?P<centre>C\d+)(?![A-Z0-9]))?
+    .*?
+    (?:\.(?P<extension>(?:MD\.)?[A-Z0-9]+))?$
+    """,
+    re.IGNORECASE | re.VERBOSE,
+)
+
+# Groups of the pattern written in capital letters in the record
+_UPPER_FIELDS = ["measurement", "condition", "subject", "centre", "headset"]
+
+
+class FileName(NamedTuple):
+    """Fields of a recording file name, None when missing."""
+
+    measurement: Optional[str]
+    condition: Optional[str]
+    subject: Optional[str]
+    centre: Optional[str]
+    headset: Optional[str]
+    interval_marker: bool
+    extension: Optional[str]
+
+
+def parse_file_name(file_name):
+    """Parse a file name in one pass.
+
+    Parameters
+    ----------
+    file_name : str
+        File name, without directories
+
+    Returns
+    -------
+    FileName
+        Measurement (``M1``), condition (``OA``), subject (``F100``), centre
+        code (``C1``) and headset in capital letters, whether the name has an
+        interval marker, and the extension as written (``edf`` or ``md.edf``)
+
+    Examples
+    --------
+    >>> from phdtools.parser import parse_file_name
+    >>> parse_file_name("M1_OA_F100_C1_EPOC.edf")
+    FileName(measurement='M1', condition='OA', subject='F100', centre='C1', headset='EPOC', interval_marker=False, extension='edf')
+    """
+    groups = FILE_NAME_PATTERN.match(file_name).groupdict()
+    for field in _UPPER_FIELDS:
+        if groups[field] is not None:
+            groups[field] = groups[field].upper()
+    groups["interval_marker"] = groups["interval_marker"] is not None
+    return FileName(**groups)
+
+
+def parse_file_names(file_names):
+    """Parse a Series of file names at once.
+
+    Parameters
+    ----------
+    file_names : pd.Series or list of str
+        File names, without directories
+
+    Returns
+    -------
+    pd.DataFrame
+        One column per field of `FileName`, with the index of the names.
+        Missing fields are NaN.
+    """
+    file_names = pd.Series(file_names, dtype=object)
+    fields = file_names.str.extract(FILE_NAME_PATTERN)
+    for field in _UPPER_FIELDS:
+        fields[field] = fields[field].str.upper()
+    fields["interval_marker"] = fields["interval_marker"].notna()
+    return fields[list(FileName._fields)]
+
+
+def _centre_substrings(centres):
+    """Centres containing each substring of their names."""
+    table = {}
+    for centre in centres:
+        for start in range(len(centre)):
+            for stop in range(start + 1, len(centre) + 1):
+                table.setdefault(centre[start:stop], set()).add(centre)
+    return {substring: tuple(sorted(matches)) for substring, matches in table.items()}
+
+
+_CENTRE_SUBSTRINGS = _centre_substrings(CENTRES)
+
+
+def normalize_centre(name):
+    """Folder name in capital letters without accents nor measurement prefix."""
+    name = unidecode(name).upper().strip()
+    if re.match(r"M\d", name):
+        name = name[2:].strip()
+    return name
+
+
+def centre_matches(name):
+    """Centres whose name contains the (normalized) folder name.
+
+    Parameters
+    ----------
+    name : str
+        Folder name, e.g. ``"M1 EMÉRITA AUGUSTA"`` or ``"Augusta"``
+
+    Returns
+    -------
+    tuple of str
+        Names of the matching centres, keys of `CENTRES`
+    """
+    return _CENTRE_SUBSTRINGS.get(normalize_centre(name), ())
+
+
+def find_centre(directories):
+    """Find the centre among some directory names.
+
+    Parameters
+    ----------
+    directories : iterable of str
+        Directory names, the first one matching a single centre is used
+
+    Returns
+    -------
+    tuple
+        Centre name and code, or None and None
+    """
+    for directory in directories:
+        matches = centre_matches(directory)
+        if len(matches) == 1:
+            return matches[0], CENTRES[matches[0]]
+    return None, None
@@ -0,0 +1,257 @@
+"""Preprocessing pipelines built from discrete stages.
+
+A `Pipeline` is an ordered list of `Stage` objects, each one a function that
+takes a Raw object and returns the processed Raw object, with its parameters.
+Stages can be removed, reordered or given other parameters per study.
+
+Given a key of the input (e.g. the hash of the file), every stage gets a key
+chaining the key of the previous stage with its own name and parameters. The
+output of a stage can be saved as a checkpoint under that key and is reused
+as long as neither the input nor any stage up to it changed, so changing the
+ICA settings does not rerun resampling, filtering and PyPREP.
+"""
+import hashlib
+import json
+import os
+import pickle
+
+import mne
+
+from phdtools.profiling import StageProfiler
+
+
+class Stage:
+    """One step of a pipeline.
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage, unique in its pipeline
+    function : callable
+        Function called as ``function(raw, **params)`` and returning the
+        processed Raw object, or a tuple of the Raw object and a dict of
+        other outputs (e.g. a fitted ICA). It may modify ``raw`` in place. To
+        run in a process pool it must be defined at module level.
+    checkpoint : bool, optional
+        Save the output of the stage, so later runs can resume from it
+    **params
+        JSON serializable parameters of the function, part of the stage key
+    """
+
+    def __init__(self, name, function, checkpoint=False, **params):
+        self.name = name
+        self.function = function
+        self.checkpoint = checkpoint
+        self.params = params
+
+    def __call__(self, raw):
+        return self.function(raw, **self.params)
+
+    def __repr__(self):
+        params = ", ".join(f"{name}={value!r}" for name, value in self.params.items())
+        return f"Stage({self.name!r}, {self.function.__name__}({params}))"
+
+    def config(self):
+        """Description of the stage used in its key."""
+        return {"name": self.name, "function": self.function.__name__, "params": self.params}
+
+    def with_params(self, **params):
+        """Copy of the stage with some parameters changed."""
+        return Stage(self.name, self.function, self.checkpoint, **{**self.params, **params})
+
+
+class Pipeline:
+    """Ordered stages applied to a Raw object.
+
+    Parameters
+    ----------
+    stages : list of Stage
+        Stages, in the order they are applied
+
+    Examples
+    --------
+    >>> from phdtools.pipeline import Pipeline, Stage
+    >>> pipeline = Pipeline([
+    >>>     Stage("pick", lambda raw, channels: raw.pick(channels), channels=["O1", "O2"]),
+    >>>     Stage("filter", lambda raw, l_freq, h_freq: raw.filter(l_freq, h_freq), checkpoint=True,
+    >>>           l_freq=1, h_freq=50),
+    >>> ])
+    >>> pipeline = pipeline.with_params("filter", h_freq=40).without("pick")
+    >>> raw = pipeline.run(raw, input_key=file_hash(path), checkpoint_dir="checkpoints")
+    """
+
+    def __init__(self, stages):
+        names = [stage.name for stage in stages]
+        duplicated = {name for name in names if names.count(name) > 1}
+        if duplicated:
+            raise ValueError(f"Duplicated stage names: {sorted(duplicated)}")
+        self.stages = list(stages)
+
+    def __repr__(self):
+        return "Pipeline([\n" + "".join(f"    {stage!r},\n" for stage in self.stages) + "])"
+
+    def __iter__(self):
+        return iter(self.stages)
+
+    def __len__(self):
+        return len(self.stages)
+
+    def __getitem__(self, name):
+        for stage in self.stages:
+            if stage.name == name:
+                return stage
+        raise KeyError(f"No stage named '{name}', stages are {self.names}")
+
+    @property
+    def names(self):
+        """Names of the stages, in order."""
+        return [stage.name for stage in self.stages]
+
+    def _check_names(self, names):
+        unknown = set(names) - set(self.names)
+        if unknown:
+            raise KeyError(f"No stages named {sorted(unknown)}, stages are {self.names}")
+
+    def without(self, *names):
+        """Copy of the pipeline with some stages removed, e.g. ``without("pyprep")``."""
+        self._check_names(names)
+        return Pipeline([stage for stage in self.stages if stage.name not in names])
+
+    def with_params(self, name, **params):
+        """Copy of the pipeline with some parameters of a stage changed."""
+        self._check_names([name])
+        return Pipeline([
+            stage.with_params(**params) if stage.name == name else stage for stage in self.stages
+        ])
+
+    def with_checkpoints(self, *names):
+        """Copy of the pipeline saving checkpoints after exactly the given stages."""
+        self._check_names(names)
+        return Pipeline([
+            Stage(stage.name, stage.function, stage.name in names, **stage.params) for stage in self.stages
+        ])
+
+    def reorder(self, names):
+        """Copy of the pipeline with the stages in the given order.
+
+        Parameters
+        ----------
+        names : list of str
+            Names of all the stages, in the new order
+        """
+        if sorted(names) != sorted(self.names):
+            raise ValueError(f"The new order must contain each of {self.names} once")
+        return Pipeline([self[name] for name in names])
+
+    def config(self):
+        """JSON serializable description of the stages, e.g. for a cache key."""
+        return [stage.config() for stage in self.stages]
+
+    def stage_keys(self, input_key):
+        """Chained key of each stage.
+
+        The key of a stage depends on the input and on the name and parameters
+        of that stage and of all the stages before it.
+
+        Parameters
+        ----------
+        input_key : str
+            Key of the input, e.g. the hash of the file
+
+        Returns
+        -------
+        list of str
+            Key of each stage, in order
+        """
+        keys = []
+        key = input_key
+        for stage in self.stages:
+            payload = json.dumps({"previous": key, "stage": stage.config()}, sort_keys=True, default=str)
+            key = hashlib.sha256(payload.encode()).hexdigest()
+            keys.append(key)
+        return keys
+
+    @staticmethod
+    def checkpoint_path(checkpoint_dir, stage, key):
+        """Path of the checkpoint of a stage."""
+        return os.path.join(checkpoint_dir, f"{stage.name}-{key[:32]}_raw.fif")
+
+    @staticmethod
+    def _outputs_path(path):
+        return path.replace("_raw.fif", "_outputs.pkl")
+
+    def run(self, raw, input_key=None, checkpoint_dir=None, profiler=None, outputs=None):
+        """Apply the stages to a Raw object.
+
+        With an input key and a checkpoint folder, the output of the stages
+        marked as checkpoints is saved, and the run resumes after the last
+        stage whose checkpoint already exists for the same key.
+
+        Parameters
+        ----------
+        raw : mne.io.Raw or callable
+            Raw object, or function without arguments returning it. The
+            function is only called if no checkpoint can be reused.
+        input_key : str, optional
+            Key of the input, e.g. the hash of the file. Checkpoints are only
+            used when it is given.
+        checkpoint_dir : str, optional
+            Folder of the checkpoints. Checkpoints are only used when it is given.
+        profiler : StageProfiler, optional
+            Profiler recording every stage run
+        outputs : dict, optional
+            Filled with the other outputs of the stages, by stage name. The
+            outputs of checkpoint stages are saved with the checkpoint, so
+            they are also available when the run resumes after them.
+
+        Returns
+        -------
+        mne.io.Raw
+            Output of the last stage
+        """
+        profiler = profiler or StageProfiler()
+        outputs = {} if outputs is None else outputs
+        use_checkpoints = input_key is not None and checkpoint_dir is not None
+        keys = self.stage_keys(input_key) if use_checkpoints else []
+
+        # Resume after the last stage already saved
+        start = 0
+        for position in reversed(range(len(keys))):
+            stage = self.stages[position]
+            path = self.checkpoint_path(checkpoint_dir, stage, keys[position])
+            if stage.checkpoint and os.path.exists(path):
+                with profiler.stage(f"checkpoint:{stage.name}") as record:
+                    raw = mne.io.read_raw_fif(path, preload=True)
+                    record["n_samples"] = raw.n_times * len(raw.ch_names)
+                print(f"Resuming after stage '{stage.name}' from checkpoint: {path}")
+                start = position + 1
+                break
+        for position in range(start):
+            path = self._outputs_path(self.checkpoint_path(checkpoint_dir, self.stages[position], keys[position]))
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    outputs[self.stages[position].name] = pickle.load(f)
+        if start == 0 and callable(raw):
+            raw = raw()
+
+        for position in range(start, len(self.stages)):
+            stage = self.stages[position]
+            with profiler.stage(stage.name) as record:
+                raw = stage(raw)
+                if isinstance(raw, tuple):
+                    raw, outputs[stage.name] = raw
+                record["n_samples"] = raw.n_times * len(raw.ch_names)
+
+            if use_checkpoints and stage.checkpoint:
+                os.makedirs(checkpoint_dir, exist_ok=True)
+                path = self.checkpoint_path(checkpoint_dir, stage, keys[position])
+                # Save under a temporary name first, so an interrupted run
+                # never leaves a truncated checkpoint behind
+                tmp_path = path.replace("_raw.fif", ".part_raw.fif")
+                raw.save(tmp_path, fmt="double", overwrite=True, verbose="error")
+                if stage.name in outputs:
+                    with open(self._outputs_path(tmp_path), "wb") as f:
+                        pickle.dump(outputs[stage.name], f)
+                    os.replace(self._outputs_path(tmp_path), self._outputs_path(path))
+                os.replace(tmp_path, path)
+        return raw
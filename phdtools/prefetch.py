@@ -0,0 +1,180 @@
+"""Read the next files in the background while the current one is processed.
+
+Reading a recording from an external or network drive and preprocessing it
+use different resources, so a background thread reads (or copies) the next
+files while the consumer processes the current one. The read-ahead is
+bounded both in number of files and in bytes, so prefetching never holds
+more than a few recordings in memory or in the scratch folder.
+"""
+import os
+import queue
+import shutil
+import tempfile
+import threading
+
+_DONE = object()
+
+
+class Prefetcher:
+    """Iterate over files, reading the next ones in a background thread.
+
+    Each file is either read into memory with ``reader``, or copied to a
+    local scratch folder (e.g. on an SSD) when ``scratch_dir`` is given, in
+    which case the iteration yields the path of the local copy. A file counts
+    against the limits from the moment it starts to be read until the
+    consumer asks for the next file, and its local copy is removed then.
+
+    Parameters
+    ----------
+    paths : iterable of str
+        Paths of the files, in the order they are yielded
+    reader : callable, optional
+        Function loading a path, e.g. into an MNE Raw object. It runs in the
+        background thread. Unused with a scratch folder.
+    depth : int, optional
+        Number of files read ahead of the one being processed
+    max_bytes : int, optional
+        Maximum size of the files read ahead and being processed. A file is
+        always read when nothing else is held, even if it is larger.
+    scratch_dir : str, optional
+        Folder where the files are copied instead of being read
+    size_of : callable, optional
+        Estimate in bytes of the memory or disk used by a file, its size by
+        default. EDF samples take 4 times their file size once loaded as
+        float64.
+
+    Examples
+    --------
+    >>> from phdtools.prefetch import Prefetcher
+    >>> with Prefetcher(paths, reader=read_raw, depth=2, max_bytes=4 * 1024**3) as prefetcher:
+    >>>     for path, raw, error in prefetcher:
+    >>>         if error is None:
+    >>>             preprocess(raw)  # The next two files are being read meanwhile
+    """
+
+    def __init__(self, paths, reader=None, depth=2, max_bytes=None, scratch_dir=None, size_of=os.path.getsize):
+        if reader is None and scratch_dir is None:
+            raise ValueError("Give a reader or a scratch folder")
+        if depth < 1:
+            raise ValueError("The prefetch depth must be at least 1")
+        self.paths = list(paths)
+        self.reader = reader
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.scratch_dir = scratch_dir
+        self.size_of = size_of
+        self.stats = {"files": 0, "bytes": 0, "waits": 0}
+
+        self._ready = queue.Queue()
+        self._condition = threading.Condition()
+        self._held_files = 0
+        self._held_bytes = 0
+        self._stopped = False
+        self._thread = None
+        self._staging = None
+
+    def _can_start(self, size):
+        if self._held_files > self.depth:  # The file being processed and `depth` files ahead
+            return False
+        return self.max_bytes is None or self._held_files == 0 or self._held_bytes + size <= self.max_bytes
+
+    def _stage(self, path):
+        if self.scratch_dir is None:
+            return self.reader(path)
+        # A unique name, the same file name may come from several folders
+        fd, local_path = tempfile.mkstemp(suffix="_" + os.path.basename(path), dir=self._staging)
+        os.close(fd)
+        try:
+            shutil.copyfile(path, local_path)
+        except BaseException:
+            os.remove(local_path)
+            raise
+        return local_path
+
+    def _run(self):
+        for path in self.paths:
+            try:
+                size = self.size_of(path)
+            except OSError:
+                size = 0
+            with self._condition:
+                if not self._can_start(size):
+                    self.stats["waits"] += 1
+                self._condition.wait_for(lambda: self._stopped or self._can_start(size))
+                if self._stopped:
+                    break
+                self._held_files += 1
+                self._held_bytes += size
+
+            try:
+                value, error = self._stage(path), None
+            except Exception as e:
+                value, error = None, e
+            self._ready.put((path, value, error, size))
+        self._ready.put(_DONE)
+
+    def _release(self, value, size):
+        if self.scratch_dir is not None and value is not None:
+            try:
+                os.remove(value)
+            except OSError:
+                pass
+        with self._condition:
+            self._held_files -= 1
+            self._held_bytes -= size
+            self._condition.notify_all()
+
+    def __iter__(self):
+        """Yield ``(path, value, error)`` for each file.
+
+        ``value`` is the result of the reader, or the path of the local copy,
+        and None if the file could not be read, ``error`` the exception raised
+        then.
+        """
+        if self._thread is not None:
+            raise RuntimeError("A Prefetcher can only be iterated once")
+        if self.scratch_dir is not None:
+            os.makedirs(self.scratch_dir, exist_ok=True)
+            self._staging = tempfile.mkdtemp(prefix="prefetch-", dir=self.scratch_dir)
+        self._thread = threading.Thread(target=self._run, name="prefetch", daemon=True)
+        self._thread.start()
+
+        try:
+            while True:
+                item = self._ready.get()
+                if item is _DONE:
+                    break
+                path, value, error, size = item
+                self.stats["files"] += 1
+                self.stats["bytes"] += size
+                try:
+                    yield path, value, error
+                finally:
+                    self._release(value, size)
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop reading ahead and remove the local copies."""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            # Drain the queue so the thread is not blocked, then wait for the file being read
+            while self._thread.is_alive():
+                try:
+                    item = self._ready.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if item is not _DONE:
+                    self._release(item[1], item[3])
+            self._thread.join()
+        if self._staging is not None:
+            shutil.rmtree(self._staging, ignore_errors=True)
+            self._staging = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
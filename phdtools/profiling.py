@@ -0,0 +1,172 @@
+"""Per-stage timing and memory instrumentation.
+
+A `StageProfiler` records, for each stage run inside its ``stage`` context,
+the wall and CPU time, the resident memory of the process and optionally the
+peak memory allocated during the stage. The records can be attached to a
+result, written as JSON lines and aggregated over a whole cohort.
+"""
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import pandas as pd
+
+
+def current_rss_mb():
+    """Resident memory of this process in MB, or None if it cannot be read."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024**2
+    except (OSError, ValueError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss / 1024**2
+
+
+def peak_rss_mb():
+    """Highest resident memory reached by this process so far, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+class StageProfiler:
+    """Record the cost of each stage of a computation.
+
+    Parameters
+    ----------
+    trace_memory : bool, optional
+        Measure the peak memory allocated during each stage with tracemalloc.
+        It slows down code that allocates many small Python objects.
+
+    Examples
+    --------
+    >>> from phdtools.profiling import StageProfiler
+    >>> profiler = StageProfiler()
+    >>> with profiler.stage("resample") as record:
+    >>>     raw.resample(128)
+    >>>     record["n_samples"] = raw.n_times * len(raw.ch_names)
+    >>> profiler.records
+    [{'stage': 'resample', 'wall_s': 1.2, 'cpu_s': 1.1, ...}]
+    """
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.records = []
+
+    @contextmanager
+    def stage(self, name):
+        """Measure the code run inside the context as one stage.
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage
+
+        Yields
+        ------
+        dict
+            Record of the stage. Extra values, such as ``n_samples``, can be
+            added to it inside the context.
+        """
+        record = {"stage": name, "n_samples": None}
+        tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        elif self.trace_memory:
+            tracemalloc.reset_peak()
+        rss_before = current_rss_mb()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            record["wall_s"] = time.perf_counter() - wall_start
+            record["cpu_s"] = time.process_time() - cpu_start
+            rss_after = current_rss_mb()
+            record["rss_mb"] = rss_after
+            record["rss_delta_mb"] = rss_after - rss_before if rss_after is not None else None
+            record["peak_rss_mb"] = peak_rss_mb()
+            record["peak_alloc_mb"] = None
+            if self.trace_memory:
+                record["peak_alloc_mb"] = tracemalloc.get_traced_memory()[1] / 1024**2
+                if tracing:
+                    tracemalloc.stop()
+            self.records.append(record)
+
+    @property
+    def total_wall_s(self):
+        """Wall time of all the recorded stages."""
+        return sum(record["wall_s"] for record in self.records)
+
+    def write_jsonl(self, path, **fields):
+        """Append the records to a JSON lines file.
+
+        Parameters
+        ----------
+        path : str
+            JSON lines file
+        **fields
+            Values added to every line, e.g. ``file=file_path``
+        """
+        write_profile(path, self.records, **fields)
+
+
+def write_profile(path, records, **fields):
+    """Append stage records to a JSON lines file.
+
+    Parameters
+    ----------
+    path : str
+        JSON lines file
+    records : list of dict
+        Records of a `StageProfiler`
+    **fields
+        Values added to every line
+    """
+    with open(path, "a") as f:
+        for record in records:
+            # Numpy scalars are written as plain numbers
+            f.write(json.dumps({**fields, **record}, default=lambda value: value.item()) + "\n")
+
+
+def load_profile(path):
+    """Read a JSON lines profile into a DataFrame, one row per file and stage."""
+    return pd.read_json(path, lines=True)
+
+
+def summarize_profile(profile):
+    """Aggregate a profile over all the files of a batch.
+
+    Parameters
+    ----------
+    profile : str or pd.DataFrame
+        JSON lines file or output of `load_profile`
+
+    Returns
+    -------
+    pd.DataFrame
+        Per stage: number of runs, total/mean/median/max wall time, mean CPU
+        time, share of the total wall time and highest memory figures,
+        sorted by total wall time
+    """
+    if isinstance(profile, str):
+        profile = load_profile(profile)
+    summary = profile.groupby("stage", sort=False).agg(
+        runs=("wall_s", "size"),
+        total_wall_s=("wall_s", "sum"),
+        mean_wall_s=("wall_s", "mean"),
+        median_wall_s=("wall_s", "median"),
+        max_wall_s=("wall_s", "max"),
+        mean_cpu_s=("cpu_s", "mean"),
+        max_rss_mb=("rss_mb", "max"),
+        max_peak_alloc_mb=("peak_alloc_mb", "max"),
+    )
+    summary["wall_share"] = summary["total_wall_s"] / summary["total_wall_s"].sum()
+    return summary.sort_values("total_wall_s", ascending=False)
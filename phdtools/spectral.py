@@ -0,0 +1,157 @@
+"""Welch PSD computed chunk by chunk.
+
+`WelchAccumulator` receives the signal in consecutive chunks of any size and
+accumulates the periodogram of every complete Welch segment, so the memory
+used does not depend on the length of the recording. The result is the same
+as `scipy.signal.welch` with its default options on the full array.
+"""
+import numpy as np
+from scipy.signal import get_window
+
+
+def _median_bias(n):
+    """Bias of the median of n periodograms, as corrected by `scipy.signal.welch`."""
+    ii_2 = 2 * np.arange(1., (n - 1) // 2 + 1)
+    return 1 + np.sum(1. / (ii_2 + 1) - 1. / ii_2)
+
+
+class WelchAccumulator:
+    """Accumulate Welch segment periodograms from consecutive chunks.
+
+    Segments are Hann-windowed, detrended by their mean and overlap by half
+    of their length by default, as in `scipy.signal.welch`.
+
+    Parameters
+    ----------
+    sfreq : float
+        Sampling frequency
+    nperseg : int, optional
+        Length of each segment
+    noverlap : int, optional
+        Overlap between segments, ``nperseg // 2`` by default
+    window : str, optional
+        Window applied to each segment
+    average : {"mean", "median"}, optional
+        How the segment periodograms are averaged. The median has to keep
+        every periodogram, so its memory grows with the recording length.
+
+    Examples
+    --------
+    >>> from phdtools.spectral import WelchAccumulator
+    >>> welch = WelchAccumulator(sfreq=128, nperseg=1024)
+    >>> for chunk in chunks:  # arrays of shape (channels, times)
+    >>>     welch.update(chunk)
+    >>> freqs, psd = welch.result()
+    """
+
+    def __init__(self, sfreq, nperseg=1024, noverlap=None, window="hann", average="mean"):
+        if average not in ("mean", "median"):
+            raise ValueError(f"Unknown average '{average}', use 'mean' or 'median'")
+        self.sfreq = sfreq
+        self.nperseg = nperseg
+        self.noverlap = nperseg // 2 if noverlap is None else noverlap
+        self.step = nperseg - self.noverlap
+        self.average = average
+        self.window = get_window(window, nperseg)
+        self.scale = 1.0 / (sfreq * (self.window ** 2).sum())
+        self.freqs = np.fft.rfftfreq(nperseg, 1 / sfreq)
+
+        self.n_segments = 0
+        self._sum = None
+        self._periodograms = []
+        self._buffer = None
+
+    def _periodograms_of(self, segments):
+        """One-sided density periodograms of segments shaped (..., nperseg)."""
+        segments = segments - segments.mean(axis=-1, keepdims=True)
+        spectrum = np.fft.rfft(segments * self.window, axis=-1)
+        periodograms = (spectrum.real ** 2 + spectrum.imag ** 2) * self.scale
+        if self.nperseg % 2:
+            periodograms[..., 1:] *= 2
+        else:
+            periodograms[..., 1:-1] *= 2
+        return periodograms
+
+    def update(self, chunk):
+        """Add the next samples of the signal.
+
+        Parameters
+        ----------
+        chunk : np.ndarray
+            Samples with shape (channels, times)
+        """
+        chunk = np.asarray(chunk, dtype=float)
+        data = chunk if self._buffer is None else np.concatenate([self._buffer, chunk], axis=-1)
+        n_times = data.shape[-1]
+        if n_times < self.nperseg:
+            self._buffer = data
+            return
+
+        n_segments = (n_times - self.nperseg) // self.step + 1
+        segments = np.lib.stride_tricks.sliding_window_view(data, self.nperseg, axis=-1)
+        segments = segments[:, ::self.step][:, :n_segments]  # channels × segments × nperseg
+        periodograms = self._periodograms_of(segments)
+
+        if self.average == "mean":
+            total = periodograms.sum(axis=1)
+            self._sum = total if self._sum is None else self._sum + total
+        else:
+            self._periodograms.append(periodograms)
+        self.n_segments += n_segments
+
+        # Keep the samples needed by the next segment
+        self._buffer = data[:, n_segments * self.step:].copy()
+
+    def result(self):
+        """Average the accumulated periodograms.
+
+        Returns
+        -------
+        tuple
+            Frequencies and PSD with shape (channels, freqs)
+        """
+        if self.n_segments == 0:
+            raise ValueError(f"Less than {self.nperseg} samples received, no complete segment")
+        if self.average == "mean":
+            return self.freqs, self._sum / self.n_segments
+        periodograms = np.concatenate(self._periodograms, axis=1)
+        return self.freqs, np.median(periodograms, axis=1) / _median_bias(self.n_segments)
+
+
+def welch_streaming(raw, nperseg=1024, noverlap=None, average="mean", picks=None, chunk_size=None):
+    """Compute the Welch PSD of a Raw object reading it window by window.
+
+    With a Raw object that is not preloaded, only one window of samples is
+    read from the EDF/FIF file at a time.
+
+    Parameters
+    ----------
+    raw : mne.io.Raw
+        Raw data, preloaded or not
+    nperseg : int, optional
+        Length of each Welch segment
+    noverlap : int, optional
+        Overlap between segments, ``nperseg // 2`` by default
+    average : {"mean", "median"}, optional
+        How the segment periodograms are averaged
+    picks : list, optional
+        Channels to use, all by default
+    chunk_size : int, optional
+        Samples read at a time, 64 segments by default
+
+    Returns
+    -------
+    tuple
+        Frequencies and PSD with shape (channels, freqs), as returned by
+        ``scipy.signal.welch(raw.get_data(picks), fs=sfreq, nperseg=nperseg)``
+    """
+    n_times = raw.n_times
+    # Same as scipy for recordings shorter than a segment
+    nperseg = min(nperseg, n_times)
+    accumulator = WelchAccumulator(raw.info['sfreq'], nperseg, noverlap=noverlap, average=average)
+    chunk_size = chunk_size or 64 * accumulator.step
+
+    for start in range(0, n_times, chunk_size):
+        stop = min(start + chunk_size, n_times)
+        accumulator.update(raw.get_data(picks=picks, start=start, stop=stop))
+    return accumulator.result()
@@ -0,0 +1,289 @@
+"""Permutation tests on band powers.
+
+All the band x channel comparisons of two conditions are tested at once: the
+permutations are drawn in batches as sign-flip (paired) or label (unpaired)
+matrices, and the t statistic of every test under every permutation of a
+batch is obtained with a few matrix products. The family-wise error over all
+the tests is controlled with the maximum statistic of each permutation.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# Columns of the wide CSV written by scripts/analysis.py that are not band powers
+METADATA_COLUMNS = ["file", "measurement", "condition", "subject"]
+
+
+def wide_to_long(table):
+    """Convert the wide table of `process_fif_files` to long format.
+
+    Parameters
+    ----------
+    table : pd.DataFrame
+        One row per file with ``{band}_{channel}`` power columns. The
+        ``{band}_mean`` global averages are left out.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per file, channel and band, with a ``power`` column
+    """
+    id_columns = [column for column in METADATA_COLUMNS if column in table]
+    power_columns = [
+        column for column in table.columns
+        if column not in id_columns and "_" in column and not column.endswith("_mean")
+    ]
+    long = table.melt(id_vars=id_columns, value_vars=power_columns, var_name="column", value_name="power")
+    long[["band", "channel"]] = long["column"].str.split("_", n=1, expand=True)
+    return long.drop(columns="column")
+
+
+def _t_paired(sums, sum_squares, n):
+    """t statistics of paired differences from their sums, shape (..., tests)."""
+    mean = sums / n
+    variance = (sum_squares / n - mean ** 2) * n / (n - 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return mean / np.sqrt(variance / n)
+
+
+def _t_welch(sums_a, sum_squares_a, n_a, sums_b, sum_squares_b, n_b):
+    """Welch t statistics of two groups from their sums, shape (..., tests)."""
+    mean_a, mean_b = sums_a / n_a, sums_b / n_b
+    variance_a = (sum_squares_a - n_a * mean_a ** 2) / (n_a - 1)
+    variance_b = (sum_squares_b - n_b * mean_b ** 2) / (n_b - 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (mean_a - mean_b) / np.sqrt(variance_a / n_a + variance_b / n_b)
+
+
+def _oriented(t, tail):
+    """Statistic whose large values are extreme for the given tail."""
+    return np.abs(t) if tail == 0 else t * tail
+
+
+def _permutation_batch(a, b, paired, tail, observed, seeds, n_permutations, batch_size, exact):
+    """Run some permutations, counting the statistics at least as extreme as the observed ones.
+
+    Each batch of permutations has its own seed, so the result does not depend
+    on how the batches are shared between processes.
+
+    Returns
+    -------
+    tuple
+        Count of each test, maximum statistic of each permutation
+    """
+    counts = np.zeros(observed.shape, dtype=np.int64)
+    maxima = []
+
+    if paired:
+        differences = a - b
+        n = len(differences)
+        sum_squares = (differences ** 2).sum(axis=0)  # Does not change when flipping signs
+    else:
+        data = np.vstack([a, b])
+        squares = data ** 2
+        n_a, n_b = len(a), len(b)
+        total, total_squares = data.sum(axis=0), squares.sum(axis=0)
+
+    for start, seed in zip(range(0, n_permutations, batch_size), seeds):
+        size = min(batch_size, n_permutations - start)
+        rng = np.random.default_rng(seed)
+        if paired:
+            if exact is not None:
+                # Every sign pattern, from the bits of the permutation number
+                numbers = np.arange(exact + start, exact + start + size)[:, None]
+                signs = 1 - 2 * ((numbers >> np.arange(n)) & 1)
+            else:
+                signs = rng.choice([-1.0, 1.0], size=(size, n))
+            t = _t_paired(signs @ differences, sum_squares, n)
+        else:
+            # Random labels with n_a rows in the first group
+            labels = np.argsort(rng.random((size, n_a + n_b)), axis=1) < n_a
+            labels = labels.astype(float)
+            sums_a, sum_squares_a = labels @ data, labels @ squares
+            t = _t_welch(sums_a, sum_squares_a, n_a, total - sums_a, total_squares - sum_squares_a, n_b)
+
+        statistic = _oriented(t, tail)
+        counts += (statistic >= observed - 1e-12).sum(axis=0)
+        maxima.append(np.nanmax(statistic, axis=1))
+    return counts, np.concatenate(maxima)
+
+
+def permutation_test(a, b, paired=True, n_permutations=10000, tail=0, batch_size=1000, n_jobs=1, seed=0):
+    """Permutation t-test of many variables at once, with max-statistic correction.
+
+    Parameters
+    ----------
+    a, b : np.ndarray
+        Observations of both conditions with shape (observations, tests). When
+        paired, row i of ``a`` and ``b`` belong to the same subject.
+    paired : bool, optional
+        Paired test flipping the sign of the differences, or unpaired
+        (Welch) test permuting the condition labels
+    n_permutations : int, optional
+        Number of permutations. A paired test with ``2 ** n_subjects`` at most
+        this number runs every sign pattern instead (exact test). The exact
+        test counts all the ``2 ** n_subjects`` patterns, the identity
+        included, so its p-values are multiples of ``2 ** -n_subjects``.
+        `mne.stats.permutation_t_test` counts ``2 ** (n_subjects - 1)``
+        patterns instead, as flipping every sign gives the same two-sided
+        statistic, and leaves the identity out of the null distribution,
+        so its p-values differ slightly (e.g. 502/1024 and 251/511).
+        Random permutations count the observed labelling as one more
+        permutation, ``(count + 1) / (n_permutations + 1)``.
+    tail : {0, 1, -1}, optional
+        Two-sided test, or alternative ``a > b`` (1) or ``a < b`` (-1)
+    batch_size : int, optional
+        Permutations computed at a time, which bounds the memory used to
+        ``batch_size * (observations + tests)`` floats
+    n_jobs : int, optional
+        Processes sharing the permutations, -1 to use all the cores
+    seed : int, optional
+        Seed of the permutations
+
+    Returns
+    -------
+    dict
+        ``t`` statistics, ``p_values`` of each test, ``p_corrected`` by the
+        maximum statistic over all tests, and ``n_permutations`` run
+    """
+    a, b = np.asarray(a, dtype=float), np.asarray(b, dtype=float)
+    if a.ndim == 1:
+        a, b = a[:, None], b[:, None]
+    if tail not in (0, 1, -1):
+        raise ValueError("tail must be 0, 1 or -1")
+
+    if paired:
+        if a.shape != b.shape:
+            raise ValueError(f"Paired samples must have the same shape, got {a.shape} and {b.shape}")
+        differences = a - b
+        t = _t_paired(differences.sum(axis=0), (differences ** 2).sum(axis=0), len(a))
+    else:
+        t = _t_welch(a.sum(axis=0), (a ** 2).sum(axis=0), len(a), b.sum(axis=0), (b ** 2).sum(axis=0), len(b))
+    observed = _oriented(t, tail)
+
+    exact = paired and 2 ** len(a) <= n_permutations
+    if exact:
+        n_permutations = 2 ** len(a)
+
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count() or 1
+    # Share whole batches between the processes
+    n_batches = -(-n_permutations // batch_size)
+    n_jobs = max(1, min(n_jobs, n_batches))
+    seeds = np.random.SeedSequence(seed).spawn(n_batches)
+    first_batches = np.linspace(0, n_batches, n_jobs + 1).astype(int)
+    tasks = []
+    for first, last in zip(first_batches[:-1], first_batches[1:]):
+        start, stop = first * batch_size, min(last * batch_size, n_permutations)
+        tasks.append((a, b, paired, tail, observed, seeds[first:last], stop - start, batch_size,
+                      start if exact else None))
+
+    if n_jobs == 1:
+        results = [_permutation_batch(*tasks[0])]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(_permutation_batch, *zip(*tasks)))
+    counts = sum(count for count, _ in results)
+    maxima = np.concatenate([maximum for _, maximum in results])
+
+    # Number of permutations whose maximum reaches the statistic of each test
+    maxima = np.sort(maxima)
+    exceed = len(maxima) - np.searchsorted(maxima, observed - 1e-12, side="left")
+    if exact:
+        # The identity is one of the enumerated sign patterns
+        p_values = counts / n_permutations
+        p_corrected = exceed / n_permutations
+    else:
+        # The observed labelling counts as one more permutation
+        p_values = (counts + 1) / (n_permutations + 1)
+        p_corrected = (exceed + 1) / (n_permutations + 1)
+
+    return {"t": t, "p_values": p_values, "p_corrected": p_corrected, "n_permutations": n_permutations}
+
+
+def condition_arrays(table, condition_a, condition_b, paired=True, by="condition", value="power"):
+    """Arrange a long band-power table as two (observations, tests) arrays.
+
+    Parameters
+    ----------
+    table : pd.DataFrame
+        Long table with ``subject``, ``band``, ``channel`` and the ``by`` and
+        ``value`` columns
+    condition_a, condition_b : str
+        Values of the ``by`` column compared
+    paired : bool, optional
+        Keep the subjects with both conditions and align them. Several files
+        of a subject in one condition are averaged.
+    by : str, optional
+        Column of the conditions, e.g. ``"measurement"`` to compare M1 and M2
+    value : str, optional
+        Column of the values tested
+
+    Returns
+    -------
+    tuple
+        Arrays of both conditions and the (band, channel) index of the tests
+    """
+    table = table[table[by].astype(str).isin([condition_a, condition_b])]
+    grouped = table.groupby([by, "subject", "band", "channel"], observed=True)[value].mean()
+    wide = grouped.unstack(["band", "channel"]).sort_index(axis=1)
+    wide = wide.dropna(axis=1)  # Tests of channels missing in some recordings
+
+    a, b = wide.loc[condition_a], wide.loc[condition_b]
+    if paired:
+        subjects = a.index.intersection(b.index)
+        a, b = a.loc[subjects], b.loc[subjects]
+    return a.to_numpy(), b.to_numpy(), wide.columns
+
+
+def compare_conditions(table, condition_a, condition_b, paired=True, by="condition", n_permutations=10000,
+                       tail=0, n_jobs=1, seed=0):
+    """Test the band powers of two conditions in every band and channel.
+
+    Parameters
+    ----------
+    table : pd.DataFrame
+        Band powers from `scripts/analysis.py`, either the wide CSV table or
+        the long table of its Parquet output
+    condition_a, condition_b : str
+        Values of the ``by`` column compared, e.g. ``"OA"`` and ``"OC"``
+    paired : bool, optional
+        Paired test over the subjects with both conditions, or unpaired test
+    by : str, optional
+        Column of the conditions
+    n_permutations, tail, n_jobs, seed
+        See `permutation_test`
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per band and channel with the number of observations and
+        mean of each condition, the t statistic and the uncorrected and
+        max-statistic corrected p-values
+
+    Examples
+    --------
+    >>> from phdtools.stats import compare_conditions
+    >>> df = pd.read_csv("results_power_bands.csv")
+    >>> results = compare_conditions(df[df["measurement"] == "M1"], "OA", "OC", n_permutations=10000)
+    >>> results[results["p_corrected"] < 0.05]
+    """
+    if "power" not in table:
+        table = wide_to_long(table)
+    a, b, tests = condition_arrays(table, condition_a, condition_b, paired=paired, by=by)
+    if min(len(a), len(b)) < 2:
+        raise ValueError(f"Not enough observations to compare {condition_a} ({len(a)}) and {condition_b} ({len(b)})")
+
+    result = permutation_test(a, b, paired=paired, n_permutations=n_permutations, tail=tail, n_jobs=n_jobs,
+                              seed=seed)
+    frame = tests.to_frame(index=False)
+    frame[f"n_{condition_a}"] = len(a)
+    frame[f"n_{condition_b}"] = len(b)
+    frame[f"mean_{condition_a}"] = a.mean(axis=0)
+    frame[f"mean_{condition_b}"] = b.mean(axis=0)
+    frame["t"] = result["t"]
+    frame["p_value"] = result["p_values"]
+    frame["p_corrected"] = result["p_corrected"]
+    return frame
@@ -0,0 +1,326 @@
+"""Cleaned recordings stored as compressed, chunked HDF5 files.
+
+A FIF file keeps the samples of a cleaned recording as float64 and has to be
+decoded whole (or read through MNE) to use any part of it. Here the samples
+are stored as float32 in a ``data`` dataset of shape (channels, times),
+compressed and chunked by channel and by blocks of time, so reading one
+channel or a time slice only decodes the chunks it overlaps. The channel
+names and types, sampling rate, bad channels and the metadata of the study
+(subject, condition, measurement, ICA exclusions...) are attributes of the
+file.
+
+Reading and writing need the optional dependency h5py.
+"""
+import os
+from datetime import datetime
+
+import numpy as np
+
+# Version of the layout, stored in the files
+FORMAT_VERSION = 1
+
+# Attributes describing the signal, the rest is metadata
+_SIGNAL_ATTRS = {"format_version", "sfreq", "ch_names", "ch_types", "bads", "highpass", "lowpass", "meas_date",
+                 "first_samp", "projections"}
+
+# Description of the average reference projector added by MNE
+_AVERAGE_REFERENCE = "Average EEG reference"
+
+
+def _import_h5py():
+    try:
+        import h5py
+    except ImportError as e:
+        raise ImportError("HDF5 storage needs h5py, install it with `pip install h5py`") from e
+    return h5py
+
+
+def _attr_value(h5py, value):
+    """Value that h5py can store as an attribute."""
+    if value is None:
+        return ""
+    if isinstance(value, (list, tuple)):
+        if all(isinstance(item, str) for item in value):
+            return np.array(value, dtype=h5py.string_dtype())
+        return np.asarray(value)
+    return value
+
+
+def _python_value(value):
+    """Attribute read by h5py as plain Python values."""
+    if isinstance(value, bytes):
+        return value.decode()
+    if isinstance(value, np.ndarray):
+        return [_python_value(item) for item in value.tolist()]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def write_recording(path, data, sfreq, ch_names, attrs=None, chunk_duration=30.0, compression="gzip",
+                    compression_level=4):
+    """Write signals to an HDF5 file as compressed float32.
+
+    Parameters
+    ----------
+    path : str
+        Path of the file, overwritten if it exists
+    data : np.ndarray
+        Signals with shape (channels, times)
+    sfreq : float
+        Sampling frequency
+    ch_names : list of str
+        Channel names, in the order of the rows of ``data``
+    attrs : dict, optional
+        Metadata stored as attributes of the file, e.g. ``subject`` or
+        ``ica_exclude``. Values must be numbers, strings or lists of them.
+    chunk_duration : float, optional
+        Seconds of signal in each chunk. Each chunk holds a single channel.
+    compression : str, optional
+        HDF5 compression filter, e.g. "gzip" or "lzf"
+    compression_level : int, optional
+        Level of the gzip compression, 0-9
+
+    Returns
+    -------
+    str
+        Path of the file
+    """
+    h5py = _import_h5py()
+    data = np.asarray(data)
+    if data.ndim != 2 or data.shape[0] != len(ch_names):
+        raise ValueError(f"Expected data with shape ({len(ch_names)}, times), got {data.shape}")
+    chunk_size = max(1, min(data.shape[1], int(round(chunk_duration * sfreq))))
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with h5py.File(path, "w") as f:
+        f.create_dataset(
+            "data", data=data.astype(np.float32), chunks=(1, chunk_size), compression=compression,
+            compression_opts=compression_level if compression == "gzip" else None, shuffle=True,
+        )
+        f.attrs["format_version"] = FORMAT_VERSION
+        f.attrs["sfreq"] = float(sfreq)
+        f.attrs["ch_names"] = _attr_value(h5py, list(ch_names))
+        for name, value in (attrs or {}).items():
+            f.attrs[name] = _attr_value(h5py, value)
+    return path
+
+
+def save_raw(raw, path, attrs=None, chunk_duration=30.0, compression="gzip", compression_level=4):
+    """Write the samples and channel information of an MNE Raw object.
+
+    Projections that are not applied (e.g. the average reference of the
+    pipeline) are not applied either, as in the FIF file; their
+    descriptions are kept and `HDF5Recording.to_raw` adds the average
+    reference back.
+
+    Parameters
+    ----------
+    raw : mne.io.Raw
+        Recording to store
+    path : str
+        Path of the file
+    attrs : dict, optional
+        Metadata of the recording, see `write_recording`
+    chunk_duration, compression, compression_level
+        Layout of the samples, see `write_recording`
+
+    Returns
+    -------
+    str
+        Path of the file
+    """
+    info = raw.info
+    signal_attrs = {
+        "ch_types": raw.get_channel_types(),
+        "bads": list(info["bads"]),
+        "highpass": float(info["highpass"]),
+        "lowpass": float(info["lowpass"]),
+        "meas_date": info["meas_date"].isoformat() if info["meas_date"] is not None else "",
+        "first_samp": int(raw.first_samp),
+        "projections": [proj["desc"] for proj in info["projs"]],
+    }
+    return write_recording(path, raw.get_data(), info["sfreq"], raw.ch_names, {**signal_attrs, **(attrs or {})},
+                           chunk_duration=chunk_duration, compression=compression,
+                           compression_level=compression_level)
+
+
+class HDF5Recording:
+    """Recording stored by `write_recording`, read on demand.
+
+    Only the attributes are read when the file is opened. `get_data` reads
+    the requested channels and samples, decoding only the chunks they
+    overlap. The object has the ``ch_names``, ``n_times``, ``info["sfreq"]``
+    and ``get_data(picks, start, stop)`` of an MNE Raw object that is not
+    preloaded, so `phdtools.spectral.welch_streaming` reads it window by
+    window.
+
+    Parameters
+    ----------
+    path : str
+        Path of the file
+
+    Examples
+    --------
+    >>> from phdtools.storage import HDF5Recording
+    >>> with HDF5Recording("M1_OA_F100_C1_EPOC_raw.h5") as recording:
+    >>>     recording.attrs["subject"], recording.attrs["ica_exclude"]
+    >>>     o1 = recording.get_data(picks=["O1"], tmin=60, tmax=120)  # Decodes 1 channel, 60 s
+    >>>     raw = recording.to_raw(tmax=300)
+    """
+
+    preload = False
+
+    def __init__(self, path):
+        h5py = _import_h5py()
+        self.path = path
+        self._file = h5py.File(path, "r")
+        self._data = self._file["data"]
+        attrs = {name: _python_value(value) for name, value in self._file.attrs.items()}
+        self.sfreq = float(attrs["sfreq"])
+        self.ch_names = list(attrs["ch_names"])
+        self.n_times = self._data.shape[1]
+        self.info = {"sfreq": self.sfreq, "ch_names": self.ch_names, "bads": list(attrs.get("bads", []))}
+        self.signal_attrs = {name: value for name, value in attrs.items() if name in _SIGNAL_ATTRS}
+        self.attrs = {name: value for name, value in attrs.items() if name not in _SIGNAL_ATTRS}
+
+    def __repr__(self):
+        return f"<HDF5Recording | {os.path.basename(self.path)}, {len(self.ch_names)} channels, " \
+               f"{self.n_times / self.sfreq:.1f} s>"
+
+    def _pick_indices(self, picks):
+        if picks is None:
+            return list(range(len(self.ch_names)))
+        if isinstance(picks, (str, int, np.integer)):
+            picks = [picks]
+        indices = []
+        for pick in picks:
+            if isinstance(pick, str):
+                if pick not in self.ch_names:
+                    raise ValueError(f"No channel named '{pick}', channels are {self.ch_names}")
+                pick = self.ch_names.index(pick)
+            indices.append(int(pick))
+        return indices
+
+    def get_data(self, picks=None, start=0, stop=None, tmin=None, tmax=None):
+        """Read some channels and samples.
+
+        Parameters
+        ----------
+        picks : list of str or int, optional
+            Channel names or indices, all the channels by default
+        start, stop : int, optional
+            First and last (excluded) samples
+        tmin, tmax : float, optional
+            First and last (excluded) times in seconds, instead of
+            ``start`` and ``stop``
+
+        Returns
+        -------
+        np.ndarray
+            float64 samples with shape (channels, times), in the order of
+            ``picks``
+        """
+        if tmin is not None:
+            start = int(round(tmin * self.sfreq))
+        if tmax is not None:
+            stop = int(round(tmax * self.sfreq))
+        start, stop, _ = slice(start, stop).indices(self.n_times)
+        indices = self._pick_indices(picks)
+        # h5py selects rows in increasing order, each once
+        rows = sorted(set(indices))
+        if not rows:
+            return np.empty((0, stop - start))
+        if rows[-1] - rows[0] + 1 == len(rows):
+            block = self._data[rows[0]:rows[-1] + 1, start:stop]
+        else:
+            block = self._data[rows, start:stop]
+        return block[[rows.index(index) for index in indices]].astype(float)
+
+    def to_raw(self, picks=None, tmin=None, tmax=None):
+        """Read the recording, or a part of it, into an MNE Raw object.
+
+        The average reference projection of the FIF file is added back when
+        all the channels are read.
+
+        Parameters
+        ----------
+        picks : list of str or int, optional
+            Channels to read, all by default
+        tmin, tmax : float, optional
+            Time window in seconds, the whole recording by default
+
+        Returns
+        -------
+        mne.io.RawArray
+            Preloaded recording
+        """
+        import mne
+
+        indices = self._pick_indices(picks)
+        start = int(round(tmin * self.sfreq)) if tmin is not None else 0
+        ch_types = self.signal_attrs.get("ch_types") or ["eeg"] * len(self.ch_names)
+        info = mne.create_info([self.ch_names[i] for i in indices], self.sfreq, [ch_types[i] for i in indices])
+        with info._unlock():
+            for name in ("highpass", "lowpass"):
+                if name in self.signal_attrs:
+                    info[name] = self.signal_attrs[name]
+        info["bads"] = [ch for ch in self.info["bads"] if ch in info["ch_names"]]
+
+        raw = mne.io.RawArray(self.get_data(indices, start=start, tmin=tmin, tmax=tmax), info,
+                              first_samp=self.signal_attrs.get("first_samp", 0) + start, verbose="error")
+        if self.signal_attrs.get("meas_date"):
+            raw.set_meas_date(datetime.fromisoformat(self.signal_attrs["meas_date"]))
+        if _AVERAGE_REFERENCE in self.signal_attrs.get("projections", []) and len(indices) == len(self.ch_names):
+            raw.set_eeg_reference("average", projection=True, verbose="error")
+        return raw
+
+    def close(self):
+        """Close the file."""
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_raw_hdf5(path, picks=None, tmin=None, tmax=None):
+    """Read a recording stored by `save_raw` into an MNE Raw object, see `HDF5Recording.to_raw`."""
+    with HDF5Recording(path) as recording:
+        return recording.to_raw(picks, tmin, tmax)
+
+
+def convert_fif(fif_path, h5_path=None, attrs=None, ica_path=None, **kwargs):
+    """Convert a preprocessed FIF file to HDF5.
+
+    Parameters
+    ----------
+    fif_path : str
+        Path of the ``_raw.fif`` file
+    h5_path : str, optional
+        Path of the HDF5 file, the FIF path with a ``.h5`` extension by
+        default
+    attrs : dict, optional
+        Metadata of the recording, see `write_recording`
+    ica_path : str, optional
+        ICA saved with the recording, whose excluded components are stored
+        in the ``ica_exclude`` attribute
+    **kwargs
+        Layout of the samples, see `write_recording`
+
+    Returns
+    -------
+    str
+        Path of the HDF5 file
+    """
+    import mne
+
+    if h5_path is None:
+        h5_path = os.path.splitext(fif_path)[0] + ".h5"
+    attrs = dict(attrs or {})
+    if ica_path is not None:
+        attrs["ica_exclude"] = [int(index) for index in mne.preprocessing.read_ica(ica_path, verbose="error").exclude]
+    raw = mne.io.read_raw_fif(fif_path, preload=True, verbose="error")
+    return save_raw(raw, h5_path, attrs, **kwargs)
@@ -0,0 +1,135 @@
+"""Lookup of the subject codes of the study.
+
+The subjects are listed in an Excel file (``doc/BD_FITBIT_FE_MentalFit.xlsx``)
+with their centre, code, gender and FITBIT number. Parsing the workbook is
+slow, so its table is cached as a Parquet file next to it and read again only
+when the workbook changes. The codes of each centre are kept sorted, and the
+subjects whose code starts with a prefix are found by binary search instead
+of scanning the whole table for every file.
+"""
+import bisect
+import os
+import re
+from typing import NamedTuple
+
+import pandas as pd
+
+CENTRE = "Centro"
+CODE = "CODIGO"
+GENDER = "Genero"
+FITBIT = "FITBIT"
+COLUMNS = [CENTRE, CODE, GENDER, FITBIT]
+
+# Year used when the code has no date
+DEFAULT_YEAR = "2024"
+
+# Birth date at the end of the codes, ddmmyy or ddmmyyyy (see doc/codification.md)
+_DATE = re.compile(r"\d{2}\d{2}(\d{4}|\d{2})$")
+
+
+class Subject(NamedTuple):
+    """Row of the subject table."""
+
+    code: str
+    centre: int
+    gender: str
+    fitbit: object
+    year: str
+
+
+def _year(code):
+    match = _DATE.search(code)
+    if not match:
+        return DEFAULT_YEAR
+    year = match.group(1)
+    return year if len(year) == 4 else "20" + year
+
+
+def read_codes(excel_path, cache_path=None):
+    """Read the subject table, from its Parquet cache when it is up to date.
+
+    Parameters
+    ----------
+    excel_path : str
+        Path of the Excel file
+    cache_path : str, optional
+        Path of the Parquet cache, the Excel path with a ``.parquet``
+        extension by default. The cache is not used without pyarrow.
+
+    Returns
+    -------
+    pd.DataFrame
+        Centre, code, gender and FITBIT columns, the FITBIT numbers as
+        nullable integers
+    """
+    if cache_path is None:
+        cache_path = os.path.splitext(excel_path)[0] + ".parquet"
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        cache_path = None
+
+    if cache_path and os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(excel_path):
+        return pd.read_parquet(cache_path)
+
+    codes = pd.read_excel(excel_path)[COLUMNS]
+    codes[CODE] = codes[CODE].astype(str).str.strip().str.upper()
+    codes[GENDER] = codes[GENDER].astype(str).str.strip()
+    # Integers with missing values, not floats
+    codes[FITBIT] = pd.to_numeric(codes[FITBIT], errors="coerce").astype("Int64")
+    if cache_path:
+        codes.to_parquet(cache_path, index=False)
+    return codes
+
+
+class SubjectIndex:
+    """Find subjects by the beginning of their code and their centre.
+
+    Parameters
+    ----------
+    codes : pd.DataFrame
+        Subject table, see `read_codes`
+
+    Examples
+    --------
+    >>> from phdtools.subjects import SubjectIndex, read_codes
+    >>> index = SubjectIndex(read_codes("doc/BD_FITBIT_FE_MentalFit.xlsx"))
+    >>> index.lookup("RCP", 1)
+    (Subject(code='RCP210310', centre=1, gender='H', fitbit=81, year='2010'),)
+    """
+
+    def __init__(self, codes):
+        self._codes = {}
+        self._subjects = {}
+        rows = [
+            (centre, str(code).strip().upper(), gender, fitbit)
+            for centre, code, gender, fitbit in codes[COLUMNS].itertuples(index=False, name=None)
+        ]
+        for centre, code, gender, fitbit in sorted(rows, key=lambda row: row[1]):
+            self._codes.setdefault(centre, []).append(code)
+            self._subjects.setdefault(centre, []).append(Subject(code, centre, gender, fitbit, _year(code)))
+
+    def __len__(self):
+        return sum(len(codes) for codes in self._codes.values())
+
+    def lookup(self, prefix, centre):
+        """Subjects of a centre whose code starts with a prefix.
+
+        Parameters
+        ----------
+        prefix : str
+            Beginning of the code, e.g. the letters of the file name
+        centre : int
+            Centre code
+
+        Returns
+        -------
+        tuple of Subject
+            Matching subjects, sorted by code
+        """
+        prefix = prefix.upper()
+        codes = self._codes.get(centre, [])
+        # The matching codes are contiguous in the sorted list
+        start = bisect.bisect_left(codes, prefix)
+        stop = bisect.bisect_left(codes, prefix + "\uffff", lo=start)
+        return tuple(self._subjects[centre][start:stop])
@@ -0,0 +1,301 @@
+"""Fast rendering of many topographic maps.
+
+The scalp image of `mne.viz.plot_topomap` is an interpolation of the channel
+values on a grid of pixels, and it is linear in the values. The image of each
+channel alone, drawn once by MNE, gives the weights from the channels to every
+pixel, so each map is then a single matrix product with the same interpolation,
+head sphere and extrapolation as ``plot_topomap``. One figure, drawn by MNE, is
+reused for all the maps, only the image data is replaced, and the frames of an
+animation can be rendered in several processes and streamed to a GIF (Pillow)
+or to any video format supported by ffmpeg.
+"""
+import os
+import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+class TopomapRenderer:
+    """Draw topomaps of one channel layout.
+
+    The maps are those of `mne.viz.plot_topomap` with ``contours=0``.
+
+    Parameters
+    ----------
+    info : mne.Info
+        Measurement info with the channel positions (a montage)
+    resolution : int, optional
+        Pixels of each side of the image, the ``res`` of `mne.viz.plot_topomap`
+    sphere : float | tuple, optional
+        Head sphere, as the ``sphere`` of `mne.viz.plot_topomap`: its radius
+        in metres or its origin and radius. MNE's default head if None.
+    cmap : str, optional
+        Colormap
+    vlim : tuple, optional
+        Limits of the colour scale. Each map uses the symmetric range of its
+        values, as ``plot_topomap``, if None.
+    figsize : tuple, optional
+        Size of the figure in inches
+
+    Examples
+    --------
+    >>> from phdtools.topomap import TopomapRenderer
+    >>> renderer = TopomapRenderer(raw.info, sphere=0.09)
+    >>> renderer.save(alpha_power, "alpha.png", title="Alpha band")
+    >>> renderer.animate(raw.get_data()[:, ::128], "activation.gif", fps=10, n_jobs=4)
+    """
+
+    def __init__(self, info, resolution=128, sphere=None, cmap="viridis", vlim=None, figsize=(6, 6)):
+        import matplotlib.pyplot as plt
+
+        montage = info.get_montage()
+        if montage is None:
+            raise ValueError("The info has no channel positions, set a montage first")
+        ch_pos = montage.get_positions()["ch_pos"]
+        picks = [ch for ch in info["ch_names"] if ch in ch_pos and not np.isnan(ch_pos[ch]).any()]
+        if len(picks) != len(info["ch_names"]):
+            missing = sorted(set(info["ch_names"]) - set(picks))
+            raise ValueError(f"Channels without position: {missing}")
+
+        self.info = info
+        self.ch_names = list(info["ch_names"])
+        self.sphere = sphere
+        self.resolution = resolution
+        self.cmap = cmap
+        self.vlim = vlim
+        self.figsize = figsize
+
+        # The image of each unit vector gives the weight of each channel on every pixel
+        fig, ax = plt.subplots()
+        try:
+            columns = []
+            for unit in np.eye(len(self.ch_names)):
+                ax.clear()
+                artist = self._plot(unit, ax)
+                columns.append(np.ma.filled(artist.get_array(), np.nan).ravel())
+        finally:
+            plt.close(fig)
+        self.weights = np.column_stack(columns)  # pixels × channels
+
+        self._figure = None
+
+    def _plot(self, values, ax):
+        import mne
+
+        image, _ = mne.viz.plot_topomap(values, self.info, sphere=self.sphere, res=self.resolution, contours=0,
+                                        cmap=self.cmap, axes=ax, show=False)
+        return image
+
+    def __getstate__(self):
+        # Each process draws on its own figure
+        return {**self.__dict__, "_figure": None}
+
+    def close(self):
+        """Close the figure shared by the maps."""
+        if self._figure is not None:
+            import matplotlib.pyplot as plt
+
+            plt.close(self._figure[0])
+            self._figure = None
+
+    def images(self, values):
+        """Interpolate the channel values on the pixel grid.
+
+        Parameters
+        ----------
+        values : np.ndarray
+            Values with shape (channels,) or (channels, maps)
+
+        Returns
+        -------
+        np.ndarray
+            Images with shape (resolution, resolution) or (maps, resolution,
+            resolution). They extend past the head, where the figure clips
+            them as ``plot_topomap``.
+        """
+        values = np.asarray(values, dtype=float)
+        images = self.weights @ values.reshape(len(self.ch_names), -1)
+        images = images.T.reshape(-1, self.resolution, self.resolution)
+        return images[0] if values.ndim == 1 else images
+
+    def _setup_figure(self):
+        import matplotlib.pyplot as plt
+
+        # MNE draws the head outline, the sensors and the clipped image once
+        fig, ax = plt.subplots(figsize=self.figsize)
+        image = self._plot(np.zeros(len(self.ch_names)), ax)
+        title = ax.set_title("")
+        fig.tight_layout()
+        self._figure = (fig, image, title)
+        return self._figure
+
+    def draw(self, values=None, image=None, title=""):
+        """Update the figure with a new map.
+
+        Parameters
+        ----------
+        values : np.ndarray, optional
+            Channel values of the map
+        image : np.ndarray, optional
+            Already interpolated image of the values
+        title : str, optional
+            Title of the map
+
+        Returns
+        -------
+        matplotlib.figure.Figure
+            The figure shared by all the maps
+        """
+        fig, artist, title_artist = self._figure or self._setup_figure()
+        image = self.images(values) if image is None else image
+        artist.set_data(image)
+        if self.vlim is not None:
+            vmin, vmax = self.vlim
+        else:
+            # Symmetric range of the values, the default of plot_topomap
+            vmax = np.nanmax(np.abs(values if values is not None else image))
+            vmin = -vmax
+        artist.set_clim(vmin, vmax)
+        title_artist.set_text(title)
+        return fig
+
+    def save(self, values, path, title="", dpi=100):
+        """Draw a map and save it to an image file."""
+        self.draw(values, title=title).savefig(path, dpi=dpi)
+
+    def frame(self, values=None, image=None, title="", dpi=100):
+        """Draw a map and return its pixels as an RGB array (height, width, 3)."""
+        fig = self.draw(values, image, title)
+        fig.set_dpi(dpi)
+        fig.canvas.draw()
+        return np.asarray(fig.canvas.buffer_rgba())[..., :3].copy()
+
+    def frames(self, data, titles=None, dpi=100):
+        """Render the maps of consecutive samples.
+
+        Parameters
+        ----------
+        data : np.ndarray
+            Values with shape (channels, frames)
+        titles : list of str, optional
+            Title of each frame
+        dpi : int, optional
+            Resolution of the frames
+
+        Yields
+        ------
+        np.ndarray
+            RGB array of each frame
+        """
+        titles = titles if titles is not None else [""] * data.shape[1]
+        # Interpolate a block of frames at a time
+        for start in range(0, data.shape[1], 256):
+            block = data[:, start:start + 256]
+            for values, image, title in zip(block.T, self.images(block), titles[start:start + 256]):
+                yield self.frame(values, image, title=title, dpi=dpi)
+
+    def animate(self, data, output_file, fps=10, titles=None, dpi=100, n_jobs=1, chunk_size=32):
+        """Render an animation of the maps of consecutive samples.
+
+        Parameters
+        ----------
+        data : np.ndarray
+            Values with shape (channels, frames)
+        output_file : str
+            ``.gif`` files are written with Pillow, any other format with ffmpeg
+        fps : int, optional
+            Frames per second
+        titles : list of str, optional
+            Title of each frame
+        dpi : int, optional
+            Resolution of the frames
+        n_jobs : int, optional
+            Processes rendering the frames, -1 to use all the cores
+        chunk_size : int, optional
+            Frames rendered at a time by each process
+        """
+        data = np.asarray(data)
+        titles = list(titles) if titles is not None else [""] * data.shape[1]
+        frames = render_frames(self, data, titles, dpi=dpi, n_jobs=n_jobs, chunk_size=chunk_size)
+        write_video(frames, output_file, fps)
+
+
+def _render_chunk(renderer, data, titles, dpi):
+    try:
+        return list(renderer.frames(data, titles, dpi))
+    finally:
+        renderer.close()
+
+
+def render_frames(renderer, data, titles, dpi=100, n_jobs=1, chunk_size=32):
+    """Render frames in order, in this process or in a pool of processes.
+
+    At most two chunks per process are rendered ahead of the consumer, so the
+    frames of a long animation are never all held in memory.
+
+    Yields
+    ------
+    np.ndarray
+        RGB array of each frame
+    """
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count() or 1
+    if n_jobs == 1:
+        yield from renderer.frames(data, titles, dpi)
+        return
+
+    starts = range(0, data.shape[1], chunk_size)
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        pending = []
+        for start in starts:
+            stop = start + chunk_size
+            pending.append(executor.submit(_render_chunk, renderer, data[:, start:stop], titles[start:stop], dpi))
+            if len(pending) >= 2 * n_jobs:
+                yield from pending.pop(0).result()
+        for future in pending:
+            yield from future.result()
+
+
+def write_video(frames, output_file, fps=10):
+    """Write RGB frames to an animation file.
+
+    Parameters
+    ----------
+    frames : iterable of np.ndarray
+        RGB arrays (height, width, 3), all of the same size
+    output_file : str
+        ``.gif`` files are written with Pillow, any other format (``.mp4``,
+        ``.webm``...) is encoded by ffmpeg, which must be installed
+    fps : int, optional
+        Frames per second
+    """
+    frames = iter(frames)
+    first = next(frames)
+
+    if output_file.lower().endswith(".gif"):
+        from PIL import Image
+
+        # Pillow consumes the other frames lazily
+        Image.fromarray(first).save(
+            output_file, save_all=True, append_images=(Image.fromarray(frame) for frame in frames),
+            duration=1000 / fps, loop=0,
+        )
+        return
+
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        raise RuntimeError("ffmpeg is needed to write videos, install it or save the animation as .gif")
+    height, width = first.shape[:2]
+    command = [
+        ffmpeg, "-y", "-loglevel", "error", "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{width}x{height}",
+        "-r", str(fps), "-i", "-", "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", "-pix_fmt", "yuv420p", output_file,
+    ]
+    with subprocess.Popen(command, stdin=subprocess.PIPE) as process:
+        process.stdin.write(first.tobytes())
+        for frame in frames:
+            process.stdin.write(frame.tobytes())
+        process.stdin.close()
+        if process.wait():
+            raise RuntimeError(f"ffmpeg failed writing {output_file}")
@@ -1,18 +1,19 @@
 import os
-import re
+import shutil
 import mne
 import numpy as np
 import pandas as pd
 from scipy.signal import welch  # Usar scipy para calcular la PSD
 
-# Define frequency bands
-bands = {
-    'Delta': [0.5, 4],
-    'Theta': [4, 8],
-    'Alpha': [8, 12],
-    'Beta': [12, 30],
-    'Gamma': [30, 50]
-}
+from phdtools.bandpower import BANDS, band_means, band_power_timeline, timeline_frame
+from phdtools.columnar import ParquetWriter, long_band_powers, remove_files
+from phdtools.manifest import Manifest
+from phdtools.parser import parse_file_name, parse_file_names
+from phdtools.spectral import welch_streaming
+from phdtools.storage import HDF5Recording
+
+# Frequency bands, shared with the rest of the package
+bands = BANDS
 
 # Function to extract metadata (subject, condition, measurement) from file name
 def extract_metadata(file_name):
@@ -20,63 +21,198 @@ def extract_metadata(file_name):
     Extract measurement, condition, and subject metadata from the file name.
     Expected format: M1_CONDITION_SUBJECT...
     """
-    measure_match = re.search(r'M\d+', file_name)
-    measurement = measure_match.group() if measure_match else "Unknown"
+    parsed = parse_file_name(file_name)
+    measurement = parsed.measurement or "Unknown"
+    condition = parsed.condition or "Unknown"
+    subject = parsed.subject or "Unknown"
 
-    condition_match = re.search(r'M\d+_(\w+)', file_name)
-    condition = condition_match.group(1) if condition_match else "Unknown"
+    return measurement, condition, subject
 
-    subject_match = re.search(r'F\d{3}', file_name)
-    subject = subject_match.group() if subject_match else "Unknown"
+# Function to list the preprocessed recordings of a folder
+def list_preprocessed_files(input_folder):
+    """
+    List the preprocessed `.fif` and `.h5` files of a folder, sorted by name.
 
-    return measurement, condition, subject
+    The ICA solutions saved next to the preprocessed data are not recordings and are left out,
+    and a recording converted to HDF5 is only listed once, as its `.h5` file.
+    """
+    files = os.listdir(input_folder)
+    h5_files = {file for file in files if file.endswith('.h5')}
+    return sorted(
+        file for file in files
+        if file in h5_files
+        or (file.endswith('.fif') and not file.endswith('_ica.fif') and file[:-4] + '.h5' not in h5_files)
+    )
 
-# Function to calculate power for each frequency band
-def calculate_band_power(raw_clean):
+# Function to load a preprocessed recording
+def load_preprocessed(file_path, preload=True):
     """
-    Calculate the average power for each frequency band across all channels.
+    Open a preprocessed `.fif` or `.h5` file.
+
+    Parameters:
+    - file_path (str): Path of the file.
+    - preload (bool, optional): Load the samples of a FIF file into memory. The samples of an HDF5
+      file are always read on demand, a window or a few channels at a time.
+
+    Returns:
+    - mne.io.Raw or phdtools.storage.HDF5Recording: The recording, to close once it is read.
+    """
+    if file_path.endswith('.h5'):
+        return HDF5Recording(file_path)
+    return mne.io.read_raw_fif(file_path, preload=preload)
+
+# Function to calculate the power of every channel in every frequency band
+def calculate_channel_band_power(raw_clean):
     """
-    # Extract data from the preprocessed file
-    data = raw_clean.get_data()  # Shape: channels × timepoints
-    sfreq = raw_clean.info['sfreq']  # Sampling frequency
+    Calculate the mean power in dB of each channel in each frequency band.
+
+    If the data is not preloaded, the PSD is computed reading the file in
+    windows, so the whole recording is never held in memory.
 
-    # Calculate Welch's PSD using scipy
-    freqs, psds = welch(data, fs=sfreq, nperseg=1024, axis=1)
+    Returns:
+    - np.ndarray: Power with shape channels × bands, in the order of `bands`.
+    """
+    if raw_clean.preload:
+        # Extract data from the preprocessed file
+        data = raw_clean.get_data()  # Shape: channels × timepoints
+        sfreq = raw_clean.info['sfreq']  # Sampling frequency
+
+        # Calculate Welch's PSD using scipy
+        freqs, psds = welch(data, fs=sfreq, nperseg=1024, axis=1)
+    else:
+        freqs, psds = welch_streaming(raw_clean, nperseg=1024)
 
     # Convert power to decibels
     psds_db = 10 * np.log10(psds)
 
+    # Mean power of every channel in every band, shape: channels × bands
+    return band_means(psds_db, freqs, bands)
+
+# Function to calculate power for each frequency band
+def calculate_band_power(raw_clean, band_power=None):
+    """
+    Calculate the average power for each frequency band across all channels.
+
+    Parameters:
+    - raw_clean (mne.io.Raw): Preprocessed data.
+    - band_power (np.ndarray, optional): Output of `calculate_channel_band_power`, computed if None.
+
+    Returns:
+    - dict: Global average of each band and power of each band in each channel.
+    """
+    if band_power is None:
+        band_power = calculate_channel_band_power(raw_clean)
+
     # Create a dictionary to store results
     band_results = {}
-    for band, (fmin, fmax) in bands.items():
-        idx_band = np.logical_and(freqs >= fmin, freqs <= fmax)
-        band_power = psds_db[:, idx_band].mean(axis=1)  # Mean power for each channel in the band
-        band_results[f'{band}_mean'] = band_power.mean()  # Global average
-        for idx, ch_name in enumerate(raw_clean.info['ch_names']):
-            band_results[f'{band}_{ch_name}'] = band_power[idx]  # Power per channel
+    ch_names = raw_clean.info['ch_names']
+    for idx_band, band in enumerate(bands):
+        band_results[f'{band}_mean'] = band_power[:, idx_band].mean()  # Global average
+        band_results.update(zip((f'{band}_{ch_name}' for ch_name in ch_names), band_power[:, idx_band]))  # Power per channel
     return band_results
 
+# Function to write the results table, appending when possible
+def write_results(df_new, output_csv, drop_files=()):
+    """
+    Add the rows of new files to the results table.
+
+    The rows are appended to the existing CSV when it has the same columns and
+    no rows have to be removed. Otherwise the table is rewritten once.
+
+    Parameters:
+    - df_new (pd.DataFrame): Results of the new files.
+    - output_csv (str): Path of the results table.
+    - drop_files (iterable, optional): Files whose previous rows must be removed.
+    """
+    drop_files = set(drop_files)
+    if not os.path.exists(output_csv):
+        df_new.to_csv(output_csv, index=False)
+        return
+
+    columns = pd.read_csv(output_csv, nrows=0).columns
+    if not drop_files and set(df_new.columns) <= set(columns):
+        df_new.reindex(columns=columns).to_csv(output_csv, mode='a', header=False, index=False)
+        return
+
+    df_old = pd.read_csv(output_csv)
+    df_old = df_old[~df_old['file'].isin(drop_files)]
+    pd.concat([df_old, df_new], ignore_index=True).to_csv(output_csv, index=False)
+
 # Function to process `.fif` files and generate the results table
-def process_fif_files(input_folder, output_csv):
+def process_fif_files(input_folder, output_csv=None, incremental=False, streaming=False, parquet_dir=None,
+                      batch_size=50):
     """
     Process preprocessed `.fif` files and generate a CSV with power band data.
+
+    In incremental mode, a manifest next to the CSV (or the Parquet dataset) records
+    the processed files. Only the rows of new or modified files are computed and
+    added to the existing table, and the rows of modified or removed files are dropped.
+
+    In streaming mode the files are not preloaded: the PSD is accumulated while
+    reading each file in windows, which bounds the memory used per file.
+
+    With a Parquet folder, the power of every file, channel and band is also written
+    in long format (see `phdtools.columnar`), partitioned by measurement and condition.
+    The rows are written every `batch_size` files, so without CSV output the results
+    of the whole folder are never held in memory.
+
+    Parameters:
+    - input_folder (str): Folder of the preprocessed `.fif` or `.h5` files.
+    - output_csv (str, optional): Path of the wide results table, one row per file. Not written if None.
+    - incremental (bool, optional): Only process the files added or modified since the last run.
+    - streaming (bool, optional): Read the files in windows instead of preloading them.
+    - parquet_dir (str, optional): Folder of the long-format Parquet dataset. Needs pyarrow.
+    - batch_size (int, optional): Files per batch written to the Parquet dataset.
     """
-    fif_files = [file for file in os.listdir(input_folder) if file.endswith('.fif')]
+    if output_csv is None and parquet_dir is None:
+        raise ValueError("Give an output CSV, a Parquet folder or both.")
+    fif_files = list_preprocessed_files(input_folder)
     if not fif_files:
         print("No `.fif` files found in the specified folder.")
         return
+    outputs = [path for path in (output_csv, parquet_dir) if path]
+
+    manifest = None
+    stale_files = []
+    if incremental:
+        manifest = Manifest(os.path.splitext(outputs[0].rstrip(os.sep))[0] + "_manifest.json")
+        if not all(os.path.exists(path) for path in outputs):
+            # The results were removed, start from scratch
+            manifest.entries = {}
+            if parquet_dir and os.path.isdir(parquet_dir):
+                shutil.rmtree(parquet_dir)
+            if output_csv and os.path.exists(output_csv):
+                os.remove(output_csv)
+        file_paths = [os.path.join(input_folder, file) for file in fif_files]
+        removed = manifest.removed(file_paths)
+        changed = manifest.changed(file_paths)
+        # Only the removed and modified files have rows to drop, the new files were never written
+        modified = [file_path for file_path in changed if os.path.abspath(file_path) in manifest.entries]
+        for file_path in removed + changed:
+            manifest.forget(file_path)
+        stale_files = [os.path.basename(file_path) for file_path in removed + modified]
+        fif_files = [os.path.basename(file_path) for file_path in changed]
+        print(f"{len(fif_files)} new or modified files, {len(removed)} removed.")
+    elif parquet_dir and os.path.isdir(parquet_dir):
+        shutil.rmtree(parquet_dir)  # Rewrite the whole dataset, as the CSV
+
+    writer = None
+    if parquet_dir:
+        if stale_files:
+            print(f"Removed {remove_files(parquet_dir, stale_files)} rows of modified or removed files.")
+        writer = ParquetWriter(parquet_dir, batch_size=batch_size)
+
+    # Extract the metadata of all the files at once
+    metadata = parse_file_names(fif_files)[['measurement', 'condition', 'subject']].fillna("Unknown")
 
     all_results = []
-    for file in fif_files:
+    for file, (measurement, condition, subject) in zip(fif_files, metadata.itertuples(index=False)):
         print(f"Processing file: {file}")
         file_path = os.path.join(input_folder, file)
 
-        # Extract metadata
-        measurement, condition, subject = extract_metadata(file)
-
         # Load the preprocessed data
         try:
-            raw_clean = mne.io.read_raw_fif(file_path, preload=True)
+            raw_clean = load_preprocessed(file_path, preload=not streaming)
         except Exception as e:
             print(f"Error loading file {file}: {e}")
             continue
@@ -84,28 +220,103 @@ def process_fif_files(input_folder, output_csv):
         # Calculate power for each band
         file_results = {'file': file, 'measurement': measurement, 'condition': condition, 'subject': subject}
         try:
-            band_powers = calculate_band_power(raw_clean)
-            file_results.update(band_powers)
+            band_power = calculate_channel_band_power(raw_clean)
+            file_results.update(calculate_band_power(raw_clean, band_power))
         except Exception as e:
             print(f"Error calculating power for file {file}: {e}")
             continue
+        finally:
+            raw_clean.close()  # An HDF5 file stays open until it is closed
 
         # Add results to the list
-        all_results.append(file_results)
+        if output_csv:
+            all_results.append(file_results)
+        if writer is not None:
+            writer.write(long_band_powers(band_power, raw_clean.ch_names, bands, file=file, subject=subject,
+                                          condition=condition, measurement=measurement))
+        if manifest is not None:
+            manifest.record(file_path, outputs)
 
-    # Convert results to a DataFrame
-    if all_results:
-        df_results = pd.DataFrame(all_results)
-        df_results.to_csv(output_csv, index=False)
-        print(f"Results saved to: {output_csv}")
-    else:
-        print("No results were generated due to errors.")
+    if writer is not None:
+        writer.close()
+        print(f"{writer.n_rows} rows saved to: {parquet_dir}")
+
+    if output_csv is not None:
+        if manifest is None:
+            # Convert results to a DataFrame
+            if all_results:
+                df_results = pd.DataFrame(all_results)
+                df_results.to_csv(output_csv, index=False)
+                print(f"Results saved to: {output_csv}")
+            else:
+                print("No results were generated due to errors.")
+        elif all_results or stale_files:
+            df_new = pd.DataFrame(all_results) if all_results else pd.DataFrame(columns=['file'])
+            write_results(df_new, output_csv, drop_files=stale_files)
+            print(f"Results updated in: {output_csv}")
+        else:
+            print("The results table is up to date.")
+    if manifest is not None:
+        manifest.save()
+
+# Function to compute band power and fatigue index timelines of `.fif` files
+def process_fif_timelines(input_folder, output_csv, window=30.0, step=5.0, nperseg=256):
+    """
+    Compute band power, relative power and fatigue indexes in sliding windows for every file.
+
+    The spectrum of each recording is computed once (see `phdtools.bandpower.band_power_timeline`),
+    so overlapping windows do not repeat the FFTs of their common samples.
+
+    Parameters:
+    - input_folder (str): Folder of the preprocessed `.fif` or `.h5` files.
+    - output_csv (str): Path of the long table, one row per file, channel and window.
+    - window (float, optional): Length of the windows in seconds.
+    - step (float, optional): Time between consecutive windows in seconds.
+    - nperseg (int, optional): Length of the Welch segments of each window.
+
+    Returns:
+    - pd.DataFrame: Timelines of all the files, with the file metadata and the window centre in seconds.
+    """
+    fif_files = list_preprocessed_files(input_folder)
+    metadata = parse_file_names(fif_files)[['measurement', 'condition', 'subject']].fillna("Unknown")
+
+    timelines = []
+    for file, (measurement, condition, subject) in zip(fif_files, metadata.itertuples(index=False)):
+        print(f"Processing file: {file}")
+        try:
+            raw_clean = load_preprocessed(os.path.join(input_folder, file))
+        except Exception as e:
+            print(f"Error loading file {file}: {e}")
+            continue
+        try:
+            timeline = band_power_timeline(raw_clean.get_data(), raw_clean.info['sfreq'], bands, window=window,
+                                           step=step, nperseg=nperseg)
+        except Exception as e:
+            print(f"Error calculating the timeline of file {file}: {e}")
+            continue
+        finally:
+            raw_clean.close()
+        frame = timeline_frame(timeline, raw_clean.ch_names, bands)
+        frame.insert(0, 'subject', subject)
+        frame.insert(0, 'condition', condition)
+        frame.insert(0, 'measurement', measurement)
+        frame.insert(0, 'file', file)
+        timelines.append(frame)
+
+    if not timelines:
+        print("No timelines were generated.")
+        return None
+    df_timelines = pd.concat(timelines, ignore_index=True)
+    df_timelines.to_csv(output_csv, index=False)
+    print(f"Timelines saved to: {output_csv}")
+    return df_timelines
 
 # Main Execution
 if __name__ == "__main__":
     # Folder containing preprocessed `.fif` files
     input_folder = "/Users/rosaayusomoreno/Desktop/phdtools/data_eeg/filtered_data"
     output_csv = "/Users/rosaayusomoreno/Desktop/phdtools/data_eeg/filtered_data/results_power_bands.csv"
+    parquet_dir = None  # Long-format Parquet dataset, e.g. os.path.join(input_folder, "power_bands")
 
     # Process files and generate the results table
-    process_fif_files(input_folder, output_csv)
+    process_fif_files(input_folder, output_csv, parquet_dir=parquet_dir)
@@ -0,0 +1,372 @@
+"""Benchmark the stages of the EEG pipeline on synthetic EPOC-like recordings.
+
+Run from the scripts folder, e.g.:
+
+    python benchmark.py --duration 300 --n-recordings 4 --save-baseline baseline.json
+    python benchmark.py --duration 300 --n-recordings 4 --baseline baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import mne
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+import analysis
+import filters
+import mapeo
+from phdtools.filetools import rename
+from phdtools.profiling import peak_rss_mb
+
+# Auxiliary channels recorded by the EPOC next to the EEG
+AUX_CHANNELS = ['COUNTER', 'INTERPOLATED']
+
+
+# Function to generate a synthetic recording
+def make_synthetic_raw(duration=60, sfreq=256, seed=0):
+    """
+    Generate an EPOC-like recording: 14 EEG channels mixing a few 1/f sources,
+    an alpha rhythm, 50 Hz line noise and sensor noise, plus auxiliary channels.
+
+    Parameters:
+    - duration (float): Length of the recording in seconds.
+    - sfreq (float): Sampling frequency.
+    - seed (int): Seed of the random generator.
+
+    Returns:
+    - mne.io.RawArray: Synthetic recording in volts.
+    """
+    rng = np.random.default_rng(seed)
+    n_times = int(duration * sfreq)
+    times = np.arange(n_times) / sfreq
+
+    # 1/f (pink) sources shaped in the frequency domain
+    spectrum = rng.standard_normal((4, n_times // 2 + 1)) + 1j * rng.standard_normal((4, n_times // 2 + 1))
+    freqs = np.fft.rfftfreq(n_times, 1 / sfreq)
+    spectrum /= np.sqrt(np.maximum(freqs, 1 / duration))
+    sources = np.fft.irfft(spectrum, n=n_times)
+    # Bursts: a slowly changing amplitude makes the sources non-Gaussian, as real EEG, so ICA can separate them
+    envelope = rng.standard_normal((4, n_times // 2 + 1)) * (freqs < 0.5)  # Changes within ~1 s
+    envelope = np.fft.irfft(envelope, n=n_times)
+    sources *= np.exp(0.5 * envelope / envelope.std(axis=1, keepdims=True))
+    sources /= sources.std(axis=1, keepdims=True)
+    sources[0] += 2 * np.sin(2 * np.pi * 10 * times)  # Alpha rhythm
+
+    n_eeg = len(filters.CH_NAMES)
+    eeg = rng.standard_normal((n_eeg, len(sources))) @ sources
+    eeg += 0.3 * np.sin(2 * np.pi * 50 * times) + 0.5 * rng.standard_normal((n_eeg, n_times))
+    eeg *= 10e-6
+
+    aux = np.vstack([np.arange(n_times) % 128, np.zeros(n_times)])
+    info = mne.create_info(filters.CH_NAMES + AUX_CHANNELS, sfreq, ['eeg'] * n_eeg + ['misc'] * len(AUX_CHANNELS))
+    return mne.io.RawArray(np.vstack([eeg, aux]), info, verbose=False)
+
+
+# Function to measure a stage
+def time_stage(function, setup=None, repeat=3, n_samples=None):
+    """
+    Time a function and measure the memory it allocates.
+
+    The function is timed `repeat` times without tracing, then run once more
+    under tracemalloc to measure its peak allocation.
+
+    Parameters:
+    - function (callable): Function to time. It receives the output of `setup`.
+    - setup (callable, optional): Function preparing the input of each run, not timed.
+    - repeat (int): Number of timed runs.
+    - n_samples (int, optional): Samples processed per run, to report throughput.
+
+    Returns:
+    - dict: Median and minimum seconds, samples/s and peak allocated MB.
+    """
+    setup = setup or (lambda: None)
+    times = []
+    for _ in range(repeat):
+        argument = setup()
+        start = time.perf_counter()
+        function(argument)
+        times.append(time.perf_counter() - start)
+
+    argument = setup()
+    tracemalloc.start()
+    function(argument)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    seconds = statistics.median(times)
+    return {
+        "seconds": seconds,
+        "min_seconds": min(times),
+        "samples_per_s": n_samples / seconds if n_samples else None,
+        "peak_mb": peak / 1024**2,
+    }
+
+
+# Function to run every benchmark
+def run_benchmarks(duration=60, n_recordings=2, sfreq=256, repeat=3, n_jobs=1, ica_fit_samples=None):
+    """
+    Benchmark each pipeline stage and the end-to-end batch.
+
+    Parameters:
+    - duration (float): Length of each synthetic recording in seconds.
+    - n_recordings (int): Number of recordings of the batch benchmark.
+    - sfreq (float): Sampling frequency of the synthetic recordings.
+    - repeat (int): Number of timed runs of each stage.
+    - n_jobs (int): Worker processes of the batch benchmark.
+    - ica_fit_samples (int, optional): Budget of samples of the ICA fits on a subset.
+
+    Returns:
+    - dict: Results of each benchmark, by name.
+    """
+    mne.set_log_level("ERROR")
+    raw = make_synthetic_raw(duration, sfreq)
+    n_samples = raw.n_times * len(filters.CH_NAMES)
+    results = {}
+
+    def run(name, function, setup=None, n_samples=None):
+        print(f"Running {name}...", flush=True)
+        results[name] = time_stage(function, setup, repeat=repeat, n_samples=n_samples)
+
+    run("preprocess_raw", lambda raw_: filters.preprocess_raw(raw_), setup=raw.copy, n_samples=n_samples)
+
+    cleaned = filters.preprocess_raw(raw.copy())["cleaned_raw"]
+    n_clean = cleaned.n_times * len(cleaned.ch_names)
+    run("calculate_band_power", analysis.calculate_band_power, setup=lambda: cleaned, n_samples=n_clean)
+    run("compute_band_powers", lambda raw_: mapeo.compute_band_powers(raw_, mapeo.BANDS), setup=lambda: cleaned,
+        n_samples=n_clean)
+
+    file_names = [
+        f"M{1 + i % 2}_OA_F{i:03d}_C{1 + i % 8}_EPOC_{'intervalMarker_' if i % 5 == 0 else ''}2024.edf"
+        for i in range(1000)
+    ]
+    run("rename (1000 names)", lambda names: [rename(name) for name in names], setup=lambda: file_names)
+
+    results.update(run_resample_benchmark(raw, repeat))
+    results.update(run_ica_benchmark(raw, ica_fit_samples, repeat))
+
+    results.update(run_batch_benchmark(duration, n_recordings, sfreq, n_jobs))
+    return results
+
+
+# Function to compare the components of two ICAs
+def component_agreement(ica, reference):
+    """
+    Match the components of an ICA one to one with those of a reference ICA
+    (Hungarian algorithm on the absolute correlation of their scalp maps).
+
+    Parameters:
+    - ica (mne.preprocessing.ICA): Fitted ICA to evaluate.
+    - reference (mne.preprocessing.ICA): ICA fitted on the whole recording.
+
+    Returns:
+    - float: Mean absolute correlation of the matched components, 1 for identical components.
+    """
+    maps, reference_maps = ica.get_components(), reference.get_components()
+    n_components = maps.shape[1]
+    correlation = np.abs(np.corrcoef(maps.T, reference_maps.T)[:n_components, n_components:])
+    rows, cols = linear_sum_assignment(correlation, maximize=True)
+    return float(correlation[rows, cols].mean())
+
+# Function to benchmark the fused resampling and filtering
+def run_resample_benchmark(raw, repeat=3):
+    """
+    Time the resample and filter stages against the fused stage on the picked channels,
+    and measure how close their results are away from the edges.
+
+    Parameters:
+    - raw (mne.io.Raw): Synthetic recording.
+    - repeat (int): Number of timed runs of each version.
+
+    Returns:
+    - dict: Results of each version, with the speedup and relative RMS difference of the fused stage.
+    """
+    picked = filters.pick_stage(raw.copy())
+    n_samples = picked.n_times * len(picked.ch_names)
+    results = {}
+
+    def separate(raw_):
+        return filters.filter_stage(filters.resample_stage(raw_))
+
+    print("Running resample + filter...", flush=True)
+    results["resample + filter"] = time_stage(separate, setup=picked.copy, repeat=repeat, n_samples=n_samples)
+    print("Running resample_filter (fused)...", flush=True)
+    results["resample_filter (fused)"] = time_stage(filters.resample_filter_stage, setup=picked.copy,
+                                                    repeat=repeat, n_samples=n_samples)
+
+    # The edges are padded differently, compare after the first and before the last second
+    reference = separate(picked.copy()).get_data()
+    fused = filters.resample_filter_stage(picked.copy()).get_data()
+    interior = slice(int(filters.SFREQ), -int(filters.SFREQ))
+    difference = np.sqrt(np.mean((fused - reference)[:, interior] ** 2) / np.mean(reference[:, interior] ** 2))
+    results["resample_filter (fused)"]["speedup"] = (results["resample + filter"]["seconds"]
+                                                     / results["resample_filter (fused)"]["seconds"])
+    results["resample_filter (fused)"]["relative_rms"] = float(difference)
+    return results
+
+# Function to benchmark the ICA fit on a subset of the recording
+def run_ica_benchmark(raw, fit_samples=None, repeat=3):
+    """
+    Time the ICA fit on the whole recording and on decimated and random subsets,
+    and measure how close the subset components are to the full fit.
+
+    Parameters:
+    - raw (mne.io.Raw): Synthetic recording.
+    - fit_samples (int, optional): Budget of samples of the subsets, a quarter of the recording by default.
+    - repeat (int): Number of timed runs of each fit.
+
+    Returns:
+    - dict: Results of each fit, with the speedup and component correlation of the subsets.
+    """
+    prepared = filters.make_pipeline(ica=False).run(raw.copy())
+    fit_samples = fit_samples or prepared.n_times // 4
+    n_samples = prepared.n_times * len(prepared.ch_names)
+    results = {}
+
+    print("Running ica fit (full)...", flush=True)
+    results["ica fit (full)"] = time_stage(lambda raw_: filters.fit_ica(raw_), setup=lambda: prepared,
+                                           repeat=repeat, n_samples=n_samples)
+    reference = filters.fit_ica(prepared)
+    # FastICA stops at max_iter without converging on some data, which dominates the time of the fit
+    results["ica fit (full)"]["iterations"] = reference.n_iter_
+    for sampling in ("decimate", "random"):
+        name = f"ica fit ({sampling})"
+        print(f"Running {name}...", flush=True)
+
+        def fit(raw_, sampling=sampling):
+            return filters.fit_ica(raw_, fit_samples=fit_samples, fit_sampling=sampling)
+
+        results[name] = time_stage(fit, setup=lambda: prepared, repeat=repeat, n_samples=n_samples)
+        results[name]["speedup"] = results["ica fit (full)"]["seconds"] / results[name]["seconds"]
+        ica = fit(prepared)
+        results[name]["iterations"] = ica.n_iter_
+        results[name]["component_correlation"] = component_agreement(ica, reference)
+    return results
+
+# Function to benchmark the whole batch
+def run_batch_benchmark(duration, n_recordings, sfreq, n_jobs):
+    """
+    Time `filters.apply_to_files` on synthetic EDF files.
+
+    Returns:
+    - dict: Result of the batch benchmark, empty if EDF files cannot be written.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        for i in range(n_recordings):
+            raw = make_synthetic_raw(duration, sfreq, seed=i)
+            try:
+                mne.export.export_raw(os.path.join(folder, f"M1_OA_F{i:03d}_C1_EPOC.edf"), raw, overwrite=True)
+            except (ImportError, RuntimeError) as e:
+                print(f"Skipping batch benchmark, cannot write EDF files: {e}")
+                return {}
+
+        print(f"Running batch of {n_recordings} recordings...", flush=True)
+        start = time.perf_counter()
+        results = filters.apply_to_files(folder, n_jobs=n_jobs)
+        seconds = time.perf_counter() - start
+
+    n_samples = n_recordings * int(duration * sfreq) * len(filters.CH_NAMES)
+    return {
+        "batch": {
+            "seconds": seconds,
+            "min_seconds": seconds,
+            "samples_per_s": n_samples / seconds,
+            "recordings_per_hour": len(results) * 3600 / seconds,
+            "peak_mb": None,
+        }
+    }
+
+
+# Function to compare the results with a baseline
+def compare_with_baseline(results, baseline, threshold=1.2):
+    """
+    Find the benchmarks slower than the baseline.
+
+    Parameters:
+    - results (dict): Current results.
+    - baseline (dict): Results stored by a previous run.
+    - threshold (float): Ratio of the median times above which a benchmark is a regression.
+
+    Returns:
+    - dict: Ratio current/baseline time of each regressed benchmark.
+    """
+    regressions = {}
+    for name, result in results.items():
+        reference = baseline.get("results", {}).get(name)
+        if not reference:
+            continue
+        ratio = result["seconds"] / reference["seconds"]
+        if ratio > threshold:
+            regressions[name] = ratio
+    return regressions
+
+
+# Function to print the results
+def print_results(results, baseline=None):
+    """
+    Print a table of the results, with the ratio to the baseline if given.
+    """
+    print(f"\n{'benchmark':<24}{'median s':>10}{'min s':>10}{'Msamples/s':>12}{'peak MB':>10}{'vs base':>9}")
+    for name, result in results.items():
+        throughput = f"{result['samples_per_s'] / 1e6:.2f}" if result["samples_per_s"] else "-"
+        peak = f"{result['peak_mb']:.1f}" if result["peak_mb"] is not None else "-"
+        reference = (baseline or {}).get("results", {}).get(name)
+        ratio = f"{result['seconds'] / reference['seconds']:.2f}x" if reference else "-"
+        print(f"{name:<24}{result['seconds']:>10.3f}{result['min_seconds']:>10.3f}{throughput:>12}{peak:>10}{ratio:>9}")
+    for name, result in results.items():
+        if "component_correlation" in result:
+            print(f"{name}: {result['speedup']:.1f}x faster than the full fit "
+                  f"({result['iterations']} vs {results['ica fit (full)']['iterations']} iterations), "
+                  f"component correlation {result['component_correlation']:.3f}")
+    for name, result in results.items():
+        if "relative_rms" in result:
+            print(f"{name}: {result['speedup']:.1f}x faster than resample + filter, "
+                  f"relative RMS difference {result['relative_rms']:.2e}")
+    if "batch" in results:
+        print(f"Batch throughput: {results['batch']['recordings_per_hour']:.0f} recordings/hour")
+    print(f"Peak RSS: {peak_rss_mb():.0f} MB")
+
+
+# Main execution
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the EEG pipeline on synthetic recordings.")
+    parser.add_argument("--duration", type=float, default=60, help="Length of each recording in seconds")
+    parser.add_argument("--n-recordings", type=int, default=2, help="Recordings in the batch benchmark")
+    parser.add_argument("--sfreq", type=float, default=256, help="Sampling frequency of the recordings")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs of each stage")
+    parser.add_argument("--n-jobs", type=int, default=1, help="Worker processes of the batch benchmark")
+    parser.add_argument("--ica-fit-samples", type=int, help="Samples of the ICA fits on a subset")
+    parser.add_argument("--baseline", help="JSON file of a previous run to compare with")
+    parser.add_argument("--save-baseline", help="Save the results to this JSON file")
+    parser.add_argument("--threshold", type=float, default=1.2, help="Slowdown ratio reported as regression")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.duration, args.n_recordings, args.sfreq, args.repeat, args.n_jobs,
+                             args.ica_fit_samples)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump({
+                "parameters": vars(args),
+                "versions": {"python": platform.python_version(), "mne": mne.__version__, "numpy": np.__version__},
+                "results": results,
+            }, f, indent=1)
+        print(f"Baseline saved to: {args.save_baseline}")
+
+    if baseline:
+        regressions = compare_with_baseline(results, baseline, args.threshold)
+        for name, ratio in regressions.items():
+            print(f"REGRESSION: {name} is {ratio:.2f}x slower than the baseline")
+        sys.exit(1 if regressions else 0)
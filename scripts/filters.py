@@ -1,93 +1,304 @@
 import os
+import shutil
+import tempfile
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
+import multiprocessing
 import mne
 from pyprep.prep_pipeline import PrepPipeline
-from scipy.signal import welch
 import numpy as np
 import matplotlib.pyplot as plt
+import pyprep
+
+from phdtools.batch import BatchContext, active_context
+from phdtools.cache import ResultCache
+from phdtools.decimation import fir_decimate
+from phdtools.filetools import file_hash
+from phdtools.manifest import Manifest
+from phdtools.parser import parse_file_name
+from phdtools.pipeline import Pipeline, Stage
+from phdtools.prefetch import Prefetcher
+from phdtools.profiling import StageProfiler, write_profile
+from phdtools.spectral import welch_streaming
+from phdtools.storage import convert_fif, read_raw_hdf5, save_raw
+
+# Channels of interest
+CH_NAMES = ['AF3', 'F7', 'F3', 'FC5', 'T7', 'P7', 'O1', 'O2', 'P8', 'T8', 'FC6', 'F4', 'F8', 'AF4']
+
+# Preprocessing parameters
+SFREQ = 128
+L_FREQ, H_FREQ = 1, 50
+PREP_MAX_ITERATIONS = 8
+ICA_N_COMPONENTS = 0.99
+ICA_METHOD = 'fastica'
+ICA_FIT_SAMPLES = None  # Samples used to fit the ICA, e.g. 60000 (~8 min at 128 Hz); None fits on the whole recording
+WELCH_NPERSEG = 1024
+
+# Suffix of the preprocessed files of each storage format
+STORAGE_SUFFIXES = {'fif': '_raw.fif', 'hdf5': '_raw.h5'}
+
+# Environment variables read by the BLAS/OpenMP backends used by numpy, scipy and MNE
+THREAD_ENV_VARS = [
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+]
+
+# Function to list the EDF files of a folder
+def list_edf_files(folder_path, keyword=None):
+    """
+    List the EDF files in a folder.
+
+    Parameters:
+    - folder_path (str): Path to the folder containing the EDF files.
+    - keyword (str, optional): If specified, only files containing this keyword in their name are listed.
+
+    Returns:
+    - list: Paths of the EDF files, sorted by name.
+    """
+    return sorted(
+        os.path.join(folder_path, file)
+        for file in os.listdir(folder_path)
+        if file.endswith(".edf") and (keyword in file if keyword else True)
+    )
+
+# Function to read a single EDF file
+def read_edf(file_path, lazy=False, picks=None, tmin=0.0, tmax=None, memmap_dir=None):
+    """
+    Read an EDF file, optionally keeping the samples on disk until needed.
+
+    In lazy mode the channels are picked and the recording is cropped before
+    any sample is read, and the remaining samples are loaded into a
+    memory-mapped file instead of RAM. The memory-mapped file is unlinked as
+    soon as it is mapped, so it disappears with the Raw object.
+
+    Parameters:
+    - file_path (str): Path to the EDF file.
+    - lazy (bool, optional): Pick, crop and memory-map instead of preloading the whole file.
+    - picks (list, optional): Channels to keep in lazy mode. Missing channels are ignored.
+    - tmin (float, optional): Start of the crop window in seconds, in lazy mode.
+    - tmax (float, optional): End of the crop window in seconds, in lazy mode. Until the end if None.
+    - memmap_dir (str, optional): Folder of the memory-mapped file, the temporary folder by default.
+
+    Returns:
+    - raw (mne.io.Raw): MNE Raw object with the data loaded.
+    """
+    if not lazy:
+        return mne.io.read_raw_edf(file_path, preload=True)  # Load into memory
+
+    raw = mne.io.read_raw_edf(file_path, preload=False)
+    if picks is not None:
+        raw.pick([ch for ch in picks if ch in raw.ch_names])
+    if tmin or tmax is not None:
+        raw.crop(tmin=tmin, tmax=min(tmax, raw.times[-1]) if tmax is not None else None)
+
+    fd, memmap_path = tempfile.mkstemp(suffix=".dat", dir=memmap_dir)
+    os.close(fd)
+    try:
+        raw.load_data(memmap=memmap_path)
+    except TypeError:
+        # MNE < 1.11 cannot memory-map after reading, load the reduced data into memory
+        raw.load_data()
+    try:
+        os.remove(memmap_path)
+    except OSError:
+        pass  # The file is still mapped (Windows), it stays in the temporary folder
+    return raw
 
 # Function to load EDF files from a folder
-def load_edf_files(folder_path, keyword=None):
+def load_edf_files(folder_path, keyword=None, lazy=False, picks=None, tmin=0.0, tmax=None, memmap_dir=None):
     """
     Generator to load EDF files from a folder iteratively.
 
     Parameters:
     - folder_path (str): Path to the folder containing the EDF files.
     - keyword (str, optional): If specified, only files containing this keyword in their name will be loaded.
+    - lazy (bool, optional): Pick channels and crop before reading, and memory-map the samples (see `read_edf`).
+    - picks (list, optional): Channels to keep in lazy mode.
+    - tmin (float, optional): Start of the crop window in seconds, in lazy mode.
+    - tmax (float, optional): End of the crop window in seconds, in lazy mode.
+    - memmap_dir (str, optional): Folder of the memory-mapped files.
 
     Yields:
     - raw (mne.io.Raw): MNE Raw object for the loaded EDF file.
     - file_name (str): Name of the EDF file being loaded.
     """
-    edf_files = [
-        os.path.join(folder_path, file)
-        for file in os.listdir(folder_path)
-        if file.endswith(".edf") and (keyword in file if keyword else True)
-    ]
+    edf_files = list_edf_files(folder_path, keyword)
 
     print(f"Found {len(edf_files)} EDF files.")
 
     for idx, file_path in enumerate(edf_files, start=1):
         print(f"[{idx}/{len(edf_files)}] Loading file: {file_path}")
-        raw = mne.io.read_raw_edf(file_path, preload=True)  # Load into memory
+        raw = read_edf(file_path, lazy=lazy, picks=picks, tmin=tmin, tmax=tmax, memmap_dir=memmap_dir)
         yield raw, file_path
 
-# Function to preprocess a single raw file
-def preprocess_raw(raw, exclude_channels=None):
+# Function to read the next EDF files in the background
+def prefetch_edf_files(edf_files, lazy=False, depth=2, max_bytes=None, scratch_dir=None):
     """
-    Preprocess an MNE Raw object.
-    Steps:
-        1. Resample to 128 Hz.
-        2. Bandpass filter (1-50 Hz).
-        3. Apply montage (10-20 system).
-        4. Run PyPREP for bad channel detection/interpolation.
-        5. Re-reference to the average.
-        6. Perform ICA for artifact removal.
-        7. Compute Welch's PSD.
+    Read the next EDF files in a background thread while the current one is processed.
 
     Parameters:
-    - raw (mne.io.Raw): The raw data object.
-    - exclude_channels (list, optional): List of channels to exclude before processing.
+    - edf_files (list): Paths of the EDF files, in processing order.
+    - lazy (bool, optional): Read the files lazily (see `read_edf`).
+    - depth (int, optional): Number of files read ahead of the one being processed.
+    - max_bytes (int, optional): Memory (or scratch space) allowed for the files read ahead and the one
+      being processed. The memory of a preloaded file is estimated as 4 times its size (int16 samples
+      loaded as float64).
+    - scratch_dir (str, optional): Local folder (e.g. on an SSD) where the files are copied ahead,
+      instead of being read into memory. Each copy is removed once its file is processed.
 
     Returns:
-        dict: Preprocessed data and PSD results.
+    - Prefetcher: Iterable of (file_path, raw or local path, error), see `phdtools.prefetch.Prefetcher`.
     """
-    # Channels of interest
-    ch_names = ['AF3', 'F7', 'F3', 'FC5', 'T7', 'P7', 'O1', 'O2', 'P8', 'T8', 'FC6', 'F4', 'F8', 'AF4']
+    if scratch_dir is not None:
+        return Prefetcher(edf_files, depth=depth, max_bytes=max_bytes, scratch_dir=scratch_dir)
+    return Prefetcher(
+        edf_files, reader=lambda file_path: read_edf(file_path, lazy=lazy, picks=CH_NAMES), depth=depth,
+        max_bytes=max_bytes, size_of=lambda file_path: 4 * os.path.getsize(file_path),
+    )
 
-    # Exclude predefined bad channels if provided
-    if exclude_channels:
-        raw.drop_channels(exclude_channels)
-        print(f"Excluded channels: {exclude_channels}")
+# Stage resampling the data
+def resample_stage(raw, sfreq=SFREQ):
+    """
+    Resample the data.
+
+    Parameters:
+    - raw (mne.io.Raw): The raw data object.
+    - sfreq (float): New sampling frequency.
 
-    # 1. Resample
-    raw.resample(sfreq=128)
+    Returns:
+    - mne.io.Raw: The resampled data.
+    """
+    raw.resample(sfreq=sfreq)
     print(f"Resampled to {raw.info['sfreq']} Hz")
+    return raw
+
+# Stage applying the bandpass filter
+def filter_stage(raw, l_freq=L_FREQ, h_freq=H_FREQ):
+    """
+    Bandpass filter the data.
+
+    Parameters:
+    - raw (mne.io.Raw): The raw data object.
+    - l_freq (float): Low cut-off frequency.
+    - h_freq (float): High cut-off frequency.
+
+    Returns:
+    - mne.io.Raw: The filtered data.
+    """
+    raw.filter(l_freq=l_freq, h_freq=h_freq)
+    print(f"Applied bandpass filter: {l_freq}-{h_freq} Hz")
+    return raw
+
+# Stage resampling and filtering in a single pass
+def resample_filter_stage(raw, sfreq=SFREQ, l_freq=L_FREQ, h_freq=H_FREQ, block_size=None):
+    """
+    Bandpass filter and decimate the data in one pass (see `phdtools.decimation.fir_decimate`).
+
+    The FIR filter is designed at the original rate, with the same defaults as `raw.filter`,
+    and also removes the frequencies above the new Nyquist frequency. The result is `raw.filter`
+    followed by keeping one sample out of every n, edges included. It matches `resample_stage`
+    followed by `filter_stage` to ~0.1% RMS, except in the last second or so, where
+    `raw.resample` pads the signal differently. If the original rate is not a multiple of the
+    new one, both stages are applied instead.
+
+    Parameters:
+    - raw (mne.io.Raw): The raw data object, with only the channels to keep.
+    - sfreq (float): New sampling frequency.
+    - l_freq (float): Low cut-off frequency.
+    - h_freq (float): High cut-off frequency, below sfreq / 2.
+    - block_size (int, optional): Samples filtered at a time.
+
+    Returns:
+    - mne.io.Raw: The filtered and resampled data.
+    """
+    factor = raw.info['sfreq'] / sfreq
+    if factor <= 1 or not float(factor).is_integer():
+        return filter_stage(resample_stage(raw, sfreq), l_freq, h_freq)
+
+    # Inside a batch context the filter is only designed once per batch
+    context = active_context()
+    if context:
+        h = context.filter(raw.info['sfreq'], l_freq, h_freq)
+    else:
+        h = mne.filter.create_filter(None, raw.info['sfreq'], l_freq, h_freq, verbose='error')
+    data = fir_decimate(raw.get_data(), h, int(factor), block_size=block_size)
+
+    info = raw.info.copy()
+    with info._unlock():
+        info['sfreq'] = float(sfreq)
+        info['highpass'], info['lowpass'] = float(l_freq), float(h_freq)
+    resampled = mne.io.RawArray(data, info, first_samp=raw.first_samp // int(factor), verbose='error')
+    resampled.set_annotations(raw.annotations)
+    print(f"Resampled to {sfreq} Hz with bandpass filter: {l_freq}-{h_freq} Hz")
+    return resampled
+
+# Stage keeping the channels of interest
+def pick_stage(raw, channels=CH_NAMES, exclude=()):
+    """
+    Pick the available channels of interest, leaving out the excluded ones.
 
-    # 2. Bandpass filter
-    raw.filter(l_freq=1, h_freq=50)
-    print("Applied bandpass filter: 1-50 Hz")
+    Parameters:
+    - raw (mne.io.Raw): The raw data object.
+    - channels (list): Channels of interest.
+    - exclude (list): Known bad channels to leave out.
 
-    # 3. Pick only available channels
-    available_channels = [ch for ch in ch_names if ch in raw.info['ch_names']]
+    Returns:
+    - mne.io.Raw: The data of the picked channels.
+    """
+    available_channels = [ch for ch in channels if ch in raw.info['ch_names'] and ch not in exclude]
     if not available_channels:
         raise ValueError("No channels from the desired list are available in this file.")
-    raw.pick_channels(available_channels)
+    if exclude:
+        print(f"Excluded channels: {list(exclude)}")
+    raw.pick(available_channels)
     print(f"Picked channels: {available_channels}")
+    return raw
+
+# Stage applying the montage
+def montage_stage(raw, montage='standard_1020'):
+    """
+    Set the electrode positions of a standard montage. Inside a batch context
+    the montage is only built once per batch.
 
-    # 4. Apply montage
-    montage = mne.channels.make_standard_montage('standard_1020')
-    raw.set_montage(montage)
+    Parameters:
+    - raw (mne.io.Raw): The raw data object.
+    - montage (str): Name of the standard montage.
+
+    Returns:
+    - mne.io.Raw: The data with the montage.
+    """
+    context = active_context()
+    raw.set_montage(context.montage(montage) if context else mne.channels.make_standard_montage(montage))
     print("Montage applied")
+    return raw
+
+# Stage running PyPREP
+def pyprep_stage(raw, line_freq=50, max_iterations=PREP_MAX_ITERATIONS, random_state=42):
+    """
+    Run PyPREP for bad channel detection/interpolation. The data is returned
+    unchanged if PyPREP fails.
+
+    Parameters:
+    - raw (mne.io.Raw): The raw data object, with a montage.
+    - line_freq (float): Frequency of the power line, removed with its harmonics.
+    - max_iterations (int): Maximum iterations of the robust reference.
+    - random_state (int): Seed of PyPREP's RANSAC.
 
-    # 5. Run PyPREP
+    Returns:
+    - mne.io.Raw: The data with the bad channels interpolated.
+    """
     prep_params = {
         "ref_chs": "eeg",
         "reref_chs": "eeg",
-        "line_freqs": np.arange(50, raw.info['sfreq'] / 2, 50),
-        "max_iterations": 8,
+        "line_freqs": np.arange(line_freq, raw.info['sfreq'] / 2, line_freq),
+        "max_iterations": max_iterations,
     }
     try:
-        prep_pipeline = PrepPipeline(raw, prep_params, raw.get_montage())
+        prep_pipeline = PrepPipeline(raw, prep_params, raw.get_montage(), random_state=random_state)
         prep_pipeline.fit()
         raw = prep_pipeline.raw.copy()
         print("PyPREP completed successfully")
@@ -97,29 +308,239 @@ def preprocess_raw(raw, exclude_channels=None):
     except OSError as e:
         print(f"PyPREP failed: {e}")
         print("Skipping PyPREP for this file")
+    return raw
+
+# Stage re-referencing to the average
+def reference_stage(raw):
+    """
+    Re-reference the data to the average, as a projection.
+
+    Parameters:
+    - raw (mne.io.Raw): The raw data object.
 
-    # 6. Re-reference to the average
+    Returns:
+    - mne.io.Raw: The re-referenced data.
+    """
     raw.set_eeg_reference('average', projection=True)
     print("Re-referenced to the average")
+    return raw
+
+# Function to fit an ICA on a subset of the recording
+def fit_ica(raw, n_components=ICA_N_COMPONENTS, method=ICA_METHOD, random_state=42, fit_samples=None,
+            fit_sampling='decimate', segment_duration=2.0):
+    """
+    Fit an ICA on the whole recording or on a subset of at most `fit_samples` samples.
 
-    # 7. ICA
+    The unmixing matrix does not depend on the order of the samples, so a
+    subset spread over the whole recording gives nearly the same components
+    at a fraction of the cost. The fitted ICA can then be applied to the full data.
+
+    Parameters:
+    - raw (mne.io.Raw): The raw data object.
+    - n_components (int or float): Number of components, or share of the variance they explain.
+    - method (str): ICA algorithm.
+    - random_state (int): Seed of the decomposition and of the random subset.
+    - fit_samples (int, optional): Budget of samples (per channel) used to fit. The whole recording if None.
+    - fit_sampling (str): 'decimate' keeps one sample out of every n, 'random' picks random segments.
+    - segment_duration (float): Length in seconds of the random segments.
+
+    Returns:
+    - mne.preprocessing.ICA: The fitted ICA.
+    """
+    if fit_sampling not in ('decimate', 'random'):
+        raise ValueError(f"Unknown fit_sampling '{fit_sampling}', use 'decimate' or 'random'")
+    ica = mne.preprocessing.ICA(n_components=n_components, method=method, random_state=random_state)
+
+    if fit_samples is None or fit_samples >= raw.n_times:
+        return ica.fit(raw)
+    if fit_sampling == 'decimate':
+        decim = int(np.ceil(raw.n_times / fit_samples))
+        print(f"Fitting ICA on one sample out of {decim}")
+        return ica.fit(raw, decim=decim)
+
+    # The segments are cut from the data array with one fancy index and concatenated into a single Raw
+    segment_length = max(1, int(round(segment_duration * raw.info['sfreq'])))
+    n_available = raw.n_times // segment_length
+    n_segments = max(1, min(n_available, fit_samples // segment_length))
+    rng = np.random.default_rng(random_state)
+    starts = np.sort(rng.choice(n_available, size=n_segments, replace=False)) * segment_length
+    data = raw.get_data()[:, (starts[:, None] + np.arange(segment_length)).ravel()]
+    print(f"Fitting ICA on {n_segments} random segments of {segment_duration} s")
+    return ica.fit(mne.io.RawArray(data, raw.info, verbose='error'))
+
+# Stage removing artifacts with ICA
+def ica_stage(raw, n_components=ICA_N_COMPONENTS, method=ICA_METHOD, random_state=42, fit_samples=ICA_FIT_SAMPLES,
+              fit_sampling='decimate'):
+    """
+    Fit an ICA (see `fit_ica`) and apply it to the full data to remove artifacts.
+    The data is returned unchanged if the ICA fails.
+
+    Parameters:
+    - raw (mne.io.Raw): The raw data object.
+    - n_components (int or float): Number of components, or share of the variance they explain.
+    - method (str): ICA algorithm.
+    - random_state (int): Seed of the decomposition.
+    - fit_samples (int, optional): Budget of samples used to fit. The whole recording if None.
+    - fit_sampling (str): How the samples are chosen, 'decimate' or 'random'.
+
+    Returns:
+    - mne.io.Raw: The data with the artifacts removed.
+    - dict: The fitted ICA under 'ica', None if it failed.
+    """
+    ica = None
     try:
-        ica = mne.preprocessing.ICA(n_components=0.99, method='fastica', random_state=42)
-        ica.fit(raw)
+        ica = fit_ica(raw, n_components, method, random_state, fit_samples, fit_sampling)
         print("ICA fit completed successfully")
         ica.apply(raw)
         print("ICA applied and artifacts removed")
     except Exception as e:
         print(f"ICA failed: {e}")
+    return raw, {"ica": ica}
+
+# Function to build the preprocessing pipeline
+def make_pipeline(exclude_channels=None, random_state=42, prep=True, ica=True, ica_fit_samples=ICA_FIT_SAMPLES,
+                  ica_fit_sampling='decimate', fused_resample=False):
+    """
+    Build the default preprocessing pipeline.
+    Stages:
+        1. Pick the channels of interest, so only they are resampled and filtered.
+        2. Resample to 128 Hz.
+        3. Bandpass filter (1-50 Hz).
+        4. Apply montage (10-20 system).
+        5. Run PyPREP for bad channel detection/interpolation (checkpoint).
+        6. Re-reference to the average.
+        7. Perform ICA for artifact removal (checkpoint).
+
+    Resampling and filtering work channel by channel, so picking the channels
+    first gives the same result as picking them afterwards. With fused_resample,
+    stages 2 and 3 are replaced by a single "resample_filter" stage.
+
+    Parameters:
+    - exclude_channels (list, optional): List of channels to exclude before processing.
+    - random_state (int, optional): Seed of PyPREP's RANSAC and of the ICA decomposition.
+    - prep (bool, optional): Include the PyPREP stage.
+    - ica (bool, optional): Include the ICA stage.
+    - ica_fit_samples (int, optional): Budget of samples used to fit the ICA, which is then applied to the
+      whole recording. The ICA is fitted on the whole recording if None.
+    - ica_fit_sampling (str, optional): How the samples are chosen, 'decimate' or 'random' (see `fit_ica`).
+    - fused_resample (bool, optional): Resample and filter in a single pass (see `resample_filter_stage`).
+
+    Returns:
+    - Pipeline: The stages, which can be removed, reordered or changed with the `Pipeline` methods.
+    """
+    if fused_resample:
+        resample_filter = [Stage("resample_filter", resample_filter_stage, sfreq=SFREQ, l_freq=L_FREQ, h_freq=H_FREQ)]
+    else:
+        resample_filter = [
+            Stage("resample", resample_stage, sfreq=SFREQ),
+            Stage("filter", filter_stage, l_freq=L_FREQ, h_freq=H_FREQ),
+        ]
+    pipeline = Pipeline([
+        Stage("pick_channels", pick_stage, channels=CH_NAMES, exclude=sorted(exclude_channels or [])),
+        *resample_filter,
+        Stage("montage", montage_stage, montage='standard_1020'),
+        Stage("pyprep", pyprep_stage, checkpoint=True, line_freq=50, max_iterations=PREP_MAX_ITERATIONS,
+              random_state=random_state),
+        Stage("reference", reference_stage),
+        Stage("ica", ica_stage, checkpoint=True, n_components=ICA_N_COMPONENTS, method=ICA_METHOD,
+              random_state=random_state, fit_samples=ica_fit_samples, fit_sampling=ica_fit_sampling),
+    ])
+    if not prep:
+        pipeline = pipeline.without("pyprep")
+    if not ica:
+        pipeline = pipeline.without("ica")
+    return pipeline
+
+# Function to preprocess a single raw file
+def preprocess_raw(raw, exclude_channels=None, random_state=42, profiler=None, pipeline=None, input_key=None,
+                   checkpoint_dir=None):
+    """
+    Preprocess an MNE Raw object with a pipeline (see `make_pipeline`) and
+    compute Welch's PSD of the result.
+
+    The wall/CPU time, memory and number of samples of every stage are recorded
+    and returned under 'metrics'.
+
+    Parameters:
+    - raw (mne.io.Raw or callable): The raw data object, or a function loading it, only called if no
+      checkpoint can be reused.
+    - exclude_channels (list, optional): List of channels to exclude before processing.
+    - random_state (int, optional): Seed of PyPREP's RANSAC and of the ICA decomposition, so the same file always gives the same result.
+    - profiler (StageProfiler, optional): Profiler recording the steps, e.g. to include the loading time.
+    - pipeline (Pipeline, optional): Stages to apply. The default pipeline built with `exclude_channels`
+      and `random_state` if None.
+    - input_key (str, optional): Key of the input data, e.g. the hash of the file, needed for checkpoints.
+    - checkpoint_dir (str, optional): Folder where the checkpoint stages save their output, so a later run
+      with the same input and the same stages up to a checkpoint resumes from it.
 
-    # 8. Welch's PSD
-    f, psd = welch(raw.get_data(), fs=raw.info['sfreq'], nperseg=1024)
+    Returns:
+        dict: Preprocessed data, PSD results, per-step metrics and the fitted ICA (None without ICA stage).
+    """
+    profiler = profiler or StageProfiler()
+    pipeline = pipeline or make_pipeline(exclude_channels, random_state)
+
+    outputs = {}
+    raw = pipeline.run(raw, input_key=input_key, checkpoint_dir=checkpoint_dir, profiler=profiler, outputs=outputs)
+
+    # Welch's PSD
+    with profiler.stage("welch") as record:
+        f, psd = welch_streaming(raw, nperseg=WELCH_NPERSEG)  # Same as scipy's welch, without copying the whole data
+        record["n_samples"] = raw.n_times * len(raw.ch_names)
     print("Welch's PSD computed")
 
-    return {"cleaned_raw": raw, "frequencies": f, "psd": psd}
+    return {
+        "cleaned_raw": raw,
+        "frequencies": f,
+        "psd": psd,
+        "metrics": profiler.records,
+        "ica": outputs.get("ica", {}).get("ica"),
+    }
+
+# Function to describe the preprocessing applied by preprocess_raw
+def preprocessing_config(exclude_channels=None, random_state=42, pipeline=None):
+    """
+    Describe every parameter that changes the output of `preprocess_raw`.
+
+    The description is used as part of the cache key, so a change in any of
+    these values (or in the MNE/PyPREP versions) invalidates the cached results.
+
+    Parameters:
+    - exclude_channels (list, optional): List of channels to exclude before processing.
+    - random_state (int, optional): Seed of PyPREP and of the ICA decomposition.
+    - pipeline (Pipeline, optional): Stages applied, the default pipeline if None.
+
+    Returns:
+        dict: JSON serializable preprocessing configuration.
+    """
+    pipeline = pipeline or make_pipeline(exclude_channels, random_state)
+    return {
+        "pipeline": pipeline.config(),
+        "welch_nperseg": WELCH_NPERSEG,
+        "versions": {"mne": mne.__version__, "pyprep": pyprep.__version__},
+    }
+
+# Function to describe a recording in the attributes of its HDF5 file
+def recording_attrs(file_name, ica=None):
+    """
+    Metadata of a preprocessed recording: measurement, condition and subject parsed from
+    the file name, and the components removed by the ICA.
+
+    Parameters:
+    - file_name (str): Name of the original file.
+    - ica (mne.preprocessing.ICA, optional): ICA applied to the recording.
+
+    Returns:
+    - dict: Attributes of the HDF5 file (see `phdtools.storage.write_recording`).
+    """
+    parsed = parse_file_name(file_name)
+    attrs = {'source_file': os.path.basename(file_name), 'measurement': parsed.measurement,
+             'condition': parsed.condition, 'subject': parsed.subject}
+    if ica is not None:
+        attrs['ica_exclude'] = [int(index) for index in ica.exclude]
+    return attrs
 
 # Function to save preprocessed data
-def save_preprocessed_data(raw, output_folder, file_name):
+def save_preprocessed_data(raw, output_folder, file_name, storage='fif', ica=None):
     """
     Save the preprocessed data to the specified output folder.
 
@@ -127,40 +548,447 @@ def save_preprocessed_data(raw, output_folder, file_name):
     - raw (mne.io.Raw): The preprocessed raw object.
     - output_folder (str): Folder to save the preprocessed file.
     - file_name (str): Name of the original file.
+    - storage (str, optional): 'fif', or 'hdf5' for compressed float32 samples chunked by time, with the
+      metadata in attributes, whose channels and time windows can be read separately (see `phdtools.storage`).
+      HDF5 needs h5py.
+    - ica (mne.preprocessing.ICA, optional): ICA applied, whose excluded components are stored in the HDF5 file.
+
+    Returns:
+    - str: Path of the saved file.
     """
+    if storage not in STORAGE_SUFFIXES:
+        raise ValueError(f"Unknown storage '{storage}', use one of {list(STORAGE_SUFFIXES)}")
     os.makedirs(output_folder, exist_ok=True)
-    output_path = os.path.join(output_folder, file_name.replace('.edf', '_raw.fif'))
-    raw.save(output_path, overwrite=True)
+    output_path = os.path.join(output_folder, file_name.replace('.edf', STORAGE_SUFFIXES[storage]))
+    if storage == 'hdf5':
+        save_raw(raw, output_path, recording_attrs(file_name, ica))
+    else:
+        raw.save(output_path, overwrite=True)
     print(f"Saved preprocessed data to: {output_path}")
+    return output_path
+
+# Function to read a preprocessed file of any storage format
+def read_preprocessed(output_path):
+    """
+    Read a file saved by `save_preprocessed_data`.
+
+    Returns:
+    - mne.io.Raw: The FIF file read lazily, or the HDF5 file loaded into memory.
+    """
+    if output_path.endswith(STORAGE_SUFFIXES['hdf5']):
+        return read_raw_hdf5(output_path)
+    return mne.io.read_raw_fif(output_path, preload=False)
+
+# Function to convert the FIF outputs of previous runs to HDF5
+def convert_preprocessed_folder(output_folder, remove_fif=False):
+    """
+    Convert every `_raw.fif` file of a folder to `_raw.h5`, with the ICA exclusions of its `_ica.fif`.
+
+    Parameters:
+    - output_folder (str): Folder of the preprocessed files.
+    - remove_fif (bool, optional): Remove each FIF file once converted.
+
+    Returns:
+    - list: Paths of the HDF5 files.
+    """
+    fif_files = sorted(file for file in os.listdir(output_folder) if file.endswith(STORAGE_SUFFIXES['fif']))
+    print(f"Found {len(fif_files)} FIF files.")
+    h5_paths = []
+    for file in fif_files:
+        fif_path = os.path.join(output_folder, file)
+        ica_path = fif_path.replace('_raw.fif', '_ica.fif')
+        file_name = file.replace(STORAGE_SUFFIXES['fif'], '.edf')
+        h5_path = convert_fif(fif_path, fif_path.replace('_raw.fif', '_raw.h5'), recording_attrs(file_name),
+                              ica_path=ica_path if os.path.exists(ica_path) else None)
+        print(f"Converted {fif_path} to {h5_path} ({os.path.getsize(h5_path) / os.path.getsize(fif_path):.0%} "
+              f"of the size)")
+        if remove_fif:
+            os.remove(fif_path)
+        h5_paths.append(h5_path)
+    return h5_paths
+
+# Function to save the fitted ICA next to the preprocessed data
+def save_ica(ica, output_folder, file_name):
+    """
+    Save a fitted ICA, so its components can be inspected or re-applied without refitting.
+
+    Parameters:
+    - ica (mne.preprocessing.ICA): The fitted ICA.
+    - output_folder (str): Folder of the preprocessed file.
+    - file_name (str): Name of the original file.
+
+    Returns:
+    - str: Path of the saved ICA, next to the preprocessed file.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    ica_path = os.path.join(output_folder, file_name.replace('.edf', '_ica.fif'))
+    ica.save(ica_path, overwrite=True)
+    print(f"Saved ICA to: {ica_path}")
+    return ica_path
+
+# Function to load the ICA saved with a preprocessed file
+def load_ica(output_path):
+    """
+    Load the ICA saved next to a preprocessed `_raw.fif` or `_raw.h5` file.
+
+    Parameters:
+    - output_path (str): Path of the preprocessed file.
+
+    Returns:
+    - mne.preprocessing.ICA: The fitted ICA, e.g. to plot its components or apply it to other data.
+    """
+    for suffix in STORAGE_SUFFIXES.values():
+        if output_path.endswith(suffix):
+            output_path = output_path[:-len(suffix)] + '_ica.fif'
+    return mne.preprocessing.read_ica(output_path)
+
+# Context manager limiting the threads used by BLAS/OpenMP in the worker processes
+@contextmanager
+def limited_threads_env(n_threads):
+    """
+    Temporarily set the BLAS/OpenMP thread environment variables.
+
+    Worker processes started inside the context inherit the limit, so a pool of
+    N workers uses N * n_threads cores instead of N * cpu_count.
+
+    Parameters:
+    - n_threads (int): Maximum number of threads per process.
+    """
+    previous = {var: os.environ.get(var) for var in THREAD_ENV_VARS}
+    os.environ.update({var: str(n_threads) for var in THREAD_ENV_VARS})
+    try:
+        yield
+    finally:
+        for var, value in previous.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+# Function to prepare the objects shared by every file of a batch
+def make_batch_context(pipeline, input_sfreq=None):
+    """
+    Build a batch context with the montage and the filter of a pipeline already computed.
+
+    Inside the context the montage is built, the filter of the "resample_filter" stage
+    designed and the PyPREP/MNE interpolation matrices computed once per channel layout
+    and sampling rate, instead of once per file. Only the objects of the stages in the
+    pipeline are computed.
+
+    Parameters:
+    - pipeline (Pipeline): Stages applied to the files.
+    - input_sfreq (float, optional): Sampling frequency of the files, at which the
+      "resample_filter" stage designs its filter. The filter is designed with the first file if None.
+
+    Returns:
+    - BatchContext: Context to activate around the batch, or to install in the workers.
+    """
+    context = BatchContext()
+    names = pipeline.names
+    if "resample_filter" in names and input_sfreq is not None:
+        params = pipeline["resample_filter"].params
+        factor = input_sfreq / params.get("sfreq", SFREQ)
+        # The other rates fall back to resample_stage and filter_stage
+        if factor > 1 and float(factor).is_integer():
+            context.filter(input_sfreq, params.get("l_freq", L_FREQ), params.get("h_freq", H_FREQ))
+    if "montage" in names:
+        context.montage(pipeline["montage"].params["montage"])
+    return context
+
+# Initializer of the worker processes
+def _init_worker(n_threads, context=None):
+    """
+    Limit the threads of the libraries already loaded in a worker process, and
+    install the batch context shared by all the files it processes.
+    """
+    os.environ.update({var: str(n_threads) for var in THREAD_ENV_VARS})
+    mne.set_log_level("WARNING")
+    if context is not None:
+        context.install()
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(limits=n_threads)
+
+# Function to load, preprocess and save a single file
+def process_file(file_path, output_folder, exclude_channels=None, random_state=42, lazy=False, pipeline=None,
+                 checkpoint_dir=None, prefetched=None, storage='fif'):
+    """
+    Load, preprocess and save a single EDF file, profiling every step.
+
+    Parameters:
+    - file_path (str): Path to the EDF file.
+    - output_folder (str): Folder to save the preprocessed file.
+    - exclude_channels (list, optional): List of channels to exclude before processing.
+    - random_state (int, optional): Seed of PyPREP and ICA.
+    - lazy (bool, optional): Read the file lazily (see `read_edf`).
+    - pipeline (Pipeline, optional): Stages to apply, the default pipeline if None.
+    - checkpoint_dir (str, optional): Folder of the stage checkpoints, keyed by the hash of the file.
+      The file is not read at all when the last stage can be loaded from a checkpoint.
+    - prefetched (mne.io.Raw or str, optional): Recording already read in the background, or path of a
+      local copy of the file to read instead of `file_path` (see `prefetch_edf_files`).
+    - storage (str, optional): Format of the preprocessed file, 'fif' or 'hdf5' (see `save_preprocessed_data`).
+
+    Returns:
+        dict: Result of `preprocess_raw`, with the paths of the saved data and ICA, and the load/save steps in
+        'metrics'.
+    """
+    profiler = StageProfiler()
+    read_path = prefetched if isinstance(prefetched, str) else file_path
+
+    def load():
+        with profiler.stage("load") as record:
+            if prefetched is None or isinstance(prefetched, str):
+                raw = read_edf(read_path, lazy=lazy, picks=CH_NAMES)
+            else:
+                raw = prefetched  # Only the time waiting for the background read is measured
+            record["n_samples"] = raw.n_times * len(raw.ch_names)
+        return raw
+
+    input_key = file_hash(read_path) if checkpoint_dir else None
+    result = preprocess_raw(load, exclude_channels, random_state=random_state, profiler=profiler,
+                            pipeline=pipeline, input_key=input_key, checkpoint_dir=checkpoint_dir)
+    with profiler.stage("save"):
+        result["output_path"] = save_preprocessed_data(
+            result["cleaned_raw"], output_folder, os.path.basename(file_path), storage=storage, ica=result["ica"]
+        )
+        result["ica_path"] = None
+        if result["ica"] is not None:
+            result["ica_path"] = save_ica(result["ica"], output_folder, os.path.basename(file_path))
+    return result
+
+# Function run by each worker process
+def _process_file(file_path, output_folder, exclude_channels, random_state, lazy=False, pipeline=None,
+                  checkpoint_dir=None, storage='fif'):
+    """
+    Process a single EDF file inside a worker process.
+
+    Returns:
+    - dict: PSD results, metrics and path of the saved file, or the traceback under 'error'.
+    """
+    try:
+        result = process_file(file_path, output_folder, exclude_channels, random_state, lazy, pipeline,
+                              checkpoint_dir, storage=storage)
+    except Exception:
+        return {"error": traceback.format_exc()}
+    # The cleaned data is read back from the saved file by the parent process
+    del result["cleaned_raw"]
+    return result
+
+# Function to report the files that could not be processed
+def report_failures(failures):
+    """
+    Print a summary of the files that failed during a batch.
+
+    Parameters:
+    - failures (dict): Error message for each failed file path.
+    """
+    if not failures:
+        return
+    print(f"{len(failures)} file(s) failed:")
+    for file_path, error in failures.items():
+        print(f"  - {file_path}: {error.strip().splitlines()[-1]}")
+
+# Function to reuse a cached preprocessing result
+def load_cached_result(entry, output_folder, file_name):
+    """
+    Copy a cached `_raw.fif` or `_raw.h5` (and `_ica.fif`) to the output folder and build its result.
+
+    Parameters:
+    - entry (dict): Cache entry returned by `ResultCache.get`.
+    - output_folder (str): Folder to save the preprocessed file.
+    - file_name (str): Name of the original file.
+
+    Returns:
+        dict: Preprocessed data and PSD results, as returned by `preprocess_raw`.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    suffix = STORAGE_SUFFIXES['hdf5'] if entry["raw_path"].endswith('.h5') else STORAGE_SUFFIXES['fif']
+    output_path = os.path.join(output_folder, file_name.replace('.edf', suffix))
+    shutil.copyfile(entry["raw_path"], output_path)
+    ica_path = None
+    if entry.get("ica_path"):
+        ica_path = output_path.replace(suffix, '_ica.fif')
+        shutil.copyfile(entry["ica_path"], ica_path)
+    print(f"Reused cached result for: {file_name}")
+    return {
+        "cleaned_raw": read_preprocessed(output_path),
+        "frequencies": entry["frequencies"],
+        "psd": entry["psd"],
+        "output_path": output_path,
+        "ica_path": ica_path,
+    }
 
 # Function to apply preprocessing to multiple files
-def apply_to_files(folder_path, keyword=None, exclude_channels=None):
+def apply_to_files(folder_path, keyword=None, exclude_channels=None, n_jobs=1, threads_per_worker=1,
+                   random_state=42, cache_dir=None, cache_size=50 * 1024**3, incremental=False, lazy=False,
+                   profile_path=None, pipeline=None, checkpoint_dir=None, shared_context=True, prefetch=0,
+                   prefetch_memory=None, scratch_dir=None, storage='fif'):
     """
     Apply preprocessing to all EDF files in a folder and save the results.
 
+    With n_jobs > 1 the files are spread over a pool of processes. Each worker
+    loads, preprocesses and saves its file, and the cleaned data is returned
+    as a Raw object reading the saved `.fif` lazily. A failing file is reported
+    and skipped without stopping the rest of the batch.
+
+    With a cache directory, files whose content and preprocessing configuration
+    did not change since a previous run are not preprocessed again: the cached
+    `_raw.fif` is copied to the output folder instead.
+
+    In incremental mode, a manifest in the output folder records the size,
+    modification time and hash of every processed file. Only new or modified
+    files are preprocessed (and returned), and the outputs of files that were
+    modified or removed from the folder are deleted.
+
     Parameters:
     - folder_path (str): Path to the folder containing EDF files.
     - keyword (str, optional): Filter files by keyword.
     - exclude_channels (list, optional): List of channels to exclude before processing.
+    - n_jobs (int, optional): Number of worker processes. 1 runs in this process, -1 uses all the cores.
+    - threads_per_worker (int, optional): BLAS/OpenMP threads allowed in each worker.
+    - random_state (int, optional): Seed of PyPREP and ICA for every file.
+    - cache_dir (str, optional): Directory of the result cache. No cache is used if None.
+    - cache_size (int, optional): Maximum size of the cache in bytes.
+    - incremental (bool, optional): Only process the files added or modified since the last run.
+    - lazy (bool, optional): Read only the channels of interest into memory-mapped files, so more
+      workers fit in the same RAM (see `read_edf`).
+    - profile_path (str, optional): JSON lines file where the time and memory of every step of every
+      preprocessed file are appended. Aggregate it with `phdtools.profiling.summarize_profile`.
+    - pipeline (Pipeline, optional): Stages to apply, e.g. `make_pipeline(prep=False)` for a study without
+      PyPREP. The default pipeline built with `exclude_channels` and `random_state` if None.
+    - checkpoint_dir (str, optional): Folder where the checkpoint stages (PyPREP and ICA by default) save
+      their output. A later run only reruns the stages from the first one whose parameters changed.
+    - shared_context (bool, optional): Build the montage, design the filter and compute the interpolation
+      matrices once per channel layout for the whole batch, including in the worker processes
+      (see `make_batch_context`).
+    - prefetch (int, optional): With n_jobs = 1, number of files read in the background while the current
+      one is preprocessed, so slow disk reads overlap with the preprocessing. 0 reads each file when needed.
+    - prefetch_memory (int, optional): Bytes allowed for the prefetched files (see `prefetch_edf_files`).
+    - scratch_dir (str, optional): Local folder where the prefetched files are copied, instead of being
+      read into memory.
+    - storage (str, optional): Format of the preprocessed files, 'fif' or 'hdf5' (see `save_preprocessed_data`).
 
     Returns:
         dict: Results of preprocessing for each file.
     """
     output_folder = os.path.join(folder_path, "filtered_data")  # Create subfolder for filtered data
+    pipeline = pipeline or make_pipeline(exclude_channels, random_state)
+    edf_files = list_edf_files(folder_path, keyword)
+    print(f"Found {len(edf_files)} EDF files.")
     results = {}
-    for raw, file_path in load_edf_files(folder_path, keyword):
-        print(f"Preprocessing file: {file_path}")
-        try:
-            result = preprocess_raw(raw, exclude_channels)
-            results[file_path] = result
+    failures = {}
+
+    # Skip the files processed in a previous run
+    manifest = None
+    if incremental:
+        manifest = Manifest(os.path.join(output_folder, "manifest.json"))
+        for output in manifest.remove_stale_outputs(edf_files):
+            print(f"Removed stale output: {output}")
+        edf_files = manifest.changed(edf_files)
+        manifest.save()
+        print(f"{len(edf_files)} new or modified files.")
+
+    def store(file_path, result, cached=False):
+        results[file_path] = result
+        if profile_path is not None and "metrics" in result:
+            write_profile(profile_path, result["metrics"], file=file_path)
+        if cache is not None and not cached:
+            cache.put(cache_keys[file_path], result["output_path"], result["frequencies"], result["psd"],
+                      source=file_path, ica_path=result["ica_path"])
+        if manifest is not None:
+            manifest.record(file_path, [path for path in (result["output_path"], result["ica_path"]) if path])
+            manifest.save()
+
+    # Look up the files already preprocessed with the same configuration
+    cache = ResultCache(cache_dir, max_size=cache_size) if cache_dir else None
+    cache_keys = {}
+    pending = edf_files
+    if cache is not None:
+        config = preprocessing_config(pipeline=pipeline)
+        if storage != 'fif':
+            config["storage"] = storage  # The FIF results cached before keep their keys
+        pending = []
+        for file_path in edf_files:
+            cache_keys[file_path] = cache.make_key(file_path, config)
+            entry = cache.get(cache_keys[file_path])
+            if entry is None:
+                pending.append(file_path)
+            else:
+                store(file_path, load_cached_result(entry, output_folder, os.path.basename(file_path)), cached=True)
+        cache.flush()  # The index is written once for all the lookups
+        print(f"{len(edf_files) - len(pending)} files found in the cache, {len(pending)} to preprocess.")
+
+    context = None
+    if shared_context and pending:
+        input_sfreq = None
+        if "resample_filter" in pipeline.names:
+            # The rate of the first file, read from its header. A file that cannot be read is reported below.
+            try:
+                input_sfreq = mne.io.read_raw_edf(pending[0], preload=False, verbose='error').info['sfreq']
+            except Exception:
+                pass
+        context = make_batch_context(pipeline, input_sfreq)
+
+    if n_jobs == 1:
+        prefetcher = None
+        if prefetch and pending:
+            prefetcher = prefetch_edf_files(pending, lazy=lazy, depth=prefetch, max_bytes=prefetch_memory,
+                                            scratch_dir=scratch_dir)
+        files = prefetcher if prefetcher else ((file_path, None, None) for file_path in pending)
+        with context.activate() if context else nullcontext(), prefetcher or nullcontext():
+            for idx, (file_path, prefetched, error) in enumerate(files, start=1):
+                print(f"[{idx}/{len(pending)}] Preprocessing file: {file_path}")
+                try:
+                    if error is not None:
+                        raise error
+                    store(file_path, process_file(file_path, output_folder, lazy=lazy, pipeline=pipeline,
+                                                  checkpoint_dir=checkpoint_dir, prefetched=prefetched,
+                                                  storage=storage))
+                except Exception as e:
+                    print(f"Error processing file {file_path}: {e}")
+                    failures[file_path] = traceback.format_exc()
+
+    elif pending:
+        if n_jobs is None or n_jobs < 1:
+            n_jobs = max(1, (os.cpu_count() or 1) // threads_per_worker)
+        n_jobs = min(n_jobs, len(pending))
+        print(f"Preprocessing {len(pending)} files with {n_jobs} workers.")
+
+        # Spawned workers inherit the thread limits from the environment
+        with limited_threads_env(threads_per_worker):
+            with ProcessPoolExecutor(
+                max_workers=n_jobs,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(threads_per_worker, context),
+            ) as executor:
+                futures = {
+                    executor.submit(_process_file, file_path, output_folder, exclude_channels, random_state, lazy,
+                                    pipeline, checkpoint_dir, storage): file_path
+                    for file_path in pending
+                }
+                for idx, future in enumerate(as_completed(futures), start=1):
+                    file_path = futures[future]
+                    try:
+                        result = future.result()
+                    except Exception:
+                        # The worker died (e.g. out of memory) before returning
+                        result = {"error": traceback.format_exc()}
+
+                    if "error" in result:
+                        print(f"[{idx}/{len(pending)}] Error processing file {file_path}")
+                        failures[file_path] = result["error"]
+                        continue
 
-            # Save the preprocessed data
-            file_name = os.path.basename(file_path)
-            save_preprocessed_data(result["cleaned_raw"], output_folder, file_name)
-        except Exception as e:
-            print(f"Error processing file {file_path}: {e}")
+                    print(f"[{idx}/{len(pending)}] Preprocessed file: {file_path}")
+                    result["cleaned_raw"] = read_preprocessed(result["output_path"])
+                    store(file_path, result)
 
-    return results
+    report_failures(failures)
+    # Keep the order of the files, independently of the completion order
+    return {file_path: results[file_path] for file_path in edf_files if file_path in results}
 
 # Function to plot Welch's PSD
 def plot_psd(psd_data, freqs, title="Power Spectral Density"):
@@ -186,9 +1014,14 @@ if __name__ == "__main__":
     folder_path = "/Users/rosaayusomoreno/Desktop/phdtools/data"  # Change to your folder path
     keyword = "EPOC"  # Filter by keyword or set to None to load all files
     exclude_channels = []  # Add any known bad channels, e.g., ['T7', 'T8']
+    n_jobs = 1  # Number of worker processes, -1 to use all the cores
+    cache_dir = None  # Folder to reuse results between runs, e.g. os.path.join(folder_path, "cache")
+    checkpoint_dir = None  # Folder to resume from the PyPREP/ICA outputs, e.g. os.path.join(folder_path, "checkpoints")
+    pipeline = make_pipeline(exclude_channels)  # e.g. make_pipeline(exclude_channels, prep=False) to skip PyPREP
 
     # Apply preprocessing to all files
-    results = apply_to_files(folder_path, keyword, exclude_channels)
+    results = apply_to_files(folder_path, keyword, exclude_channels, n_jobs=n_jobs, cache_dir=cache_dir,
+                             pipeline=pipeline, checkpoint_dir=checkpoint_dir)
 
     # Handle results
     for file_path, result in results.items():
@@ -1,4 +1,5 @@
-
+from phdtools.executor import apply_to_raw
+from phdtools.index import build_dataframe_with_paths
 
 # The data is here
 root_path = "/Volumes/MENTALFIT/MENTALFIT/ESTUDIO 2/3.BD_Análisis/CASCO EEG MENTALFIT TODO"
@@ -8,18 +9,16 @@ df = build_dataframe_with_paths(root_path)
 """
 df is:
 
-identifier | Gender | Centre | title | sampling_rate | channels | headset | path
------------+--------+--------+---------------+----------+---------+-------}
-01         | XX     | C1      |"titl" |                                     root_path + path_to_edf_01
-02         | XX     | C1      |"titl" |                                     root_path + path_to_edf_02
-03         | XX     | C1      |"titl" |                                     root_path + path_to_edf_03
-04         | XX     | C1      |"titl" |                                     root_path + path_to_edf_04
+path                       | file  | measurement | centre  | centre_id | condition | subject | headset | sampling_rate | channels | duration
+---------------------------+-------+-------------+---------+-----------+-----------+---------+---------+---------------+----------+---------
+root_path + path_to_edf_01 | "..." | M1          | QUERCUS | 1         | OA        | ...     | EPOC    | 128           | AF3,...  | 300
+root_path + path_to_edf_02 | "..." | M1          | QUERCUS | 1         | OC        | ...     | EPOC    | 128           | AF3,...  | 300
 ...
 
 """
 
 # filter the dataframe with all files
-df_ = df[ df["sampling_rate"] == 128 & df["Centre"] == "C1" ]
+df_ = df[ (df["sampling_rate"] == 128) & (df["centre_id"] == 1) ]
 
 # get path files
 paths_to_edf = df_["path"]
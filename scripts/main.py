@@ -9,15 +9,13 @@ new_directory = os.path.join(directory, "renamed")
 files = os.listdir(directory)
 
 
-from phdtools.filetools import rename_and_copy
+from phdtools.filetools import bulk_rename_and_copy
 
 
-for i, each_file in enumerate(files):
-    if "M2" not in each_file and "M1" not in each_file:
-        continue
-        # raise Exception(f"Error in file '{each_file}'")
+# Only the files of the measurements M1 and M2
+files = [each_file for each_file in files if "M2" in each_file or "M1" in each_file]
 
-
-    rename_and_copy(each_file, directory, new_directory=new_directory)
+# Plan every new name first, then copy concurrently (resumes if interrupted)
+bulk_rename_and_copy(files, directory, new_directory=new_directory)
 
 print("Done")
@@ -1,18 +1,16 @@
+import json
 import os
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 import mne
-from matplotlib.animation import FuncAnimation
 
-# Define frequency bands
-BANDS = {
-    'Delta': [0.5, 4],
-    'Theta': [4, 8],
-    'Alpha': [8, 12],
-    'Beta': [12, 30],
-    'Gamma': [30, 50]
-}
+from phdtools.bandpower import BANDS, band_means
+from phdtools.topomap import TopomapRenderer
+
+# Head sphere of the topomaps (origin and radius in metres)
+SPHERE = (0.00, 0.0, 0.0, 0.09)  # Adjust head size
 
 # Function to load EEG data from CSV files
 def load_csv_files(folder_path, file_list, electrodes):
@@ -46,6 +44,104 @@ def load_csv_files(folder_path, file_list, electrodes):
             print(f"Error loading file {file_name}: {e}")
     return data
 
+# Function to read one band table with typed columns and a fixed electrode order
+def read_band_table(file_path, electrodes, bands=None):
+    """
+    Read the band powers of one subject as a float32 (electrodes × bands) array.
+
+    Parameters:
+    - file_path (str): Path of the CSV file, one row per electrode and one column per band.
+    - electrodes (list): Electrode names, in the order of the rows of the result.
+    - bands (list, optional): Band columns to read, in order. All the columns by default.
+
+    Returns:
+    - tuple: Array with shape (electrodes, bands) and the list of band names.
+    """
+    if bands is None:
+        bands = list(pd.read_csv(file_path, index_col=0, nrows=0).columns)
+    index_name = pd.read_csv(file_path, nrows=0).columns[0]
+    dtypes = {band: np.float32 for band in bands}
+    dtypes[index_name] = str
+    table = pd.read_csv(file_path, index_col=0, usecols=[index_name, *bands], dtype=dtypes)
+    table = table.drop('ECG_artificial', axis=0, errors='ignore')
+
+    missing = [electrode for electrode in electrodes if electrode not in table.index]
+    extra = [electrode for electrode in table.index if electrode not in electrodes]
+    if missing or extra or table.index.duplicated().any():
+        raise ValueError(f"Electrodes do not match, missing {missing}, unexpected {extra}")
+    return table.loc[electrodes, bands].to_numpy(dtype=np.float32), list(bands)
+
+# Function to load many band tables into one array, with an on-disk cache
+def load_band_tables(folder_path, file_list, electrodes, bands=None, n_jobs=8, cache_path=None):
+    """
+    Load the band tables of many subjects into a single (subjects × electrodes × bands) array.
+
+    The files are parsed concurrently. With a cache path the array is saved as
+    a .npy file, with a .json file describing its rows, and later runs memory-map
+    it instead of parsing the CSV files while the files are unchanged.
+
+    Parameters:
+    - folder_path (str): Path to the folder containing the CSV files.
+    - file_list (list): List of CSV file names to load.
+    - electrodes (list): Electrode names, in the order of the second axis.
+    - bands (list, optional): Band columns, in the order of the third axis. Taken from the first file by default.
+    - n_jobs (int): Number of threads reading files.
+    - cache_path (str, optional): Path of the .npy cache.
+
+    Returns:
+    - tuple: Array (read-only memmap when cached), list of the loaded file names and list of band names.
+    """
+    paths = [os.path.join(folder_path, file_name) for file_name in file_list]
+    found = [(file_name, path) for file_name, path in zip(file_list, paths) if os.path.exists(path)]
+    for file_name, path in zip(file_list, paths):
+        if not os.path.exists(path):
+            print(f"File not found: {path}")
+
+    # The cache is valid for the same files (size and modification time), electrodes and bands
+    signature = {
+        "files": [[file_name, os.stat(path).st_size, os.stat(path).st_mtime_ns] for file_name, path in found],
+        "electrodes": list(electrodes),
+        "bands": list(bands) if bands is not None else None,
+    }
+    meta_path = os.path.splitext(cache_path)[0] + ".json" if cache_path else None
+    if cache_path and os.path.exists(cache_path) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta["signature"] == signature:
+            print(f"Band tables loaded from cache: {cache_path}")
+            return np.load(cache_path, mmap_mode='r'), meta["loaded"], meta["bands"]
+
+    if bands is None and found:
+        bands = list(pd.read_csv(found[0][1], index_col=0, nrows=0).columns)
+    bands = list(bands or [])
+
+    def read(item):
+        file_name, path = item
+        try:
+            return file_name, read_band_table(path, electrodes, bands)[0]
+        except Exception as e:
+            print(f"Error loading file {file_name}: {e}")
+            return file_name, None
+
+    tables, loaded = [], []
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        for file_name, table in executor.map(read, found):
+            if table is not None:
+                tables.append(table)
+                loaded.append(file_name)
+                print(f"File loaded: {file_name}")
+
+    data = np.stack(tables) if tables else np.empty((0, len(electrodes), len(bands)), dtype=np.float32)
+
+    if cache_path:
+        temp_path = cache_path + ".part.npy"
+        np.save(temp_path, data)
+        os.replace(temp_path, cache_path)
+        with open(meta_path, "w") as f:
+            json.dump({"signature": signature, "loaded": loaded, "bands": bands}, f, indent=2)
+        data = np.load(cache_path, mmap_mode='r')
+    return data, loaded, bands
+
 # Function to create EEG info structure
 def create_eeg_info(electrodes, sfreq=256):
     """
@@ -79,59 +175,54 @@ def compute_band_powers(raw, bands):
     freqs = psds.freqs
     psd_data = psds.get_data()
 
-    band_powers = {}
-    for band, (fmin, fmax) in bands.items():
-        idx_band = np.logical_and(freqs >= fmin, freqs <= fmax)
-        band_power = np.mean(psd_data[:, idx_band], axis=1)
-        band_powers[band] = band_power
-    return band_powers
+    band_power = band_means(psd_data, freqs, bands)  # Shape: channels × bands
+    return {band: band_power[:, idx_band] for idx_band, band in enumerate(bands)}
 
 # Function to generate topographic maps
-def plot_topomaps(band_powers, info, output_folder, prefix=""):
+def plot_topomaps(band_powers, info, output_folder, prefix="", renderer=None, dpi=300):
     """
     Generate topographic maps for each frequency band.
 
+    The interpolation grid is computed once for the channel layout and the same
+    figure is reused for every band, only its image data is replaced.
+
     Parameters:
     - band_powers (dict): Band powers for each frequency band.
     - info (mne.Info): EEG Info object.
     - output_folder (str): Folder to save the images.
     - prefix (str): Prefix for image file names.
+    - renderer (TopomapRenderer, optional): Renderer of the layout, to share it between files.
+    - dpi (int): Resolution of the images.
     """
+    renderer = renderer or TopomapRenderer(info, sphere=SPHERE)
     for band, power in band_powers.items():
-        fig, ax = plt.subplots(figsize=(6, 6))
-        mne.viz.plot_topomap(
-            power, info, axes=ax, show=False, cmap='viridis', 
-            sphere=(0.00, 0.0, 0.0, 0.09)  # Adjust head size
-        )
-        ax.set_title(f"{band} band")
         image_path = os.path.join(output_folder, f"{prefix}_{band}.png")
-        plt.tight_layout()
-        plt.savefig(image_path, dpi=300)
-        plt.close()
+        renderer.save(power, image_path, title=f"{band} band", dpi=dpi)
         print(f"Saved topomap: {image_path}")
 
 # Function to create EEG activation animation
-def create_activation_animation(raw, output_file):
+def create_activation_animation(raw, output_file, step=1000, fps=10, n_jobs=1, renderer=None, dpi=100):
     """
     Create an EEG activation animation over time.
 
+    The samples of all the frames are read at once, the maps are interpolated
+    with one matrix product and the frames are rendered in parallel and streamed
+    to the output file.
+
     Parameters:
     - raw (mne.io.Raw): Preprocessed EEG data.
-    - output_file (str): Path to save the animation (GIF or MP4).
+    - output_file (str): Path to save the animation (GIF, or MP4 and other formats with ffmpeg).
+    - step (int): Samples between consecutive frames.
+    - fps (int): Frames per second of the animation.
+    - n_jobs (int): Processes rendering the frames, -1 to use all the cores.
+    - renderer (TopomapRenderer, optional): Renderer of the layout, to share it between files.
+    - dpi (int): Resolution of the frames.
     """
-    times = np.arange(0, len(raw.times), 1000)  # Adjust step size for time
-    fig, ax = plt.subplots()
-
-    def update_topomap(frame):
-        ax.clear()
-        time = raw.times[frame]
-        data = raw.copy().crop(tmin=time, tmax=time + 1/raw.info['sfreq']).get_data()
-        mne.viz.plot_topomap(data[:, 0], raw.info, axes=ax, show=False, cmap='viridis')
-        ax.set_title(f'Time: {time:.2f} s')
-
-    anim = FuncAnimation(fig, update_topomap, frames=times, interval=200, repeat=False)
-    anim.save(output_file, writer='imagemagick', fps=10)
-    plt.show()
+    renderer = renderer or TopomapRenderer(raw.info, sphere=SPHERE)
+    samples = np.arange(0, len(raw.times), step)  # Adjust step size for time
+    data = raw.get_data()[:, samples]
+    titles = [f'Time: {time:.2f} s' for time in raw.times[samples]]
+    renderer.animate(data, output_file, fps=fps, titles=titles, dpi=dpi, n_jobs=n_jobs)
     print(f"Animation saved: {output_file}")
 
 # Main execution
@@ -143,23 +234,15 @@ if __name__ == "__main__":
     electrodes = ['AF3', 'F7', 'F3', 'FC5', 'T7', 'P7', 'O1', 
                   'O2', 'P8', 'T8', 'FC6', 'F4', 'F8', 'AF4']
 
-    # Load data
-    eeg_data = load_csv_files(data_folder, file_list, electrodes)
+    # Load data (parsed once, memory-mapped from the cache on reruns)
+    cache_path = os.path.join(output_folder, "band_tables.npy")
+    band_tables, loaded_files, bands = load_band_tables(data_folder, file_list, electrodes, cache_path=cache_path)
 
     # Create EEG info
     info = create_eeg_info(electrodes)
+    renderer = TopomapRenderer(info, sphere=SPHERE)  # Shared by all the files
 
-    # Process each file
-    for file_name, data in eeg_data.items():
-        # Create RawArray for processing
-        raw = mne.io.RawArray(data.values.T, info)
-
-        # Compute band powers
-        band_powers = compute_band_powers(raw, BANDS)
-
-        # Generate topomaps
-        plot_topomaps(band_powers, info, output_folder, prefix=file_name)
-
-        # Create animation (optional)
-        animation_file = os.path.join(output_folder, f"{file_name}_animation.gif")
-        create_activation_animation(raw, animation_file)
+    # Generate the topomaps of each file from its band powers
+    for file_name, table in zip(loaded_files, band_tables):
+        band_powers = {band: table[:, idx_band] for idx_band, band in enumerate(bands)}
+        plot_topomaps(band_powers, info, output_folder, prefix=file_name, renderer=renderer)
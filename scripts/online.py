@@ -0,0 +1,93 @@
+import time
+
+import mne
+import numpy as np
+
+from analysis import bands
+from filters import CH_NAMES, H_FREQ, L_FREQ, SFREQ
+from phdtools.online import OnlineBandPower
+
+# Seconds of signal in each chunk sent by the source
+CHUNK_DURATION = 1 / 16
+
+# Source replaying an EDF file as if it was recorded live
+class EDFReplaySource:
+    """
+    Replay the channels of an EDF file in chunks, at real-time speed.
+
+    Any iterable yielding (chunk, timestamp) pairs can be used as a source instead,
+    e.g. a reader of the headset stream.
+
+    Parameters:
+    - file_path (str): Path to the EDF file.
+    - ch_names (list): Channels to stream, in order.
+    - chunk_duration (float): Seconds of signal in each chunk.
+    - speed (float): Replay speed, 1 for real time. 0 sends the chunks as fast as possible.
+    """
+    def __init__(self, file_path, ch_names=CH_NAMES, chunk_duration=CHUNK_DURATION, speed=1.0):
+        raw = mne.io.read_raw_edf(file_path, preload=False, verbose='error')
+        raw.pick([ch for ch in ch_names if ch in raw.ch_names])
+        self.ch_names = raw.ch_names
+        self.sfreq = raw.info['sfreq']
+        self.data = raw.get_data()
+        self.chunk_size = max(1, int(round(chunk_duration * self.sfreq)))
+        self.speed = speed
+
+    def __iter__(self):
+        """
+        Yield the chunks when they would have been recorded.
+
+        Yields:
+        - np.ndarray: Samples with shape (channels, chunk_size).
+        - float: Arrival time of the chunk (`time.perf_counter`).
+        """
+        start = time.perf_counter()
+        for stop in range(self.chunk_size, self.data.shape[1] + 1, self.chunk_size):
+            if self.speed:
+                # Wait until the last sample of the chunk has been "recorded"
+                delay = start + stop / self.sfreq / self.speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            yield self.data[:, stop - self.chunk_size:stop], time.perf_counter()
+
+# Function to show the band power of a stream while it is recorded
+def run_online(source, update_interval=0.25, window=4.0, notch=50, on_update=None, verbose=True):
+    """
+    Compute the band power of a live stream, with the offline channels, bands and filter band.
+
+    Parameters:
+    - source (EDFReplaySource or iterable): Source of (chunk, timestamp) pairs with `sfreq` and `ch_names`.
+    - update_interval (float): Seconds between band power updates.
+    - window (float): Seconds of signal in each Welch estimate.
+    - notch (float, optional): Line frequency removed, None to keep it.
+    - on_update (callable, optional): Function called with each update (see `OnlineBandPower.push`).
+    - verbose (bool): Print the mean band power of every update.
+
+    Returns:
+    - dict: Latency statistics of the updates in milliseconds.
+    """
+    decimation = max(1, int(round(source.sfreq / SFREQ)))  # As the offline resampling
+    online = OnlineBandPower(source.sfreq, source.ch_names, bands=bands, window=window,
+                             update_interval=update_interval, l_freq=L_FREQ, h_freq=H_FREQ, notch=notch,
+                             decimation=decimation)
+
+    for chunk, timestamp in source:
+        for update in online.push(chunk, timestamp):
+            if on_update is not None:
+                on_update(update)
+            if verbose:
+                powers = ", ".join(f"{band}: {10 * np.log10(power):.1f} dB"
+                                   for band, power in zip(bands, update["band_power"].mean(axis=0)))
+                print(f"t = {update['time']:7.2f} s | {powers} | {update['latency'] * 1000:.2f} ms")
+
+    stats = online.latency.summary()
+    print(f"Latency of {stats['n_updates']} updates: " +
+          ", ".join(f"{name} {value:.3f}" for name, value in stats.items() if name != "n_updates"))
+    return stats
+
+# Main execution
+if __name__ == "__main__":
+    edf_file = "/path/to/recording.edf"
+
+    # Replay the recording at real-time speed, updating the band power every 250 ms
+    run_online(EDFReplaySource(edf_file), update_interval=0.25)
@@ -1,92 +1,56 @@
 import os
-import pandas as pd
-import re
-from unidecode import unidecode
+from functools import lru_cache
 
-excel_path = "doc/BD_FITBIT_FE_MentalFit.xlsx"
-codes = pd.read_excel(excel_path)
-
-CENTRO = "Centro"
-CODIGO = "CODIGO"
-GENERO = "Genero"
-FITBIT = "FITBIT"
-COLUMNS = [CENTRO, CODIGO, GENERO, FITBIT]
-
-codes = codes[COLUMNS]
-
-CONDICIONES = ["OA", "OC", "STROOP", "PASAT", "PVTB", "MSIT", "PVSAT", "PVT-B", "PVT"]
-
-CENTROS = {
-    "ALBALAT": 8,
-    "QUERCUS" : 1,
-    "PUEBLA" : 2, # "ENRIQUE DÍEZ CANDO"
-    "EMÉRITA AUGUSTA" : 3,
-    "SAGRADO CORAZÓN MIAJADAS" : 4,
-    "SALESIANOS BADAJOZ" : 5,
-    "SANTA EULALIA MÉRIDA" : 6,
-    "NUESTRA SEÑORA DOLORES GUAREÑA" : 7,
-    "ALBALAT" : 8,
-}
-
-CENTROS = {unidecode(key): value for key, value in CENTROS.items()}
-
-NEW_CENTROS = {}
-for key, value in CENTROS.items:
-    NEW_CENTROS[unidecode(key)] = value
+from phdtools.index import build_dataframe_with_paths
+from phdtools.parser import CENTRES, centre_matches, parse_file_name
+from phdtools.subjects import SubjectIndex, read_codes
 
+excel_path = "doc/BD_FITBIT_FE_MentalFit.xlsx"
 
-def find_in_dict(key, dictionary):
-    # 
-    matches = [key_ for key_ in dictionary if key in key_ ]
+# The Excel file is parsed once and cached as Parquet, the codes are indexed by centre
+codes = read_codes(excel_path)
+subjects = SubjectIndex(codes)
 
+# Function to find the centre whose name contains a folder name
+def find_centre_key(name):
+    """
+    Find the centre of a folder name, e.g. "M1 Emérita Augusta".
 
-    key = "AUGUSTA"
+    Parameters:
+    - name (str): Folder name, with or without accents and measurement prefix.
 
-    matches = []
-    for key_ in dictionary:
-        if key in key_:
-            matches.append(key_)
+    Returns:
+    - str: Key of the centre in CENTRES, or None if no centre matches.
+    """
+    matches = centre_matches(name)
 
     if not any(matches):
         return None
     if len(matches) > 1:
         raise Exception("More than one match found")
-    
-    return matches[0]
-
 
-def _starts_with_condition(file_name):    
-    conditions = []
-    for each in CONDICIONES:
-        if file_name.startswith(each):
-            conditions.append(each)
-    return conditions
+    return matches[0]
 
 
 def check_beginning_is_correct(file_name):
-    conditions = _starts_with_condition(file_name)
-    if len(conditions) != 1:
-        raise f"File does not have a valid condition: {conditions}"
+    if parse_file_name(file_name).condition is None:
+        raise Exception(f"File does not have a valid condition: {file_name}")
 
 def get_condition(file_name):
-    conditions = _starts_with_condition(file_name)
-    return conditions[0]
+    return parse_file_name(file_name).condition
 
 
+@lru_cache(maxsize=None)
 def get_centre_id(root):
     centre = root.split("/")[-2]
-    if centre.startswith("M1") or centre.startswith("M2"):
-        centre = centre[2:]
-
-    centre = unidecode(centre.strip())
-    key = find_in_dict(centre, CENTROS)
+    key = find_centre_key(centre)
     if key is None:
         raise Exception(f"No key found for: {centre}")
 
-    return CENTROS[key]
+    return CENTRES[key]
 
-def get_user_id(file_name, condition):
-    file_short = file_[len(condition):]
+def get_user_id(file_name, condition, centre_id):
+    file_short = file_name[len(condition):]
 
     # Check separator
     if file_short[0] not in ["_", " "]:
@@ -102,67 +66,45 @@ def get_user_id(file_name, condition):
     else:
         # the name has four letters
         name = file_short[:4]
-    
-    # Filter codes by name
-    code_ = codes[codes["CODIGO"].str.startswith(name)]
-    if code_.shape[0] > 1:
-        print(f"There are more than one user with that begining {name}")
-
-    # Obtaining the center name
-    centre_id = get_centre_id(root)
-
-    # Filter by centre
-    codigo = code_[code_[CENTRO] == centre_id]
-
-    if len(codigo) != 1:
-        raise Exception(f"Error filtering user for code {codigo}.\n{code_.head()}")
 
-    year = re.match(r".*(2\d+)", codigo)
-    if not year:
-        year = "2024"
+    # Codes of the centre starting with the name
+    matches = subjects.lookup(name, centre_id)
 
-    gender = codigo[GENERO]
-    fitbit = codigo[FITBIT]
+    if len(matches) != 1:
+        raise Exception(f"Error filtering user for code {name} in centre {centre_id}: {matches}")
 
-    return codigo, year, gender, fitbit
+    subject = matches[0]
+    return subject.code, subject.year, subject.gender, subject.fitbit
 
 root_path = "/Volumes/MENTALFIT/MENTALFIT/ESTUDIO 2/3.BD_Análisis/CASCO EEG MENTALFIT TODO"
 # root_path = "/Users/german.ayuso/Desktop/Desktop/Mentalfit"
 
-for root, subFolder, files in os.walk(root_path):
-    if not files:
-        # We are reading a directory, hence continue
-        continue
+# SQLite index of the tree, kept out of the (read-only) data drive. None uses the user cache folder.
+index_path = None  # e.g. "edf_index.sqlite" in the working directory
 
-    for file in files:
+# Index of the EDF files in the tree, only new or modified files are read again
+files_df = build_dataframe_with_paths(root_path, index_path=index_path)
 
-        if ".DS_Store" in file:
-            continue
+# Analysing the files in the "M1" directory only
+for file_path in files_df.loc[files_df["measurement"] == "M1", "path"]:
+    root, file = os.path.split(file_path)
 
-        # Obtain MX directoy
-        MX = root.replace(root_path+"/", "").split("/")[0]
+    print(f"\nAnalysing file: {file_path}")
 
-        # Skip the file if not in "M1" directory
-        if MX != "M1":
-            continue
-
-        file_path = os.path.join(root, file)
-
-        # Analysing M1 only
-        print(f"\nAnalysing file: {file_path}")
-
-        # Work with the name in capital letters
-        file_ = file.upper().strip()
-        
-        # Store the new file name parts
-        new_name = {}
+    # Work with the name in capital letters
+    file_ = file.upper().strip()
+    
+    # Store the new file name parts
+    new_name = {}
 
-        check_beginning_is_correct(file_)
-        condition = get_condition(file_)
-        new_name['condition'] = condition
+    check_beginning_is_correct(file_)
+    condition = get_condition(file_)
+    new_name['condition'] = condition
 
-        codigo, year, gender, fitbit = get_user_id(file_, condition)
-        print(codigo, year, gender, fitbit)
+    # The centre of each folder is looked up once
+    centre_id = get_centre_id(root)
+    codigo, year, gender, fitbit = get_user_id(file_, condition, centre_id)
+    print(codigo, year, gender, fitbit)
 
-        formato = "{directory}_{condition}_{user}_{centro}_{gender}"
-        # formato.format(**new_name)
\ No newline at end of file
+    formato = "{directory}_{condition}_{user}_{centro}_{gender}"
+    # formato.format(**new_name)
\ No newline at end of file